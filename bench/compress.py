@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark: nén luồng theo message (proto.Deflater, cap "zlib").
+
+Với từng mức nén: tỉ lệ byte trên dây (kể cả header frame) và thông lượng
+CPU khi nén các loại message thật: replay lịch sử khi /join, danh sách pin,
+gói JSON, chunk file text / PDF-like và chunk đã nén sẵn (jpg – packable()
+phải bỏ qua). Decoder giải nén lại để kiểm tra dữ liệu khớp.
+    python3 bench/compress.py [--mb N] [--levels 1,6,9]
+"""
+
+import argparse, json, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from proto import Decoder, Deflater, ZMIN, packable, pack_chunk
+
+CHUNK = 64 * 1024
+
+def workloads(mb):
+    total, rnd = mb << 20, random.Random(7)
+    words = "xin chào các bạn hôm nay mình gửi file báo cáo nhé ok cảm ơn".split()
+    chat = [f"[MSG #{i}] user{i % 9}: {' '.join(rnd.choices(words, k=rnd.randint(3, 14)))}\n".encode()
+            for i in range(total // 60)]
+    replay = [b"".join(chat[i:i+50]) for i in range(0, len(chat), 50)]     # một khối mỗi /join
+    pins = [b"-- PINNED --\n" + b"".join(f"{n}) ".encode() + c for n, c in enumerate(chat[i:i+20], 1))
+            for i in range(0, len(chat), 20)]
+    js = [(json.dumps({"type": "file_start", "filename": f"bao_cao_{i}.pdf", "size": i * 977,
+                       "from": "alice", "to": [], "tid": i, "xid": os.urandom(8).hex()}) + "\n").encode()
+          for i in range(total // 200)]
+    text = b"".join(chat)
+    pdfish = b"".join(b"%d 0 obj << /Type /Page /Font /F1 >> stream\nBT 12 Tf (%s) Tj ET\nendstream\n"
+                      % (i, c) for i, c in enumerate(chat))[:total]
+    jpg = b"\xff\xd8\xff" + os.urandom(total)
+    chunks = lambda data: [pack_chunk(1, o, data[o:o+CHUNK]) for o in range(0, len(data), CHUNK)]
+    return [("join replay", replay, None), ("pinned list", pins, None), ("json packets", js, None),
+            ("text file", chunks(text), text), ("pdf-like file", chunks(pdfish), pdfish),
+            ("jpg file", chunks(jpg), jpg)]
+
+def run(level, msgs, head):
+    z = Deflater(level)
+    skip = head is not None and not packable(head[:65536])
+    wire = []
+    for m in msgs:
+        wire.append(m if skip or len(m) < ZMIN else z.pack(m))
+    dec = Decoder(max_frame=CHUNK + 64)
+    t = time.perf_counter()
+    out = sum(1 for d in wire for _fr in dec.feed(d))
+    return z, sum(map(len, wire)), time.perf_counter() - t, out, skip
+
+def frames(msgs):
+    dec = Decoder(max_frame=CHUNK + 64)
+    return sum(1 for m in msgs for _fr in dec.feed(m))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mb", type=int, default=4, help="kích thước mỗi loại (MB)")
+    ap.add_argument("--levels", default="1,6,9", help="các mức zlib cần đo")
+    a = ap.parse_args()
+    levels = [int(x) for x in a.levels.split(",")]
+    print(f"{'payload':>14} {'MB':>6} {'lvl':>4} {'wire %':>7} {'deflate MB/s':>13} {'inflate MB/s':>13}")
+    for name, msgs, head in workloads(a.mb):
+        raw = sum(map(len, msgs)); mb = raw / (1 << 20); want = frames(msgs)
+        for lvl in levels:
+            z, wire, dt, n, skip = run(lvl, msgs, head)
+            assert n == want, (name, n, want)       # giải nén ra đúng chừng ấy dòng / frame
+            cpu = f"{z.raw / max(z.cpu, 1e-9) / 1e6:>13.0f}" if z.raw else f"{'skipped':>13}"
+            print(f"{name:>14} {mb:>6.1f} {lvl:>4} {wire / raw:>7.0%} {cpu} {mb / dt:>13.0f}")
+            if skip: break                      # mức nén không ảnh hưởng: packable() đã bỏ qua
+
+if __name__ == "__main__":
+    main()
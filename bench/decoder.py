@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark: tách luồng byte nhận được thành dòng / frame.
+
+So sánh cách cũ (decode từng recv rồi buf.split("\\n", 1) trên str), bản
+bytes cắt chuỗi mỗi frame và proto.Decoder (bytearray + offset) với các
+đợt dữ liệu lớn đọc theo khối 64 KB.
+    python3 bench/decoder.py [--mb N]
+"""
+
+import argparse, base64, json, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from proto import Decoder, FRAME, BIN, pack_frame
+
+READ = 65536
+
+def split_str(chunks, errors="replace"):
+    """Cách cũ của client_thread / recv_thread (cách cũ dùng errors="strict")."""
+    buf, n = "", 0
+    for d in chunks:
+        buf += d.decode("utf-8", errors)
+        while "\n" in buf:
+            _line, buf = buf.split("\n", 1); n += 1
+    return n
+
+class SliceDecoder:
+    """Bản bytes đầu tiên: buf += data, cắt bytes mỗi frame."""
+    def __init__(self):
+        self.buf = b""
+
+    def feed(self, data):
+        self.buf += data
+        while self.buf:
+            if self.buf[0] == BIN:
+                if len(self.buf) < FRAME.size: return
+                _m, tid, seq, n = FRAME.unpack_from(self.buf)
+                end = FRAME.size + n
+                if len(self.buf) < end: return
+                payload, self.buf = self.buf[FRAME.size:end], self.buf[end:]
+                yield ("bin", tid, seq, payload)
+            else:
+                i = self.buf.find(b"\n")
+                if i < 0: return
+                raw, self.buf = self.buf[:i], self.buf[i+1:]
+                yield ("line", raw.decode("utf-8", "replace"))
+
+def run(cls, chunks):
+    dec, n = cls(), 0
+    for d in chunks:
+        for _fr in dec.feed(d): n += 1
+    return n
+
+def pieces(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+def workloads(mb):
+    total = mb << 20
+    chat = b"".join(f"[MSG #{i}] alice: xin chào các bạn {i}\n".encode() for i in range(total // 40))
+    chunk = os.urandom(4096)
+    js = (json.dumps({"type": "file_chunk", "filename": "a.bin", "from": "alice",
+                      "data": base64.b64encode(chunk).decode()}) + "\n").encode()
+    frames = (pack_frame(1, 0, chunk) + b"[MSG #1] bob: ok\n") * (total // 4200)
+    long_line = b"x" * (512 << 10) + b"\n"
+    return [("chat lines", pieces(chat[:total], READ), True),
+            ("json chunks", pieces(js * (total // len(js)), READ), True),
+            ("bin frames", pieces(frames, READ), False),
+            ("512K line/1K", pieces(long_line, 1024), True)]
+
+def timed(fn, chunks):
+    t = time.perf_counter(); fn(chunks)
+    return time.perf_counter() - t
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mb", type=int, default=8, help="kích thước mỗi đợt (MB)")
+    a = ap.parse_args()
+    print(f"{'burst':>14} {'MB':>6} {'str split MB/s':>15} {'bytes slice MB/s':>17} {'Decoder MB/s':>13}")
+    for name, chunks, text in workloads(a.mb):
+        mb = sum(map(len, chunks)) / (1 << 20)
+        old = f"{mb / timed(split_str, chunks):>15.1f}" if text else f"{'n/a':>15}"
+        sl = timed(lambda c: run(SliceDecoder, c), chunks)
+        new = timed(lambda c: run(Decoder, c), chunks)
+        print(f"{name:>14} {mb:>6.1f} {old} {mb / sl:>17.1f} {mb / new:>13.1f}")
+
+    # UTF-8 nhiều byte bị tách giữa hai recv
+    line = "[MSG #7] dũng: Tiếng Việt có dấu – ổn không?\n".encode()
+    def old_ok(cut):
+        try: return split_str([line[:cut], line[cut:]], "strict") == 1
+        except UnicodeDecodeError: return False
+    def new_ok(cut):
+        d = Decoder()
+        return [fr[1] for part in (line[:cut], line[cut:]) for fr in d.feed(part)] == [line[:-1].decode()]
+    cuts = range(1, len(line))
+    bad, good = sum(not old_ok(c) for c in cuts), sum(map(new_ok, cuts))
+    print(f"split UTF-8: str split fails {bad}/{len(line)-1} cut points, Decoder ok {good}/{len(line)-1}")
+
+if __name__ == "__main__":
+    main()
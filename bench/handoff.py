@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: nâng cấp server bằng --handoff khi đang có người chat.
+
+Với mỗi cỡ trong --users: chạy server.py --handoff mới, nối chừng ấy user
+(dòng văn bản thường, --fanout user mỗi phòng), một thread cho --rate dòng chat
+mỗi giây, mỗi dòng mang thời điểm gửi (monotonic dùng chung của máy). Sau
+--warm giây chạy server.py thứ hai với cùng PATH rồi đo tiếp --after giây. In:
+thời gian server cũ gửi trạng thái, thời gian server mới tiếp quản, độ trễ dòng
+chat p50 / max trước và quanh lúc chuyển, số dòng thiếu và số kết nối bị đóng
+(phải là 0 và 0).
+    python3 bench/handoff.py [--users 100,1000,4000] [--fanout 50] [--rate 200]
+"""
+
+import argparse, os, random, re, selectors, shutil, socket, subprocess, sys, tempfile, threading, time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LINE = re.compile(rb"\] (u\d+): t=([\d.]+) n=(\d+)")
+
+def launch(port, path, log):
+    # log ra file: server in mỗi lần login, pipe không ai đọc sẽ đầy và chặn nó
+    return subprocess.Popen([sys.executable, "server.py", "--port", str(port), "--handoff", path,
+                             "--limit", "msg=0,cmd=0,room_msg=0"],
+                            cwd=ROOT, stdout=open(log, "w"), stderr=subprocess.STDOUT)
+
+def wait_for(log, txt, t=60):
+    # chờ dòng chứa txt trong log của server, trả lại dòng đó
+    end = time.monotonic() + t
+    while time.monotonic() < end:
+        for l in open(log, encoding="utf-8", errors="replace"):
+            if txt in l: return l
+        time.sleep(0.02)
+    raise RuntimeError(f"server never printed {txt!r}")
+
+def ms_of(line):
+    return float(re.search(r"in (\d+) ms", line).group(1))
+
+def run(n, fanout, rate, warm, after, port):
+    d = tempfile.mkdtemp(prefix="handoffbench")
+    path = os.path.join(d, "ho.sock")
+    la, lb = os.path.join(d, "a.log"), os.path.join(d, "b.log")
+    old = launch(port, path, la); wait_for(la, "listening")
+    sel, socks, room = selectors.DefaultSelector(), [], {}
+    for i in range(n):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.sendall(f"u{i}\n/create hb{i // fanout}\n/join hb{i // fanout}\n".encode())  # "Room exists": bỏ qua
+        s.setblocking(False); sel.register(s, selectors.EVENT_READ, i); socks.append(s)
+        room[f"u{i}"] = i // fanout
+    members = {r: sum(1 for v in room.values() if v == r) for r in set(room.values())}
+    sent, lat, closed, stop = {}, [], [0], threading.Event()
+    phase = ["warm"]
+
+    def talk():
+        k, gap = 0, 1 / rate
+        nxt = time.monotonic() + 1                 # chờ login / join xong
+        while not stop.is_set():
+            time.sleep(max(0, nxt - time.monotonic())); nxt += gap
+            i = random.randrange(n)
+            sent[k] = (room[f"u{i}"], phase[0])
+            try: socks[i].send(f"t={time.monotonic()} n={k}\n".encode())
+            except (BlockingIOError, OSError): sent.pop(k)
+            k += 1
+
+    th = threading.Thread(target=talk, daemon=True); th.start()
+    bufs, got = [b""] * n, {}
+    def pump(until):
+        while time.monotonic() < until:
+            for key, _ in sel.select(0.05):
+                i = key.data
+                try: data = key.fileobj.recv(1 << 16)
+                except BlockingIOError: continue
+                except OSError: data = b""
+                if not data:
+                    closed[0] += 1; sel.unregister(key.fileobj); continue
+                *lines, bufs[i] = (bufs[i] + data).split(b"\n")
+                now = time.monotonic()
+                for l in lines:
+                    m = LINE.search(l)
+                    if m and int(m.group(3)) in sent:
+                        k = int(m.group(3)); got[k] = got.get(k, 0) + 1
+                        lat.append((sent[k][1], now - float(m.group(2))))
+    pump(time.monotonic() + 1 + warm)
+    phase[0] = "handoff"
+    new = launch(port, path, lb)
+    pump(time.monotonic() + 0.2)                   # vẫn đọc trong lúc chuyển
+    took = wait_for(lb, "Took over")
+    handed = wait_for(la, "Handed"); old.wait(10)
+    pump(time.monotonic() + after)
+    stop.set(); th.join()
+    pump(time.monotonic() + 1)                     # phần còn bay
+    missing = sum(members[r] - got.get(k, 0) for k, (r, _ph) in sent.items())
+    for s in socks: s.close()
+    new.terminate(); new.wait()
+    shutil.rmtree(d, ignore_errors=True)
+    q = lambda xs, p: sorted(xs)[min(len(xs) - 1, int(p * len(xs)))] * 1e3 if xs else 0.0
+    before = [x for ph, x in lat if ph == "warm"]; around = [x for ph, x in lat if ph == "handoff"]
+    return ms_of(handed), ms_of(took), q(before, .5), max(before, default=0) * 1e3, \
+           q(around, .5), max(around, default=0) * 1e3, missing, closed[0]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", default="100,1000,4000")
+    ap.add_argument("--fanout", type=int, default=50, help="user mỗi phòng")
+    ap.add_argument("--rate", type=float, default=200, help="dòng chat mỗi giây (tổng)")
+    ap.add_argument("--warm", type=float, default=2)
+    ap.add_argument("--after", type=float, default=2)
+    ap.add_argument("--port", type=int, default=12399)
+    a = ap.parse_args()
+    try:                                        # nghìn kết nối: nâng giới hạn fd (server con thừa hưởng)
+        import resource
+        _soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError): pass
+    print(f"fanout {a.fanout}, {a.rate:g} lines/s; latency in ms before / around the handoff")
+    print(f"{'users':>6} {'handed ms':>9} {'took ms':>8} {'p50':>6} {'max':>7} {'p50 ho':>7} {'max ho':>7} "
+          f"{'missing':>7} {'closed':>6}")
+    for i, n in enumerate(map(int, a.users.split(","))):
+        r = run(n, a.fanout, a.rate, a.warm, a.after, a.port + i)
+        print(f"{n:>6} {r[0]:>9.0f} {r[1]:>8.0f} {r[2]:>6.2f} {r[3]:>7.1f} {r[4]:>7.2f} {r[5]:>7.1f} "
+              f"{r[6]:>7} {r[7]:>6}", flush=True)
+
+if __name__ == "__main__":
+    main()
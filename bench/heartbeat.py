@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: hạn login / heartbeat (bánh xe wheel.py) với hàng chục nghìn socket.
+
+Chạy server.py (--ping, --dead, --login-timeout ngắn) rồi mở --conns kết nối,
+chia ba nhóm: "live" login với cap ping và trả pong, "deaf" login rồi im lặng
+(như peer đã mất: half-open), "mute" không bao giờ login. Hai user đo gửi dòng
+chat qua lại mỗi 20 ms suốt thời gian đó, mỗi dòng mang thời điểm gửi. In: CPU
+server khi chỉ có heartbeat, độ trễ dòng chat trước / trong lúc dọn, số kết nối
+mỗi nhóm bị đóng (deaf + mute phải hết, live phải còn đủ) và số server báo.
+    python3 bench/heartbeat.py [--conns 20000] [--ping 2] [--dead 5] [--login 3]
+"""
+
+import argparse, os, re, selectors, socket, subprocess, sys, tempfile, time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LOGIN = b'{"type":"login","name":"%s","caps":["ping"]}\n'
+
+def cpu(pid):
+    # giây CPU (user + sys) của process, đọc /proc
+    f = open(f"/proc/{pid}/stat").read().rsplit(")", 1)[1].split()
+    return (int(f[11]) + int(f[12])) / os.sysconf("SC_CLK_TCK")
+
+def closed(s):
+    # đọc hết phần đang chờ; True nếu server đã đóng
+    s.setblocking(False)
+    while True:
+        try: d = s.recv(1 << 16)
+        except BlockingIOError: return False
+        except OSError: return True
+        if not d: return True
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--conns", type=int, default=20000)
+    ap.add_argument("--ping", type=float, default=2)
+    ap.add_argument("--dead", type=float, default=5)
+    ap.add_argument("--login", type=float, default=3)
+    ap.add_argument("--port", type=int, default=12398)
+    a = ap.parse_args()
+    try:                                        # nghìn kết nối: nâng giới hạn fd (server con thừa hưởng)
+        import resource
+        _soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError): pass
+    log = tempfile.NamedTemporaryFile("w+", prefix="hbbench", suffix=".log")
+    srv = subprocess.Popen([sys.executable, "server.py", "--port", str(a.port), "--ping", str(a.ping),
+                            "--dead", str(a.dead), "--login-timeout", str(a.login),
+                            "--limit", "msg=0,cmd=0,room_msg=0"],
+                           cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+    for _ in range(100):
+        try: socket.create_connection(("127.0.0.1", a.port)).close(); break
+        except OSError: time.sleep(0.05)
+    sel = selectors.DefaultSelector()
+    def login(name, room=None):
+        s = socket.create_connection(("127.0.0.1", a.port))
+        s.sendall(LOGIN % name.encode() + (f"/join {room}\n".encode() if room else b""))
+        return s
+    tx, rx = login("probe_tx", "room1"), login("probe_rx", "room1")
+    groups = {"live": [], "deaf": [], "mute": []}
+    t0 = time.monotonic()
+    for i in range(a.conns):
+        kind = ("live", "deaf", "mute")[i % 3]
+        s = login(f"{kind}{i}") if kind != "mute" else socket.create_connection(("127.0.0.1", a.port))
+        groups[kind].append(s)
+    for s in groups["live"] + [tx, rx]:
+        s.setblocking(False); sel.register(s, selectors.EVENT_READ, bytearray())
+    print(f"{a.conns} connections in {time.monotonic() - t0:.1f} s; ping {a.ping:g} s, dead {a.dead:g} s, "
+          f"login timeout {a.login:g} s", flush=True)
+    lat, pongs, nxt, start = [], 0, time.monotonic(), time.monotonic()
+    c0 = cpu(srv.pid); cpu_idle = None
+    end = start + a.dead + a.ping + 3
+    while time.monotonic() < end:
+        now = time.monotonic()
+        if now >= nxt:
+            tx.send(f"t={now}\n".encode()); nxt += 0.02
+        for key, _ in sel.select(max(0, nxt - time.monotonic())):
+            s, buf = key.fileobj, key.data
+            try: d = s.recv(1 << 16)
+            except (BlockingIOError, InterruptedError): continue
+            if not d: sel.unregister(s); continue
+            buf += d
+            *lines, rest = bytes(buf).split(b"\n"); buf[:] = rest
+            for l in lines:
+                if l == b'{"type":"ping"}':
+                    s.send(b'{"type":"pong"}\n'); pongs += 1
+                elif s is rx and b": t=" in l:
+                    lat.append((time.monotonic(), time.monotonic() - float(l.rsplit(b"t=", 1)[1])))
+        if cpu_idle is None and time.monotonic() >= start + min(a.login, a.ping) - 0.5:
+            cpu_idle = (cpu(srv.pid) - c0) / (time.monotonic() - start)   # chưa tới hạn nào
+    tx.sendall(b"/stats\n"); time.sleep(0.5)
+    stats = b""
+    while True:
+        try: stats += tx.recv(1 << 16)
+        except (BlockingIOError, InterruptedError): break
+    gone = {k: sum(closed(s) for s in v) for k, v in groups.items()}
+    srv.terminate(); srv.wait()
+    log.seek(0); out = log.read()
+    before = sorted(x for t, x in lat if t < start + min(a.login, a.ping))
+    during = sorted(x for t, x in lat if t >= start + min(a.login, a.ping))
+    q = lambda xs, p: xs[min(len(xs) - 1, int(p * len(xs)))] * 1e3 if xs else 0.0
+    m = re.findall(r"Reaped: .*", stats.decode(errors="replace"))
+    print(f"server CPU before any deadline: {cpu_idle * 100:.1f}%")
+    print(f"chat latency ms  before: p50 {q(before, .5):.2f} p99 {q(before, .99):.2f} max {before[-1] * 1e3 if before else 0:.1f}"
+          f"  during reaping: p50 {q(during, .5):.2f} p99 {q(during, .99):.2f} max {during[-1] * 1e3 if during else 0:.1f}")
+    print(f"closed by server: live {gone['live']}/{len(groups['live'])}, deaf {gone['deaf']}/{len(groups['deaf'])}, "
+          f"mute {gone['mute']}/{len(groups['mute'])}; pongs sent {pongs}")
+    print("server:", m[0] if m else "?")
+    for l in out.splitlines():
+        if "Reaped" in l: print("  " + l)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark: tra cứu message theo id trong lịch sử phòng.
+
+So sánh quét tuyến tính trên deque (cách cũ của /recall, /reply, /pin,
+/forward) với History (ring buffer + chỉ mục) khi dung lượng tăng dần.
+    python3 bench/history_lookup.py [--lookups N]
+"""
+
+import argparse, os, random, sys, timeit
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from history import History
+
+def scan(dq, mid):
+    return next((h for h in dq if h[0] == mid), None)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--lookups", type=int, default=2000)
+    a = ap.parse_args()
+    print(f"{'capacity':>10} {'deque scan µs':>14} {'History.get µs':>15} {'recall µs':>10}")
+    for cap in (1_000, 10_000, 100_000, 1_000_000):
+        total = cap * 3                         # đã có eviction nhiều vòng
+        dq, h = deque(maxlen=cap), History(cap)
+        for i in range(1, total + 1):
+            e = (i, "u", f"[MSG #{i}] u: hello {i}")
+            dq.append(e); h.append(e)
+        ids = [random.randint(total - cap + 1, total) for _ in range(a.lookups)]
+        it = iter(ids)
+        n_scan = max(20, a.lookups // (cap // 1000))   # quét chậm: ít lần hơn
+        lin = timeit.timeit(lambda: scan(dq, next(it)), number=n_scan) / n_scan * 1e6
+        it = iter(ids)
+        get = timeit.timeit(lambda: h.get(next(it)), number=a.lookups) / a.lookups * 1e6
+        it = iter(ids)
+        rec = timeit.timeit(lambda: h.replace((m := next(it)), (m, "u", "(recalled)")),
+                            number=a.lookups) / a.lookups * 1e6
+        print(f"{cap:>10} {lin:>14.2f} {get:>15.3f} {rec:>10.3f}")
+
+if __name__ == "__main__":
+    main()
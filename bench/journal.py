@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: lưu đồ thị bạn bè (server.py --state) và khởi động lại.
+
+Dựng E cạnh bạn bè (mỗi cạnh = /addfriend + /acceptfriend) qua Social có
+journal, như server làm. Đo thời gian thêm vào mỗi lệnh (Social.accept có
+ghi journal so với không), tốc độ writer ghi + fsync, rồi thời gian nạp lại
+khi: (1) toàn bộ nằm trong log, (2) sau khi gộp thành snapshot, (3) snapshot
++ đuôi log SNAP_EVERY bản ghi – lúc writer sắp gộp.
+    python3 bench/journal.py [--edges 1000000] [--degree 20] [--dir /tmp/jbench]
+"""
+
+import argparse, os, shutil, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import journal
+from journal import Journal
+from state import Social
+
+def edges(n_edges, degree):
+    users = max(2, 2 * n_edges // degree)
+    half = max(1, degree // 2)
+    for i in range(n_edges):
+        u, k = divmod(i, half)
+        yield f"user{u % users}", f"user{(u + k * 7919 + 1) % users}"
+
+def build(soc, pairs):
+    t = time.perf_counter(); n = 0
+    for u, v in pairs:
+        soc.request(u, v); soc.accept(v, u); n += 1
+    return (time.perf_counter() - t) / n * 1e6
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--edges", type=int, default=1_000_000)
+    ap.add_argument("--degree", type=int, default=20, help="số bạn trung bình mỗi user")
+    ap.add_argument("--dir", default="/tmp/jbench")
+    a = ap.parse_args()
+    shutil.rmtree(a.dir, ignore_errors=True)
+    print(f"{a.edges} friend edges, ~{2 * a.edges // a.degree} users")
+    plain = build(Social(), edges(min(a.edges, 200_000), a.degree))
+    jn = Journal(a.dir); jn.load()
+    soc = Social(jn)
+    t0 = time.perf_counter()
+    per = build(soc, edges(a.edges, a.degree))
+    t1 = time.perf_counter(); jn.sync(); t2 = time.perf_counter()
+    print(f"request+accept: {plain:.2f} µs without journal, {per:.2f} µs with "
+          f"({(per - plain) / 2:.2f} µs per logged change, writer never on the command path)")
+    print(f"writer: {2 * a.edges} records on disk {t2 - t0:.1f}s after the first, "
+          f"{t2 - t1:.2f}s after the last command")
+    t = time.perf_counter()
+    while jn.tail >= journal.SNAP_EVERY or (jn.child and jn.child.poll() is None): time.sleep(0.05)
+    print(f"auto-compaction caught up {time.perf_counter() - t:.1f}s later")
+    size = sum(os.path.getsize(os.path.join(a.dir, f)) for f in os.listdir(a.dir))
+    tail, journal.SNAP_EVERY = journal.SNAP_EVERY, 1 << 62       # gộp bằng tay từ đây
+    def restart(label):
+        t = time.perf_counter(); d, n, _ = journal.load(a.dir)
+        dt = time.perf_counter() - t
+        e = sum(map(len, d["friends"].values())) // 2
+        print(f"{label:<34} {dt:>6.2f}s  ({n} log records replayed, {e} edges)")
+    print(f"on disk: {size / 1e6:.1f} MB")
+    restart("load after auto-compaction")
+    journal.compact(a.dir, max(journal.gens(a.dir)))
+    print(f"snapshot: {os.path.getsize(os.path.join(a.dir, 'snapshot')) / 1e6:.1f} MB")
+    restart("snapshot only")
+    jn = Journal(a.dir); d = jn.load()
+    soc = Social(jn); soc.restore(d)
+    build(soc, edges(tail // 2, a.degree // 2 or 1))
+    jn.sync()
+    restart(f"snapshot + {tail}-record tail")
+
+if __name__ == "__main__":
+    main()
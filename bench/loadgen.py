@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load generator không giao diện: hàng nghìn user giả nói đúng giao thức của
+client.py (gói login + caps, /join, dòng chat, PM JSON, upload "xfer" bằng
+frame v2 có credit theo file_ack, nén "zlib" nếu bật) – không Tkinter, không
+input(). Mỗi process con chạy một event loop selectors cho phần user của nó.
+
+Với mỗi mode server (mỗi mode một server con mới) chạy cùng một kịch bản rồi
+in bảng: message gửi / nhận mỗi giây, tỉ lệ tới nơi, độ trễ end-to-end
+p50/p90/p99/max (timestamp nằm trong nội dung, đồng hồ monotonic dùng chung
+của máy), độ trễ PM, thông lượng relay file (MB/s phía người nhận) và độ trễ
+nhận trọn một file, CPU / RSS đỉnh của server (cả các worker, đọc /proc).
+
+Kịch bản là các tham số trong SCENARIOS, hoặc file JSON cùng khoá (có thể có
+"base": tên kịch bản gốc); --set k=v ghi đè từng tham số. --json lưu kết quả,
+--baseline so với lần lưu trước và thoát mã 1 nếu tụt quá --tolerance.
+    python3 bench/loadgen.py [--scenario mixed] [--modes loop,thread,workers4]
+    python3 bench/loadgen.py --scenario chat --set users=3000 --json base.json
+    python3 bench/loadgen.py --scenario chat --baseline base.json
+    python3 bench/loadgen.py --connect 127.0.0.1:12345   # server đang chạy sẵn
+"""
+
+import argparse, hashlib, heapq, json, math, multiprocessing as mp, os, random, secrets
+import selectors, socket, subprocess, sys, threading, time, zlib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from proto import Decoder, FrameError, Deflater, ZMIN, pack_chunk
+
+DEFAULTS = dict(users=100, rooms=4,         # user chia đều vào các phòng lg0, lg1, …
+                rate=1.0, msg_bytes=64,     # dòng chat mỗi giây mỗi user, độ dài dòng
+                pm_rate=0.0,                # PM mỗi giây mỗi user (tới một user ngẫu nhiên)
+                file_users=0, file_kb=512,  # số user gửi file vào phòng, kích thước file
+                file_every=5.0,             # giây giữa hai lần gửi của một user
+                duration=10.0, drain=2.0,   # giây đo, giây chờ nốt phần đang bay
+                ramp=500,                   # kết nối mới mỗi giây (tổng)
+                zlib=False)
+SCENARIOS = {
+    "smoke": dict(users=40, rooms=4, rate=1.0, pm_rate=0.2, file_users=2, file_kb=256,
+                  file_every=1.0, duration=5),
+    "chat":  dict(users=2000, rooms=20, rate=0.2, duration=20),
+    "pm":    dict(users=1000, rooms=10, rate=0.05, pm_rate=0.5, duration=20),
+    "mixed": dict(users=1000, rooms=10, rate=0.3, pm_rate=0.05, file_users=10, file_kb=1024,
+                  file_every=5.0, duration=20),
+    "files": dict(users=100, rooms=4, rate=0.1, file_users=20, file_kb=4096, file_every=1.0,
+                  duration=20),
+}
+MODES = {"loop": ["--mode", "loop"], "thread": ["--mode", "thread"]}   # + "workers<N>"
+CHUNK = 64 * 1024                           # chunk file, như client khi đường truyền nhanh
+WINDOW = 1 << 20                            # byte gửi trước ack của server (client.WINDOW)
+OUT_HIGH = 256 * 1024                       # chỉ nạp thêm chunk khi buffer gửi thấp hơn
+
+def now_us(): return int(time.monotonic() * 1e6)
+
+# ────────── histogram độ trễ (µs, mốc log 5%) ──────────
+LO, STEP, NB = 10.0, math.log(1.05), 400
+
+def hist(): return [0] * NB
+def hist_add(h, us): h[min(NB - 1, max(0, int(math.log(max(us, LO) / LO) / STEP)))] += 1
+def hist_merge(a, b): return [x + y for x, y in zip(a, b)]
+def pct(h, q):
+    """Giá trị (ms) mà q phần các mẫu không vượt quá; None nếu không có mẫu."""
+    n = sum(h)
+    if not n: return None
+    want, acc = q * n, 0
+    for i, c in enumerate(h):
+        acc += c
+        if acc >= want: return LO * math.exp(STEP * (i + 1)) / 1000
+    return None
+
+# ────────── phía user giả (process con) ──────────
+class User:
+    __slots__ = ("i", "name", "room", "sock", "dec", "z", "out", "ev", "joined", "up", "rx", "alive")
+    def __init__(self, i, tag, rooms):
+        self.i, self.name, self.room = i, f"{tag}u{i}", f"lg{i % rooms}"
+        self.sock, self.dec, self.z, self.out = None, Decoder(raw=True), None, bytearray()
+        self.ev, self.joined, self.up, self.rx, self.alive = 0, False, None, {}, False
+
+class Gen:
+    def __init__(self, k, procs, sc, addr, tag):
+        self.sc, self.addr = sc, addr
+        self.users = [User(i, tag, sc["rooms"]) for i in range(k, sc["users"], procs)]
+        self.names = [f"{tag}u{i}" for i in range(sc["users"])]
+        self.sel, self.rnd = selectors.DefaultSelector(), random.Random(k)
+        self.t0 = None                          # µs lúc bắt đầu đo
+        self.r = dict(sent=0, pm_sent=0, recv=0, pm_recv=0, lat=hist(), pm_lat=hist(), file_lat=hist(),
+                      file_bytes=0, files_sent=0, files_done=0, closed=0, sent_rooms={})
+        kb = sc["file_kb"] * 1024
+        self.data = secrets.token_bytes(kb)     # ngẫu nhiên: không nén được, như ảnh / video
+        self.sha = hashlib.sha256(self.data).hexdigest()
+        self.chunks = [(o, self.data[o:o+CHUNK], zlib.crc32(self.data[o:o+CHUNK])) for o in range(0, kb, CHUNK)]
+
+    # ---- gửi ----
+    def push(self, u, data):
+        if u.z and len(data) >= ZMIN: data = u.z.pack(data)
+        u.out += data
+
+    def line(self, u, obj):
+        self.push(u, (json.dumps(obj) + "\n").encode() if isinstance(obj, dict) else obj.encode() + b"\n")
+
+    def flush(self, u):
+        while True:
+            self.refill(u)
+            if not u.out: break
+            try: n = u.sock.send(u.out)
+            except (BlockingIOError, InterruptedError): break
+            except OSError: self.close(u); return
+            del u.out[:n]
+        ev = selectors.EVENT_READ | (selectors.EVENT_WRITE if u.out else 0)
+        if ev != u.ev: self.sel.modify(u.sock, ev, u); u.ev = ev
+
+    def refill(self, u):
+        # nạp chunk file khi buffer gửi đã vơi và còn credit (offset - ack < WINDOW)
+        up = u.up
+        while up and len(u.out) < OUT_HIGH:
+            if up["next"] == len(self.chunks):
+                self.line(u, {"type": "file_end", "filename": up["fn"], "from": u.name,
+                              "tid": up["tid"], "xid": up["xid"]})
+                u.up = up = None; break
+            off, payload, crc = self.chunks[up["next"]]
+            if off - up["acked"] >= WINDOW: break
+            u.out += pack_chunk(up["tid"], off, payload, crc); up["next"] += 1
+
+    # ---- sự kiện theo lịch ----
+    def chat(self, u):
+        text = f"lg {now_us()} "
+        self.line(u, text + "x" * max(0, self.sc["msg_bytes"] - len(text)))
+        self.r["sent"] += 1
+        self.r["sent_rooms"][u.room] = self.r["sent_rooms"].get(u.room, 0) + 1
+
+    def pm(self, u):
+        to = self.rnd.choice(self.names)
+        if to == u.name: to = self.names[(u.i + 1) % len(self.names)]   # server không gửi PM cho chính mình
+        self.line(u, {"type": "msg", "to": [to], "text": f"lg {now_us()}", "from": u.name})
+        self.r["pm_sent"] += 1
+
+    def upload(self, u):
+        if u.up: return                         # file trước chưa gửi xong
+        tid, xid = self.rnd.randrange(1, 1 << 28), secrets.token_hex(8)
+        fn = f"lg-{now_us()}.bin"
+        self.line(u, {"type": "file_start", "filename": fn, "size": len(self.data), "to": [],
+                      "from": u.name, "tid": tid, "xid": xid, "sha256": self.sha, "compress": False})
+        u.up = {"fn": fn, "tid": tid, "xid": xid, "next": 0, "acked": 0}
+        self.r["files_sent"] += 1
+
+    # ---- nhận ----
+    def read(self, u):
+        try: data = u.sock.recv(1 << 18)
+        except (BlockingIOError, InterruptedError): return
+        except OSError: data = b""
+        if not data: self.close(u); return
+        t = now_us()
+        try:
+            for fr in u.dec.feed(data):
+                if fr[0] == "bin" or fr[0] == "raw":
+                    rx = u.rx.get(fr[1])
+                    n = len(fr[3] if fr[0] == "bin" else fr[2])
+                    if rx: rx[2] += n
+                    if self.t0: self.r["file_bytes"] += n
+                    continue
+                self.on_line(u, fr[1], t)
+        except FrameError:
+            self.close(u)
+
+    def on_line(self, u, line, t):
+        j = line.find(": lg ")
+        if j >= 0 and line.startswith("[MSG #"):
+            ts = int(line[j+5:line.index(" ", j+5)])
+            if self.t0 and ts >= self.t0: self.r["recv"] += 1; hist_add(self.r["lat"], t - ts)
+            return
+        if line.startswith("{"):
+            try: pk = json.loads(line)
+            except ValueError: return
+            k = pk.get("type")
+            if k == "msg":
+                ts = int(str(pk.get("text", "0")).split()[-1])
+                if self.t0 and ts >= self.t0: self.r["pm_recv"] += 1; hist_add(self.r["pm_lat"], t - ts)
+            elif k == "file_ack":
+                if u.up and pk.get("xid") == u.up["xid"]: u.up["acked"] = pk.get("offset") or 0
+            elif k == "file_start":
+                u.rx[pk.get("tid")] = [int(pk["filename"][3:-4]), pk["size"], 0]
+            elif k == "file_end":
+                rx = u.rx.pop(pk.get("tid"), None)
+                if rx and rx[2] >= rx[1] and self.t0 and rx[0] >= self.t0:
+                    self.r["files_done"] += 1; hist_add(self.r["file_lat"], t - rx[0])
+            elif k == "welcome":
+                if "zlib" in pk.get("caps", ()): u.z = Deflater(1)
+            return
+        if not u.joined and f"Joined {u.room}" in line: u.joined = True
+
+    # ---- kết nối ----
+    def connect(self, u):
+        try: u.sock = socket.create_connection(self.addr, timeout=10)
+        except OSError: self.r["closed"] += 1; return
+        u.sock.setblocking(False); u.alive = True
+        caps = ["bin", "xfer"] + (["zlib"] if self.sc["zlib"] else [])
+        u.out += (json.dumps({"type": "login", "name": u.name, "caps": caps}) + "\n").encode()
+        u.out += f"/create {u.room}\n/join {u.room}\n".encode()  # "Room exists" khi đã có: bỏ qua
+        u.ev = selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.sel.register(u.sock, u.ev, u)
+
+    def close(self, u):
+        if not u.alive: return
+        u.alive = False; self.r["closed"] += 1
+        try: self.sel.unregister(u.sock)
+        except (KeyError, ValueError): pass
+        u.sock.close()
+
+    def poll(self, timeout):
+        for key, ev in self.sel.select(timeout):
+            u = key.data
+            if ev & selectors.EVENT_READ and u.alive: self.read(u)
+            if ev & selectors.EVENT_WRITE and u.alive: self.flush(u)
+
+    def run(self, procs, ready, go, stop):
+        sc, heap = self.sc, []
+        gap, nxt, todo = procs / sc["ramp"], time.monotonic(), list(self.users)
+        deadline = time.monotonic() + 60 + len(todo) * gap
+        while time.monotonic() < deadline:      # đăng nhập theo nhịp ramp
+            while todo and time.monotonic() >= nxt:
+                self.connect(todo.pop(0)); nxt += gap
+            self.poll(0.01)
+            if not todo and all(u.joined or not u.alive for u in self.users): break
+        ready.put(sum(u.joined for u in self.users))
+        while not go.is_set(): self.poll(0.01)
+        self.t0, start = now_us(), time.monotonic()
+        def plan(kind, u, rate):
+            if rate > 0: heapq.heappush(heap, (start + self.rnd.uniform(0, 1 / rate), u.i, kind, rate))
+        for u in self.users:
+            plan("chat", u, sc["rate"]); plan("pm", u, sc["pm_rate"])
+            if u.i < sc["file_users"]: plan("file", u, 1 / sc["file_every"])
+        users = {u.i: u for u in self.users}
+        cpu, end = time.process_time(), None
+        while end is None or time.monotonic() < end:
+            t = time.monotonic()
+            if end is None and stop.is_set(): end, heap = t + sc["drain"], []
+            dirty = set()
+            while heap and heap[0][0] <= t:
+                _t, i, kind, rate = heapq.heappop(heap)
+                u = users[i]
+                if not u.alive: continue
+                getattr(self, {"chat": "chat", "pm": "pm", "file": "upload"}[kind])(u)
+                dirty.add(u)
+                heapq.heappush(heap, (_t + self.rnd.expovariate(rate), i, kind, rate))
+            for u in dirty: self.flush(u)
+            self.poll(max(0.0, min(0.01, heap[0][0] - time.monotonic())) if heap else 0.01)
+        self.r["cpu"] = time.process_time() - cpu
+        for u in self.users: self.close(u)
+        self.r["closed"] -= len(self.users)     # chỉ tính các kết nối server đóng giữa chừng
+        return self.r
+
+def gen_proc(k, procs, sc, addr, tag, ready, go, stop, out):
+    out.put(Gen(k, procs, sc, addr, tag).run(procs, ready, go, stop))
+
+# ────────── phía điều phối ──────────
+def tree(pid):
+    """pid và mọi process con cháu (Linux /proc)."""
+    kids = {}
+    for d in os.listdir("/proc"):
+        if d.isdigit():
+            try:
+                with open(f"/proc/{d}/stat") as f: ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError): continue
+            kids.setdefault(ppid, []).append(int(d))
+    out, todo = [], [pid]
+    while todo:
+        p = todo.pop(); out.append(p); todo += kids.get(p, [])
+    return out
+
+def usage(pids):
+    # (giây CPU user+sys, RSS byte) cộng trên các process
+    cpu = rss = 0
+    tick, page = os.sysconf("SC_CLK_TCK"), os.sysconf("SC_PAGE_SIZE")
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/stat") as f: st = f.read().rsplit(")", 1)[1].split()
+        except OSError: continue
+        cpu += (int(st[11]) + int(st[12])) / tick; rss += int(st[21]) * page
+    return cpu, rss
+
+class Sampler(threading.Thread):
+    """Đo CPU server trong cửa sổ đo và RSS đỉnh (lấy mẫu mỗi 0.2 s)."""
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid, self.ok = pid, pid is not None and os.path.isdir("/proc")
+        self.done, self.peak, self.cpu = threading.Event(), 0, None
+    def run(self):
+        if not self.ok: return
+        pids = tree(self.pid); c0 = usage(pids)[0]
+        while not self.done.wait(0.2):
+            pids = tree(self.pid); self.peak = max(self.peak, usage(pids)[1])
+        self.cpu = usage(pids)[0] - c0
+
+def start_server(port, args):
+    p = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), "--port", str(port)] + args,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(200):
+        try: socket.create_connection(("127.0.0.1", port), timeout=1).close(); return p
+        except OSError: time.sleep(0.05)
+        if p.poll() is not None: break
+    p.kill(); raise SystemExit(f"server {args} did not start")
+
+def run_mode(sc, addr, pid, procs, tag):
+    ctx = mp.get_context("fork" if hasattr(os, "fork") else "spawn")
+    ready, out, go, stop = ctx.Queue(), ctx.Queue(), ctx.Event(), ctx.Event()
+    ps = [ctx.Process(target=gen_proc, args=(k, procs, sc, addr, tag, ready, go, stop, out), daemon=True)
+          for k in range(procs)]
+    for p in ps: p.start()
+    joined = sum(ready.get(timeout=120 + sc["users"] / sc["ramp"]) for _ in ps)
+    time.sleep(0.5)                             # replay /join và lời chào đã tới hết
+    smp = Sampler(pid); smp.start()
+    go.set(); time.sleep(sc["duration"]); stop.set()
+    smp.done.set()
+    rs = [out.get(timeout=sc["drain"] + 60) for _ in ps]
+    for p in ps: p.join(5)
+    smp.join()
+    r = {k: sum(x[k] for x in rs) for k in ("sent", "pm_sent", "recv", "pm_recv", "file_bytes",
+                                            "files_sent", "files_done", "closed", "cpu")}
+    for k in ("lat", "pm_lat", "file_lat"):
+        h = hist()
+        for x in rs: h = hist_merge(h, x[k])
+        r[k] = h
+    size = {}                                   # mỗi dòng chat tới mọi người trong phòng (kể cả người gửi)
+    for i in range(sc["users"]): size[f"lg{i % sc['rooms']}"] = size.get(f"lg{i % sc['rooms']}", 0) + 1
+    want = sum(n * size[room] for x in rs for room, n in x["sent_rooms"].items())
+    d = sc["duration"]
+    return {"joined": joined, "sent/s": r["sent"] / d, "recv/s": r["recv"] / d,
+            "delivered": r["recv"] / want if want else None,
+            "p50": pct(r["lat"], .5), "p90": pct(r["lat"], .9), "p99": pct(r["lat"], .99),
+            "max": pct(r["lat"], 1), "pm p50": pct(r["pm_lat"], .5), "pm p99": pct(r["pm_lat"], .99),
+            "pm ok": r["pm_recv"] / r["pm_sent"] if r["pm_sent"] else None,
+            "file MB/s": r["file_bytes"] / d / 1e6, "files": r["files_done"],
+            "file p50": pct(r["file_lat"], .5), "closed": r["closed"],
+            "srv cpu%": smp.cpu / d * 100 if smp.cpu is not None else None,
+            "srv MB": smp.peak / 1e6 if smp.ok else None, "gen cpu%": r["cpu"] / d * 100}
+
+COLS = [("joined", "{:.0f}"), ("sent/s", "{:.0f}"), ("recv/s", "{:.0f}"), ("delivered", "{:.1%}"),
+        ("p50", "{:.1f}"), ("p90", "{:.1f}"), ("p99", "{:.1f}"), ("max", "{:.0f}"),
+        ("pm p50", "{:.1f}"), ("pm p99", "{:.1f}"), ("pm ok", "{:.1%}"), ("file MB/s", "{:.1f}"),
+        ("files", "{:.0f}"), ("file p50", "{:.0f}"), ("closed", "{:.0f}"), ("srv cpu%", "{:.0f}"),
+        ("srv MB", "{:.0f}"), ("gen cpu%", "{:.0f}")]
+# chỉ số so với baseline: +1 = càng cao càng tốt, -1 = càng thấp càng tốt
+WATCH = {"recv/s": 1, "delivered": 1, "p50": -1, "p99": -1, "pm p99": -1, "file MB/s": 1}
+LAT_SLACK = 2.0                             # ms: chênh lệch độ trễ nhỏ hơn là nhiễu, không tính
+
+def table(res):
+    w = max([4] + [len(m) for m in res])
+    print(f"{'mode':>{w}} " + " ".join(f"{c:>9}" for c, _f in COLS))
+    for m, row in res.items():
+        print(f"{m:>{w}} " + " ".join(f"{(f.format(row[c]) if row.get(c) is not None else '-'):>9}"
+                                    for c, f in COLS))
+    print("latency columns in ms; delivered = chat lines received / (lines sent x room size)")
+
+def regressions(res, base, tol):
+    out = []
+    for m, row in res.items():
+        old = base.get(m)
+        for k, sign in WATCH.items() if old else ():
+            a, b = row.get(k), old.get(k)
+            if a is None or b is None or not b: continue
+            if sign * (a - b) / b < -tol and (sign > 0 or a - b > LAT_SLACK):
+                out.append(f"{m}: {k} {b:.4g} -> {a:.4g}")
+    return out
+
+def scenario(name, sets):
+    if name in SCENARIOS: sc = dict(DEFAULTS, **SCENARIOS[name])
+    else:
+        with open(name) as f: spec = json.load(f)
+        sc = dict(DEFAULTS, **SCENARIOS.get(spec.pop("base", None), {}), **spec)
+    for kv in sets:
+        k, _, v = kv.partition("=")
+        if k not in DEFAULTS: raise SystemExit(f"unknown parameter {k!r}")
+        sc[k] = v.lower() in ("1", "true", "yes") if isinstance(DEFAULTS[k], bool) else type(DEFAULTS[k])(v)
+    bad = [k for k in sc if k not in DEFAULTS]
+    if bad: raise SystemExit(f"unknown parameter(s) {bad}")
+    return sc
+
+def main():
+    ap = argparse.ArgumentParser(description="Headless load generator for server.py")
+    ap.add_argument("--scenario", default="smoke", help="tên trong SCENARIOS hoặc file JSON: "
+                    + ", ".join(SCENARIOS))
+    ap.add_argument("--set", action="append", default=[], metavar="K=V", help="ghi đè tham số kịch bản")
+    ap.add_argument("--modes", default="loop,thread,workers4", help="các mode server: loop, thread, workers<N>")
+    ap.add_argument("--server-args", default="", help="tham số thêm cho server.py (vd. \"--zlib-level 0\")")
+    ap.add_argument("--connect", metavar="HOST:PORT", help="dùng server đang chạy, không tự khởi động")
+    ap.add_argument("--pid", type=int, help="pid server (với --connect) để đo CPU/RSS")
+    ap.add_argument("--port", type=int, default=23800, help="cổng đầu cho các server con")
+    ap.add_argument("--procs", type=int, default=min(4, os.cpu_count() or 1), help="số process sinh tải")
+    ap.add_argument("--json", metavar="FILE", help="lưu kết quả")
+    ap.add_argument("--baseline", metavar="FILE", help="so với kết quả đã lưu")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="mức tụt cho phép so với baseline")
+    a = ap.parse_args()
+    sc = scenario(a.scenario, a.set)
+    try:                                        # nghìn kết nối: nâng giới hạn fd (server con thừa hưởng)
+        import resource
+        _soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError): pass
+    print("scenario:", ", ".join(f"{k}={v}" for k, v in sc.items()), flush=True)
+    res = {}
+    if a.connect:
+        host, _, port = a.connect.rpartition(":")
+        res["external"] = run_mode(sc, (host, int(port)), a.pid, a.procs, secrets.token_hex(3))
+    for n, m in enumerate([] if a.connect else a.modes.split(",")):
+        args = MODES.get(m) or (["--workers", m[7:]] if m.startswith("workers") and m[7:].isdigit() else None)
+        if args is None: raise SystemExit(f"unknown mode {m!r}")
+        port = a.port + 10 * n
+        srv = start_server(port, args + a.server_args.split())
+        try:
+            if m.startswith("workers"): time.sleep(1)      # các worker nối bus xong
+            res[m] = run_mode(sc, ("127.0.0.1", port), srv.pid, a.procs, secrets.token_hex(3))
+        finally:
+            srv.terminate(); srv.wait()
+        print(f"{m}: done", flush=True)
+    table(res)
+    if a.json:
+        with open(a.json, "w") as f: json.dump({"scenario": sc, "results": res}, f, indent=1)
+    if a.baseline:
+        with open(a.baseline) as f: base = json.load(f)
+        if base["scenario"] != sc: print("note: baseline was recorded with a different scenario")
+        bad = regressions(res, base["results"], a.tolerance)
+        for b in bad: print("REGRESSION", b)
+        if bad: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
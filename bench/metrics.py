@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark: chi phí của metrics.py trên đường nóng.
+
+So sánh ns mỗi lần gọi: M.inc / M.observe (shard theo thread) với bộ đếm
+dùng chung có khoá, `with TimedLock` với `with threading.Lock` (không tranh
+chấp), và một broadcast tới N hàng đợi (Outbox.put) có / không có phần đếm
+mà server.bc thêm vào. Cuối cùng chạy T thread cùng đếm. TimedLock đắt gấp
+~1.5 lần lock thường nên chỉ dùng cho lock lấy một lần mỗi thao tác (State,
+Room, Social, Sessions, bảng transfer), không dùng cho lock của Outbox (mỗi
+người nhận một lần: +30% thời gian broadcast).
+    python3 bench/metrics.py [--n 200000] [--fanout 1000] [--threads 4]
+"""
+
+import argparse, os, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from metrics import M, TimedLock, COUNTS
+from outbox import Outbox
+
+M.define("bench_total", "counter", "bench")
+M.define("bench_seconds", "histogram", "bench")
+M.define("bench_fanout", "histogram", "bench", COUNTS)
+LAB = (("room", "room1"),)
+
+def per_call(fn, n):
+    t = time.perf_counter()
+    fn(n)
+    return (time.perf_counter() - t) / n * 1e9
+
+def locked_counter(n):
+    lock, d, k = threading.Lock(), {}, ("bench_total", LAB)
+    for _ in range(n):
+        with lock: d[k] = d.get(k, 0) + 1
+
+def shard_inc(n):
+    for _ in range(n): M.inc("bench_total", 1, LAB)
+
+def shard_observe(n):
+    for i in range(n): M.observe("bench_seconds", i * 1e-7, LAB)
+
+def with_lock(lock):
+    def run(n):
+        for _ in range(n):
+            with lock: pass
+    return run
+
+def broadcast(fanout, counted):
+    boxes = [Outbox(1 << 30, 1 << 40, {}) for _ in range(fanout)]
+    data = b"[MSG #1] alice: hello everyone\n"
+    def run(n):
+        for _ in range(n):
+            t = time.perf_counter()
+            for b in boxes: b.put(data, "chat")
+            if counted:
+                M.inc("bench_total", fanout, LAB); M.inc("bench_total", fanout * len(data), LAB)
+                M.observe("bench_fanout", fanout); M.observe("bench_seconds", time.perf_counter() - t)
+        for b in boxes: b.q.clear(); b.size = 0
+    return run
+
+def threaded(fn, threads, n):
+    ts = [threading.Thread(target=fn, args=(n,)) for _ in range(threads)]
+    t = time.perf_counter()
+    for x in ts: x.start()
+    for x in ts: x.join()
+    return (time.perf_counter() - t) / (n * threads) * 1e9
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=200000, help="số lần gọi mỗi phép đo")
+    ap.add_argument("--fanout", type=int, default=1000, help="số người nhận mỗi broadcast")
+    ap.add_argument("--threads", type=int, default=4)
+    a = ap.parse_args()
+    rows = [("counter, shared + lock", per_call(locked_counter, a.n)),
+            ("M.inc (per-thread shard)", per_call(shard_inc, a.n)),
+            ("M.observe", per_call(shard_observe, a.n)),
+            ("with threading.Lock", per_call(with_lock(threading.Lock()), a.n)),
+            ("with TimedLock", per_call(with_lock(TimedLock("bench")), a.n))]
+    for name, ns in rows: print(f"{name:>28} {ns:>9.0f} ns")
+    m = max(1, a.n // a.fanout // 10)
+    runs = [(broadcast(a.fanout, False), broadcast(a.fanout, True)) for _ in range(5)]
+    plain = min(per_call(p, m) for p, _c in runs) / 1e3         # lấy lần nhanh nhất
+    counted = min(per_call(c, m) for _p, c in runs) / 1e3
+    print(f"{'broadcast to ' + str(a.fanout):>28} {plain:>9.1f} us plain, {counted:.1f} us counted "
+          f"({(counted - plain) / plain:+.1%})")
+    locked = threaded(locked_counter, a.threads, a.n // a.threads)
+    shard = threaded(shard_inc, a.threads, a.n // a.threads)
+    print(f"{str(a.threads) + ' threads counting':>28} {locked:>9.0f} ns shared+lock, {shard:.0f} ns shard")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: bão kết nối lại (server / mạng chập chờn, mọi client rớt rồi vào
+lại cùng lúc) với đồ thị bạn bè dày.
+
+Mỗi cấu hình chạy một server con: N user đăng nhập, mỗi người kết bạn với F
+người kế tiếp trên vòng tròn (/addfriend + /acceptfriend). Sau đó mọi kết nối
+đóng cùng lúc, rồi tất cả đăng nhập lại cùng lúc. Đo thời gian tới khi mọi
+user nhận "Hello" và tới khi hết luồng thông báo [Friend], số dòng / byte
+[Friend] client nhận, và giây CPU server (đọc /proc) trong cả đợt.
+--presence-ms 0 là gửi ngay từng thay đổi (không gom).
+    python3 bench/presence.py [--users 1000] [--friends 20] [--mode loop]
+                              [--presence-ms 0,250]
+"""
+
+import argparse, os, selectors, socket, subprocess, sys, time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+from loadgen import tree, usage
+
+class Swarm:
+    """N kết nối non-blocking trên một selectors; đếm dòng theo loại."""
+    def __init__(self, port):
+        self.port, self.sel = port, selectors.DefaultSelector()
+        self.socks, self.buf = {}, {}
+        self.hello = self.friend = self.fbytes = 0
+
+    def connect(self, names):
+        for n in names:
+            s = socket.create_connection(("127.0.0.1", self.port))
+            s.sendall(f"{n}\n".encode()); s.setblocking(False)
+            self.sel.register(s, selectors.EVENT_READ, n)
+            self.socks[n], self.buf[n] = s, b""
+
+    def send(self, name, line):
+        s = self.socks[name]
+        s.setblocking(True); s.sendall(f"{line}\n".encode()); s.setblocking(False)
+
+    def close_all(self):
+        for s in self.socks.values():
+            self.sel.unregister(s); s.close()
+        self.socks.clear(); self.buf.clear()
+
+    def pump(self, idle=0.5, until=None, limit=120):
+        """Đọc tới khi until() đúng và không có dữ liệu mới trong idle giây."""
+        end, last = time.monotonic() + limit, time.monotonic()
+        while time.monotonic() < end:
+            got = self.sel.select(0.05)
+            for key, _ in got:
+                try: d = key.fileobj.recv(1 << 16)
+                except (BlockingIOError, InterruptedError): continue
+                except OSError: d = b""
+                if not d: continue
+                n = key.data
+                *lines, self.buf[n] = (self.buf[n] + d).split(b"\n")
+                for l in lines:
+                    if l.startswith(b"[Friend]"): self.friend += 1; self.fbytes += len(l) + 1
+                    elif b"Hello " in l: self.hello += 1
+                    elif l.startswith(b"Username taken"):   # kết nối cũ chưa được dọn: thử lại
+                        key.fileobj.send(f"{n}\n".encode())
+                last = time.monotonic()
+            if got: continue
+            if (until is None or until()) and time.monotonic() - last >= idle: return
+        raise SystemExit("timeout waiting for server")
+
+def run(a, ms, port):
+    srv = subprocess.Popen([sys.executable, "server.py", "--port", str(port), "--mode", a.mode,
+                            "--presence-ms", str(ms), "--limit", "cmd=0"], cwd=ROOT,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try: socket.create_connection(("127.0.0.1", port)).close(); break
+            except OSError: time.sleep(0.05)
+        names = [f"u{i}" for i in range(a.users)]
+        sw = Swarm(port)
+        sw.connect(names); sw.pump(0.3, lambda: sw.hello >= a.users)
+        half = max(1, a.friends // 2)                   # mỗi cạnh một lời mời: bậc ~ F
+        for i, n in enumerate(names):
+            for k in range(1, half + 1): sw.send(n, f"/addfriend {names[(i + k) % a.users]}")
+        sw.pump(0.5)
+        for i, n in enumerate(names):
+            for k in range(1, half + 1): sw.send(n, f"/acceptfriend {names[(i - k) % a.users]}")
+        sw.pump(0.5)
+        pids = tree(srv.pid); c0 = usage(pids)[0]
+        sw.hello = sw.friend = sw.fbytes = 0
+        t0 = time.monotonic()
+        sw.close_all()
+        sw.connect(names)
+        sw.pump(0, lambda: sw.hello >= a.users)
+        t_login = time.monotonic() - t0
+        sw.pump(max(0.5, 2 * ms / 1000))
+        t_all = time.monotonic() - t0 - max(0.5, 2 * ms / 1000)
+        cpu = usage(pids)[0] - c0
+        sw.close_all()
+        return t_login, t_all, sw.friend, sw.fbytes, cpu
+    finally:
+        srv.terminate(); srv.wait()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--friends", type=int, default=20, help="số bạn mỗi user")
+    ap.add_argument("--mode", choices=("loop", "thread"), default="loop")
+    ap.add_argument("--presence-ms", default="0,250", help="các cửa sổ gom cần đo (ms)")
+    ap.add_argument("--port", type=int, default=15500)
+    a = ap.parse_args()
+    print(f"{a.users} users × {a.friends} friends, {a.mode} mode: everyone drops and reconnects at once")
+    print(f"{'window ms':>10} {'all in s':>9} {'settled s':>10} {'[Friend] lines':>15} {'KB':>8} {'server CPU s':>13}")
+    for i, ms in enumerate(float(x) for x in a.presence_ms.split(",")):
+        t_login, t_all, lines, nb, cpu = run(a, ms, a.port + i)
+        print(f"{ms:>10g} {t_login:>9.2f} {t_all:>10.2f} {lines:>15} {nb / 1024:>8.0f} {cpu:>13.2f}")
+
+if __name__ == "__main__":
+    main()
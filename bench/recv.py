@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: nhận file trong khi chat (chatcore.Client, không cần server).
+
+Một thread giả làm server đẩy qua socketpair một file (frame v2 64 KB) xen
+một dòng chat mỗi --every chunk, mỗi dòng mang thời điểm gửi. So hai cách:
+inline – ghi đĩa ngay trên thread đọc, mỗi chunk một lần write (như trước) –
+và pipeline – thread ghi riêng, gộp chunk. Đĩa chậm được giả bằng --disk-ms
+mili giây chờ mỗi lần write. In thời gian tải, độ trễ dòng chat (p50/p99/max),
+số lần write và số sự kiện progress.
+    python3 bench/recv.py [--mb 256] [--disk-ms 0,1,5] [--every 16]
+"""
+
+import argparse, os, shutil, socket, sys, tempfile, threading, time, json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chatcore
+from chatcore import Client
+from proto import pack_chunk
+
+PIECE = 64 * 1024
+
+class Pipeline(Client):
+    disk_ms, writes = 0, 0
+    def flush_file(self, tr):
+        if tr["buf"] and not tr["f"].closed:
+            self.writes += 1; time.sleep(self.disk_ms / 1000)
+        super().flush_file(tr)
+
+class Inline(Pipeline):
+    def to_disk(self, fn, args, n=0):
+        fn(*args)
+        for tr in self.dirty: self.flush_file(tr)
+        self.dirty.clear()
+
+def feed(sock, mb, every):
+    data = os.urandom(PIECE)
+    size = mb * (1 << 20)
+    sock.sendall((json.dumps({"type": "file_start", "filename": "big.bin", "size": size, "from": "bob",
+                              "xid": "x1", "tid": 7}) + "\n").encode())
+    for i, off in enumerate(range(0, size, PIECE)):
+        sock.sendall(pack_chunk(7, off, data))
+        if i % every == 0:
+            sock.sendall(f"[MSG #{i}] bob: t={time.perf_counter()}\n".encode())
+    sock.sendall((json.dumps({"type": "file_end", "filename": "big.bin", "from": "bob", "xid": "x1",
+                              "tid": 7}) + "\n").encode())
+
+def run(cls, mb, every, disk_ms, d):
+    a, b = socket.socketpair()
+    c = cls(downloads=d); c.sock, c.name, c.disk_ms = a, "me", disk_ms
+    threading.Thread(target=c.recv_loop, args=(a,), daemon=True).start()
+    t0 = time.perf_counter()
+    threading.Thread(target=feed, args=(b, mb, every), daemon=True).start()
+    lat, prog = [], 0
+    while True:
+        ev, args = c.next_event()
+        now = time.perf_counter()
+        if ev == "line": lat.append(now - float(args[0].rsplit("t=", 1)[1]))
+        elif ev == "progress": prog += 1
+        elif ev == "file_offer": c.decide(args[0], True)
+        elif ev in ("file_saved", "file_error"): break
+    dt = time.perf_counter() - t0
+    a.close(); b.close()
+    os.remove(os.path.join(d, "big.bin"))
+    lat.sort()
+    return dt, lat, c.writes, prog
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mb", type=int, default=256)
+    ap.add_argument("--disk-ms", default="0,1,5")
+    ap.add_argument("--every", type=int, default=16, help="một dòng chat mỗi chừng này chunk")
+    a = ap.parse_args()
+    d = tempfile.mkdtemp(prefix="recvbench")
+    print(f"{a.mb} MB in 64 KB frames, a chat line every {a.every} chunks "
+          f"(WQ_MAX {chatcore.WQ_MAX >> 20} MB, WBATCH {chatcore.WBATCH >> 10} KB)")
+    print(f"{'disk ms':>7} {'mode':<9} {'MB/s':>7} {'chat p50 ms':>11} {'p99':>8} {'max':>8} "
+          f"{'writes':>7} {'progress':>8}")
+    try:
+        for ms in map(float, a.disk_ms.split(",")):
+            for name, cls in (("inline", Inline), ("pipeline", Pipeline)):
+                dt, lat, w, prog = run(cls, a.mb, a.every, ms, d)
+                q = lambda p: lat[min(len(lat) - 1, int(p * len(lat)))] * 1e3
+                print(f"{ms:>7g} {name:<9} {a.mb / dt:>7.0f} {q(.5):>11.2f} {q(.99):>8.2f} "
+                      f"{lat[-1] * 1e3:>8.2f} {w:>7} {prog:>8}")
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stress test: nhiều phòng cùng bận, kiểm tra id message không trùng / không
+hổng và đo throughput khi số phòng bận tăng.
+
+Chạy một server con trên cổng riêng, mỗi phòng có W client gửi M dòng
+(xen kẽ chat thường và /reply) cùng lúc, một observer/phòng thu mọi
+[MSG #id]. Thoát với mã 1 nếu có id trùng hoặc thiếu. Cột msg/write lấy từ
+/stats: số message trung bình mỗi syscall ghi của server.
+    python3 bench/room_stress.py [--mode thread|loop] [--rooms 1,2,4,8,16]
+"""
+
+import argparse, os, re, socket, subprocess, sys, threading, time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MSG = re.compile(rb"\[MSG #(\d+)\]")
+STATS = re.compile(rb"Output: (\d+) messages in (\d+) writes")
+
+def connect(port, name):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.sendall(f"{name}\n".encode())
+    return s
+
+def io_stats(port):
+    s = connect(port, f"stats{time.monotonic_ns()}")
+    s.sendall(b"/stats\n"); s.settimeout(5)
+    buf = b""
+    while not STATS.search(buf): buf += s.recv(4096)
+    s.close()
+    return tuple(map(int, STATS.search(buf).groups()))
+
+def drain(s, stop):
+    s.settimeout(0.2)
+    while not stop.is_set():
+        try:
+            if not s.recv(1 << 16): return
+        except socket.timeout: pass
+        except OSError: return
+
+def observe(s, want, ids, done):
+    buf = b""
+    s.settimeout(30)
+    try:
+        while len(ids) < want:
+            d = s.recv(1 << 16)
+            if not d: break
+            buf += d
+            *lines, buf = buf.split(b"\n")
+            for ln in lines:
+                m = MSG.match(ln)
+                if m: ids.append(int(m.group(1)))
+    except OSError: pass
+    done.set()
+
+def run(port, nrooms, writers, msgs, tag):
+    rooms = [f"{tag}r{i}" for i in range(nrooms)]
+    adm = connect(port, f"{tag}adm")
+    for r in rooms: adm.sendall(f"/create {r}\n".encode())
+    time.sleep(0.2)
+    stop, obs, ws = threading.Event(), [], []
+    for r in rooms:
+        o = connect(port, f"{tag}o{r}"); o.sendall(f"/join {r}\n".encode())
+        ids, done = [], threading.Event()
+        obs.append((r, ids, done, o))
+        for w in range(writers):
+            s = connect(port, f"{tag}{r}w{w}"); s.sendall(f"/join {r}\n".encode())
+            threading.Thread(target=drain, args=(s, stop), daemon=True).start()
+            ws.append(s)
+    time.sleep(0.5)
+    want = writers * msgs
+    for r, ids, done, o in obs:
+        threading.Thread(target=observe, args=(o, want, ids, done), daemon=True).start()
+    payload = b"".join((f"/reply 1 hi {i}\n" if i % 4 == 3 else f"msg {i}\n").encode()
+                       for i in range(msgs))
+    t0 = time.perf_counter()
+    ths = [threading.Thread(target=s.sendall, args=(payload,)) for s in ws]
+    for t in ths: t.start()
+    for t in ths: t.join()
+    for _r, _ids, done, _o in obs: done.wait(60)
+    dt = time.perf_counter() - t0
+    stop.set()
+    ok = True
+    for r, ids, _d, _o in obs:
+        got = [i for i in ids if i > 0]
+        if len(set(got)) != len(got):
+            print(f"  {r}: DUPLICATE ids ({len(got) - len(set(got))})"); ok = False
+        if sorted(set(got)) != list(range(min(got, default=1), min(got, default=1) + want)):
+            print(f"  {r}: missing ids (got {len(set(got))}/{want})"); ok = False
+    for s in ws + [o for *_x, o in obs] + [adm]: s.close()
+    return nrooms * want / dt, ok
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mode", default="thread", choices=("thread", "loop"))
+    ap.add_argument("--rooms", default="1,2,4,8,16")
+    ap.add_argument("--writers", type=int, default=4)
+    ap.add_argument("--msgs", type=int, default=500)
+    ap.add_argument("--port", type=int, default=23456)
+    ap.add_argument("--flush-ms", default="1")
+    a = ap.parse_args()
+    srv = subprocess.Popen([sys.executable, "server.py", "--port", str(a.port), "--mode", a.mode,
+                            "--out-msgs", "1000000", "--out-kb", "1000000",
+                            "--history", "1000000", "--flush-ms", a.flush_ms,
+                            "--limit", "msg=0,cmd=0,room_msg=0"],
+                           cwd=ROOT, stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try: socket.create_connection(("127.0.0.1", a.port)).close(); break
+            except OSError: time.sleep(0.05)
+        print(f"mode={a.mode} writers/room={a.writers} msgs/writer={a.msgs} flush={a.flush_ms}ms")
+        print(f"{'busy rooms':>10} {'msgs/s':>10} {'msg/write':>10} {'ids':>6}")
+        all_ok = True
+        for i, n in enumerate(int(x) for x in a.rooms.split(",")):
+            f0, w0 = io_stats(a.port)
+            rate, ok = run(a.port, n, a.writers, a.msgs, f"t{i}")
+            f1, w1 = io_stats(a.port)
+            all_ok &= ok
+            print(f"{n:>10} {rate:>10.0f} {(f1-f0)/max(w1-w0,1):>10.1f} {'ok' if ok else 'FAIL':>6}")
+    finally:
+        srv.terminate()
+    sys.exit(0 if all_ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: /search trên lịch sử phòng khi lịch sử lớn dần.
+
+Mỗi cỡ dựng một Room với --history bằng cỡ đó (đầy, đã đẩy ra một vòng) từ
+các dòng 8 từ theo phân bố Zipf trên 50 000 từ. Đo thời gian post thêm do chỉ
+mục (so với Room không chỉ mục), rồi độ trễ một trang (20 kết quả) cho: từ hiếm, từ phổ biến, hai từ
+(AND), lọc người gửi, trang sâu (nửa lịch sử) – so với quét tuyến tính.
+    python3 bench/search.py [--sizes 10000,100000,1000000,2000000] [--queries 200]
+"""
+
+import argparse, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from state import Room
+from search import terms
+
+VOCAB = 50_000
+USERS = [f"u{i}" for i in range(50)]
+
+def corpus(n, rnd):
+    words = [f"w{i}" for i in range(VOCAB)]
+    weights = [1 / (i + 1) for i in range(VOCAB)]
+    flat = rnd.choices(words, weights, k=8 * n)
+    return [" ".join(flat[i:i + 8]) for i in range(0, 8 * n, 8)]
+
+class NoIndex:
+    def add(self, mid, line): pass
+    def evict(self, mid, line): pass
+
+def fill(r, lines):
+    t = time.perf_counter()
+    for i, txt in enumerate(lines):
+        u = USERS[i % len(USERS)]
+        r.post(u, lambda mid: f"[MSG #{mid}] {u}: {txt}")
+    return (time.perf_counter() - t) / len(lines) * 1e6
+
+def scan(h, q, sender, n=20):
+    # cách không có chỉ mục: đi ngược toàn bộ ring
+    ws, out = terms(q), []
+    for e in reversed(list(h)):
+        if ws <= terms(e[2]) and (sender is None or e[1] == sender):
+            out.append(e)
+            if len(out) == n: break
+    return out
+
+def timed(fn, k):
+    t = time.perf_counter()
+    for _ in range(k): fn()
+    return (time.perf_counter() - t) / k * 1e3
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="10000,100000,1000000,2000000")
+    ap.add_argument("--queries", type=int, default=200)
+    a = ap.parse_args()
+    rnd = random.Random(7)
+    print(f"{'history':>9} {'post µs':>8} {'(no idx)':>9} {'rare ms':>8} {'common':>7} {'AND':>7} "
+          f"{'sender':>7} {'deep':>7} {'scan rare ms':>13}")
+    for size in map(int, a.sizes.split(",")):
+        lines = corpus(size + size // 4, rnd)
+        plain = Room("bench", size); plain.index = NoIndex()
+        bare = fill(plain, lines); del plain
+        r = Room("bench", size)
+        post = fill(r, lines)
+        mid = r.next_id - size // 2
+        qs = {"rare": ("w20000", None, None), "common": ("w3", None, None),
+              "AND": ("w3 w40", None, None), "sender": ("w3", "u7", None), "deep": ("w3", None, mid)}
+        ms = {k: timed(lambda q=q: r.search(*q), a.queries) for k, q in qs.items()}
+        k = max(1, a.queries * 2000 // size)
+        sc = timed(lambda: scan(r.history, "w20000", None), min(k, 20))
+        print(f"{size:>9} {post:>8.2f} {bare:>9.2f} {ms['rare']:>8.3f} {ms['common']:>7.3f} {ms['AND']:>7.3f} "
+              f"{ms['sender']:>7.3f} {ms['deep']:>7.3f} {sc:>13.1f}")
+        del r, lines
+
+if __name__ == "__main__":
+    main()
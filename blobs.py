@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kho file phía server, đánh địa chỉ theo nội dung (SHA-256).
+
+Mỗi nội dung chỉ được lưu một lần: <root>/<2 ký tự đầu>/<sha256>. Upload ghi
+vào <root>/tmp theo offset (sender có thể gửi tiếp sau khi rớt mạng), hash
+được tính dần khi chunk tới theo thứ tự; tới cuối mới so với sha256 sender
+khai báo rồi đổi tên vào kho – nội dung đã có thì chỉ bỏ bản tạm. Giới hạn:
+thời gian giữ kể từ lần dùng cuối (mtime, /fetch cập nhật) và tổng dung lượng
+(xoá file lâu không dùng nhất trước). Việc quét thư mục chạy ở thread dọn
+riêng, mỗi SWEEP giây hoặc ngay khi commit() đẩy tổng đã đếm quá max_bytes –
+không bao giờ trên thread gọi commit() (event loop). Các worker (--workers)
+dùng chung thư mục, nên mỗi lần dọn đếm lại dung lượng từ đĩa.
+"""
+
+import hashlib, os, re, threading, time
+
+SHA = re.compile(r"[0-9a-f]{64}")
+TMP_TTL = 3600                                  # giây: bản tạm bỏ dở (server chết giữa upload)
+SWEEP = 60                                      # giây giữa hai lần dọn theo hạn
+LOW = 0.9                                       # dọn quá dung lượng thì xuống còn chừng này * max_bytes
+
+class Blobs:
+    def __init__(self, root, max_bytes, ttl):
+        self.root, self.max_bytes, self.ttl = root, max_bytes, ttl
+        self.lock = threading.Lock()
+        self.total, self.wake = 0, threading.Event()  # byte trong kho (đếm lại mỗi lần dọn)
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+        self.prune()
+        threading.Thread(target=self._sweeper, daemon=True).start()
+
+    def path(self, sha):
+        return os.path.join(self.root, sha[:2], sha)
+
+    def find(self, key):
+        """Đường dẫn blob theo sha256 hoặc phần đầu của nó (>= 16 ký tự hex);
+        None nếu không có. Đánh dấu vừa dùng để được giữ lâu hơn."""
+        if not re.fullmatch(r"[0-9a-f]{16,64}", key): return None
+        d = os.path.join(self.root, key[:2])
+        try: name = next(n for n in os.listdir(d) if n.startswith(key))
+        except (OSError, StopIteration): return None
+        p = os.path.join(d, name)
+        try: os.utime(p)
+        except OSError: return None             # vừa bị dọn
+        return p
+
+    def upload(self, sha, size, tag):
+        """Bản tạm cho một upload; tag phân biệt các upload song song cùng nội dung."""
+        return Upload(sha, size, os.path.join(self.root, "tmp", f"{tag}.part"))
+
+    def commit(self, up):
+        """Đưa bản tạm vào kho nếu đúng hash đã khai; True nếu file hợp lệ."""
+        ok = up.digest() == up.sha
+        if not ok: up.abort(); return False
+        dst = self.path(up.sha)
+        with self.lock:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.exists(dst): up.abort(); os.utime(dst)
+            else:
+                os.replace(up.tmp, dst); self.total += up.size
+                if self.total > self.max_bytes: self.wake.set()
+        return True
+
+    def _sweeper(self):
+        while True:
+            self.wake.wait(SWEEP); self.wake.clear()
+            try: self.prune()
+            except OSError: pass
+
+    def _files(self):
+        for d in os.listdir(self.root):
+            if len(d) != 2: continue
+            with os.scandir(os.path.join(self.root, d)) as it:
+                for e in it:
+                    try: s = e.stat()
+                    except OSError: continue
+                    yield e.path, s.st_mtime, s.st_size
+
+    def prune(self):
+        """Xoá blob quá hạn, rồi (nếu tổng > max_bytes) blob ít dùng nhất tới khi
+        còn LOW * max_bytes. File đang được gửi vẫn đọc được tới hết (fd đã mở)."""
+        files = sorted(self._files(), key=lambda f: f[1])   # quét đĩa ngoài lock: commit() không chờ
+        total, now = sum(f[2] for f in files), time.time()
+        cap = self.max_bytes * LOW if total > self.max_bytes else self.max_bytes
+        with self.lock:
+            for p, t, n in files:
+                if t >= now - self.ttl and total <= cap: break
+                try:
+                    if os.stat(p).st_mtime > t: continue    # vừa được dùng (find / commit) sau lúc quét
+                    os.remove(p); total -= n
+                except OSError: pass
+            self.total = total
+        with os.scandir(os.path.join(self.root, "tmp")) as it:
+            for e in it:
+                try:
+                    if e.stat().st_mtime < now - TMP_TTL: os.remove(e.path)
+                except OSError: pass
+
+
+class Upload:
+    __slots__ = ("sha", "size", "tmp", "f", "h", "pos")
+    def __init__(self, sha, size, tmp):
+        self.sha, self.size, self.tmp = sha, size, tmp
+        self.f = open(tmp, "w+b")
+        self.h, self.pos = hashlib.sha256(), 0  # hash phần liên tục [0, pos) đã ghi
+
+    def __getstate__(self):
+        # server.py --handoff: file tạm đi theo (fd), hash tính lại lúc commit
+        self.f.flush()
+        return self.sha, self.size, self.tmp, self.f
+
+    def __setstate__(self, st):
+        self.sha, self.size, self.tmp, self.f = st
+        self.h, self.pos = None, 0
+
+    def write(self, off, data):
+        if off < 0 or off + len(data) > self.size: return
+        self.f.seek(off); self.f.write(data)
+        if self.h is not None and off == self.pos:
+            self.h.update(data); self.pos += len(data)
+        elif off < self.pos:
+            self.h = None                       # ghi đè phần đã hash: tính lại lúc cuối
+
+    def digest(self):
+        if self.h is None or self.pos != self.size:
+            self.h = hashlib.sha256(); self.f.seek(0)
+            for b in iter(lambda: self.f.read(1 << 20), b""): self.h.update(b)
+        self.f.close()
+        return self.h.hexdigest()
+
+    def abort(self):
+        if not self.f.closed: self.f.close()
+        try: os.remove(self.tmp)
+        except OSError: pass
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bus nội bộ cho chế độ nhiều worker (server.py --workers N).
+
+Process cha chạy Hub: mỗi worker nối tới nó qua một Unix domain socket.
+Mọi thay đổi trạng thái dùng chung (phòng, lịch sử, pin, bạn bè, ai đang
+online ở đâu, broadcast/PM/file tới người ở worker khác) được worker gửi
+lên hub dưới dạng op; hub không hiểu op, chỉ xếp chúng thành MỘT thứ tự
+rồi phát lại cho mọi worker (kể cả worker gửi). Mỗi worker áp dụng cùng
+dãy op theo cùng thứ tự -> id message, số pin… giống hệt nhau ở mọi nơi.
+
+Frame: header HEAD (độ dài phần pickle, worker id, seq, cờ) + pickle((op, args)).
+"""
+
+import os, pickle, selectors, socket, struct
+
+HEAD = struct.Struct("!IHIB")                   # len, wid, seq, flags
+OTHERS = 1                                      # cờ: không gửi lại cho worker gốc
+HUB = 0xFFFF                                    # wid của op do chính hub tạo ra
+
+def pack(wid, seq, op, args, flags=0):
+    body = pickle.dumps((op, args), pickle.HIGHEST_PROTOCOL)
+    return HEAD.pack(len(body), wid, seq, flags) + body
+
+def frames(buf):
+    """Tách các frame đủ từ bytearray buf (xoá phần đã tách)."""
+    pos, out = 0, []
+    while len(buf) - pos >= HEAD.size:
+        n, wid, seq, flags = HEAD.unpack_from(buf, pos)
+        end = pos + HEAD.size + n
+        if len(buf) < end: break
+        out.append((wid, seq, flags, bytes(buf[pos:end])))
+        pos = end
+    del buf[:pos]
+    return out
+
+
+class Hub:
+    """Bộ sắp thứ tự: nhận frame từ worker, phát lại nguyên vẹn cho mọi worker."""
+    def __init__(self, path, n):
+        self.path, self.n = path, n
+        self.srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.srv.bind(path); self.srv.listen(n)
+        self.peers = {}                         # wid -> Peer
+
+    def start(self):
+        """Chờ đủ n worker rồi mới cho chạy, để không worker nào lỡ op đầu tiên."""
+        while len(self.peers) < self.n:
+            s, _ = self.srv.accept()
+            wid = int.from_bytes(s.recv(2), "big")
+            self.peers[wid] = Peer(wid, s)
+        for p in self.peers.values(): p.sock.sendall(b"\1")
+
+    def serve(self):
+        self.sel = selectors.DefaultSelector()
+        for p in self.peers.values():
+            p.sock.setblocking(False); self.sel.register(p.sock, selectors.EVENT_READ, p)
+        while self.peers:
+            for key, ev in self.sel.select():
+                p = key.data
+                if ev & selectors.EVENT_READ: self.read(p)
+                if ev & selectors.EVENT_WRITE and p.wid in self.peers: self.flush(p)
+
+    def read(self, p):
+        try: d = p.sock.recv(1 << 20)
+        except BlockingIOError: return
+        except OSError: d = b""
+        if not d:                               # worker chết: báo cho các worker còn lại
+            self.sel.unregister(p.sock); p.sock.close(); del self.peers[p.wid]
+            self.fanout(None, pack(HUB, 0, "down", (p.wid,)))
+            return
+        p.inbuf += d
+        for src, _seq, flags, fr in frames(p.inbuf):
+            self.fanout(src if flags & OTHERS else None, fr)
+
+    def fanout(self, skip, fr):
+        for q in list(self.peers.values()):
+            if q.wid == skip: continue
+            if not q.outbuf:                    # thường gửi được ngay, khỏi đệm
+                try: n = q.sock.send(fr)
+                except BlockingIOError: n = 0
+                except OSError: continue
+                if n == len(fr): continue
+                q.outbuf += fr[n:]
+                self.sel.modify(q.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, q)
+            else:
+                q.outbuf += fr
+
+    def flush(self, p):
+        try: n = p.sock.send(p.outbuf)
+        except BlockingIOError: return
+        except OSError: return
+        del p.outbuf[:n]
+        if not p.outbuf: self.sel.modify(p.sock, selectors.EVENT_READ, p)
+
+    def close(self):
+        for p in self.peers.values(): p.sock.close()
+        self.srv.close()
+        try: os.unlink(self.path)
+        except OSError: pass
+
+class Peer:
+    __slots__ = ("wid", "sock", "inbuf", "outbuf")
+    def __init__(self, wid, sock):
+        self.wid, self.sock, self.inbuf, self.outbuf = wid, sock, bytearray(), bytearray()
+
+
+class Bus:
+    """Phía worker. apply(op, args) áp dụng một op; send() gửi op lên hub."""
+    def __init__(self, path, wid, apply):
+        self.wid, self.apply, self.seq = wid, apply, 0
+        self.last = self.acked = 0                  # op cuối cần quay về / đã quay về
+        self.want, self.res = 0, None               # op send(wait=True) đang chờ, kết quả
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.sock.sendall(wid.to_bytes(2, "big"))
+        self.sock.recv(1)                       # hub: đủ worker, bắt đầu
+        self.buf = bytearray()
+
+    def send(self, op, args, wait=False, others=False):
+        """Gửi op; wait=True: đọc bus (áp dụng các op tới trước) cho tới khi chính
+        op này quay về và trả về kết quả apply của nó."""
+        self.seq += 1
+        self.sock.sendall(pack(self.wid, self.seq, op, args, OTHERS if others else 0))
+        if others: return None                  # không quay về worker này
+        self.last = self.seq
+        if not wait: return None
+        self.want = self.seq
+        self.settle()
+        return self.res
+
+    def settle(self):
+        """Chờ mọi op mình đã gửi quay về và được áp dụng, để lệnh tiếp theo của
+        cùng client đọc được chính thay đổi của nó (chế độ 1 process có sẵn)."""
+        while self.acked < self.last:
+            d = self.sock.recv(1 << 20)
+            if not d: raise SystemExit("bus closed")
+            self.buf += d
+            self.run()
+
+    def pump(self):
+        """Có dữ liệu trên bus (event loop báo): áp dụng mọi op đã đủ."""
+        try: d = self.sock.recv(1 << 20, socket.MSG_DONTWAIT)
+        except BlockingIOError: return          # settle() đã đọc hết trước đó
+        if not d: raise SystemExit("bus closed")
+        self.buf += d
+        self.run()
+
+    def run(self):
+        for wid, seq, _flags, fr in frames(self.buf):
+            op, args = pickle.loads(memoryview(fr)[HEAD.size:])
+            r = self.apply(op, args)
+            if wid != self.wid: continue
+            self.acked = seq
+            if seq == self.want: self.res = r
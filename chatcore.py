@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lõi mạng của client, không phụ thuộc Tk / input(): kết nối, login (caps,
+resume + tự kết nối lại, heartbeat cap "ping"), scheduler gửi, nhận và ghép file, upload có credit /
+resume / gửi bù. client.py chỉ là giao diện dòng lệnh + pop-up trên lớp này;
+bot và test dùng thẳng Client.
+
+Thread đọc socket chỉ giải mã, cập nhật trạng thái rồi xếp sự kiện vào inbox
+(hàng đợi không giới hạn) – nó không bao giờ chờ người dùng, nên chunk file và
+chat vẫn được đọc khi một hộp thoại đang mở. Sự kiện được giao cho các handler
+đăng ký bằng on() trên thread dispatcher riêng (start(dispatch=True)), hoặc lấy
+trực tiếp bằng next_event(). Dữ liệu file không được giải mã / ghi trên thread
+đọc: mọi gói file_* được xếp theo thứ tự vào hàng đợi đĩa (giới hạn WQ_MAX byte;
+đầy thì thread đọc chờ, TCP hãm bên gửi) cho thread ghi riêng, thread này gộp các
+chunk liền nhau thành lần write tối đa WBATCH byte vào file tạm đã cấp sẵn đủ cỡ
+trong thư mục downloads. Quyết định giữ / mở / bỏ qua (decide()) đến lúc nào
+cũng được, file chỉ được đổi tên thành bản lưu khi đã nhận đủ và đã có quyết định.
+
+Sự kiện – tên(tham số):
+  line(text)                    dòng chat / thông báo của server
+  pm(pk)  invite(pk)  friendreq(pk)
+  file_offer(key, info)         file mới (info: filename, size, from) -> decide(key, …)
+  progress(kind, fn, pct)       kind "send" | "recv"; tối đa 1 lần mỗi PROGRESS giây
+                                (mọi transfer cộng lại), luôn có lần 100%
+  file_retry(fn, missing)       thiếu / hỏng `missing` byte, đã xin gửi lại
+  file_saved(fn, path, view)    nhận đủ, người dùng chọn giữ (view: mở file)
+  file_skipped(fn, path)        nhận đủ, người dùng bỏ qua (save() để giữ sau)
+  file_error(fn, text)          hỏng sau các lần xin lại
+  sent(fn)                      upload xong
+  send_failed(fn, why)          upload hỏng (why "" nếu mất kết nối) hoặc bị server từ chối
+  status(text)                  mất kết nối, đang kết nối lại
+  closed()                      đã thôi kết nối lại
+"""
+
+import socket, threading, select, json, base64, os, re, tempfile, itertools, time, traceback
+import hashlib, secrets, bisect, zlib
+from collections import deque
+from proto import Decoder, FrameError, CAPS, Deflater, ZMIN, packable, pack_frame, pack_chunk, need_ranges
+
+HOST, PORT = '127.0.0.1', 12345
+CHUNK = 4096                           # chunk file nhỏ nhất (byte)
+CHUNK_MAX = 256*1024                   # chunk lớn nhất khi đường truyền nhanh
+SLICE = 0.02                           # giây mỗi lần ghi chunk: dòng chat chờ tối đa chừng này
+WINDOW = 1<<20                         # credit mỗi upload "xfer": byte gửi trước ack của server
+ZLEVEL = 1                             # mức nén khi server nhận cap "zlib"
+RETRIES = 10                           # số lần thử kết nối lại khi rớt mạng
+REFILL = 3                             # số lần xin lại đoạn file thiếu/hỏng (và gửi bù mỗi người nhận)
+NEED_TTL = 300                         # giây sau khi gửi xong còn nhận file_need (= --resume-ttl của server)
+WQ_MAX = 8<<20                         # byte file chờ ghi đĩa tối đa
+WBATCH = 1<<20                         # các chunk liền nhau gộp thành một lần write tới chừng này
+PROGRESS = 0.25                        # giây giữa hai sự kiện progress
+MSG_ID=re.compile(r"\[(?:MSG|FILE) #(\d+)\]")
+PIN_EV=re.compile(r"\[[\d:]+\] \*\*\S+ (?:un)?pinned ")
+
+class Rejected(Exception):
+    """Server từ chối upload (file_reject: giới hạn tốc độ, quá nhiều transfer)."""
+
+def add_range(have,a,b):
+    # have: các đoạn [đầu, cuối) đã nhận, không chồng nhau, tăng dần
+    i=bisect.bisect_left(have,[a])
+    if i and have[i-1][1]>=a: i-=1; a=have[i][0]
+    j=i
+    while j<len(have) and have[j][0]<=b: b=max(b,have[j][1]); j+=1
+    have[i:j]=[[a,b]]
+
+def missing(tr):
+    gaps, pos = [], 0
+    for a,b in tr["have"]:
+        if a>pos: gaps.append([pos,a-pos])
+        pos=b
+    if pos<tr["size"]: gaps.append([pos,tr["size"]-pos])
+    return gaps
+
+def file_hash(f):
+    h=hashlib.sha256(); f.seek(0)
+    for b in iter(lambda: f.read(1<<20), b""): h.update(b)
+    return h.hexdigest()
+
+class Client:
+    def __init__(self, host=HOST, port=PORT, downloads="downloads"):
+        self.host, self.port, self.downloads = host, port, downloads
+        self.name, self.room = "", None         # room: để tự /join lại sau khi kết nối lại
+        self.sock, self.quitting = None, False  # socket hiện tại (đổi khi kết nối lại)
+        self.rejoin = False                     # welcome kế tiếp là của một lần kết nối lại
+        self.token, self.server_caps = None, set()  # token phiên (cap "resume"), cap server nhận
+        self.beat, self.dead = None, None       # cap "ping": giây im lặng trước khi ping / coi server đã chết
+        self.seen, self.sync_room = {}, None    # room -> [id cuối đã thấy, pin_rev]; phòng của các dòng đang tới
+        self.transfers, self.rtids = {}, {}     # xid (hoặc tên file) -> trạng thái nhận; tid relay -> khoá
+        self.done, self.skipped = {}, {}        # nhận xong chờ decide(); tên -> file tạm đã bỏ qua
+        self.flock = threading.Lock()           # transfers <-> done (thread ghi đĩa và decide())
+        self.uploads, self.acks = {}, {}        # xid -> upload có thể gửi bù; xid -> [offset đã relay, Event]
+        self.rejected = {}                      # tid -> lý do server từ chối upload
+        self.tid_seq = itertools.count(1)
+        self.ctlq, self.ups = deque(), []       # (sock, bytes) chờ gửi / các upload đang chạy
+        self.cv = threading.Condition()         # của scheduler
+        self.rate = CHUNK/SLICE                 # byte/giây, trung bình trượt
+        self.zout = {}                          # sock -> Deflater (cap "zlib"), chỉ thread scheduler dùng
+        self.sched_on = False
+        self.wq, self.wbytes, self.wcv = deque(), 0, threading.Condition()   # hàng đợi đĩa
+        self.disk_on, self.prog_t = False, 0.0
+        self.dirty = []                         # transfer có chunk gộp chưa ghi (chỉ thread ghi dùng)
+        self.inbox, self.icv, self.handlers = deque(), threading.Condition(), {}
+
+    # ───── sự kiện ─────
+    def on(self, ev, fn):
+        """Đăng ký handler cho sự kiện ev; chạy trên thread dispatcher."""
+        self.handlers.setdefault(ev, []).append(fn)
+        return fn
+
+    def emit(self, ev, *args):
+        with self.icv:
+            self.inbox.append((ev, args)); self.icv.notify()
+
+    def next_event(self, timeout=None):
+        """(tên, tham số) kế tiếp trong inbox; None nếu quá timeout."""
+        with self.icv:
+            if not self.icv.wait_for(lambda: self.inbox, timeout): return None
+            return self.inbox.popleft()
+
+    def dispatch(self):
+        while True:
+            ev, args = self.next_event()
+            for fn in self.handlers.get(ev, ()):
+                try: fn(*args)
+                except Exception: traceback.print_exc()
+
+    # ───── kết nối ─────
+    def connect(self):
+        """Mở kết nối; trả về lời chào của server ("Enter username:")."""
+        self.sock = socket.create_connection((self.host, self.port))
+        return self.sock.recv(1024).decode(errors="replace")
+
+    def start(self, name, dispatch=True):
+        """Login với tên name rồi chạy thread đọc (+ dispatcher nếu dispatch)."""
+        self.name = name
+        self.login(self.sock)
+        threading.Thread(target=self.recv_thread, daemon=True).start()
+        if dispatch: threading.Thread(target=self.dispatch, daemon=True).start()
+
+    def close(self):
+        self.flush(); self.sock.close()
+
+    def login(self, sock):
+        pk={"type":"login","name":self.name,"caps":sorted(CAPS)}
+        if self.token: pk["token"]=self.token
+        if self.seen: pk["seen"]=self.seen
+        self.send_json(sock,pk)
+
+    def reconnect(self):
+        # rớt mạng: kết nối lại, trình token + id đã thấy -> server chỉ gửi phần thiếu
+        self.emit("status", "Disconnected – reconnecting…")
+        self.rejoin=True
+        for i in range(RETRIES):
+            time.sleep(min(2**i,30))
+            try: sock=socket.create_connection((self.host,self.port),timeout=5)
+            except OSError: continue
+            try:
+                sock.settimeout(None); sock.recv(1024)      # "Enter username:"
+                self.login(sock)
+            except OSError: sock.close(); continue
+            self.sock=sock; return True
+        return False
+
+    def on_welcome(self, pk):
+        self.server_caps.update(pk.get("caps",()))
+        self.token=pk.get("token",self.token)
+        self.beat,self.dead=pk.get("ping"),pk.get("dead")
+        self.zout.clear()                     # kết nối mới: luồng nén mới
+        if "zlib" in pk.get("caps",()): self.zout[self.sock]=Deflater(ZLEVEL)
+        room,rejoin,self.rejoin=self.room,self.rejoin,False
+        if rejoin and room and pk.get("room")!=room:   # server không còn giữ phiên: tự /join, chỉ lấy phần thiếu
+            self.post(self.sock," ".join(["/join",room]+[str(x) for x in self.seen.get(room,())]).encode()+b"\n")
+
+    def on_sync(self, pk):
+        self.sync_room=pk["room"]; self.seen[pk["room"]]=[pk["last"],pk["pins"]]
+
+    def track(self, line):
+        # cập nhật id cuối đã thấy (và pin_rev) của phòng hiện tại từ các dòng chat
+        s=self.seen.get(self.sync_room)
+        if not s: return
+        m=MSG_ID.match(line)
+        if m: s[0]=max(s[0],int(m.group(1)))
+        elif PIN_EV.match(line): s[1]+=1
+
+    # ───── gửi: lệnh / chat / PM ─────
+    def send_json(self, s, o): self.post(s,(json.dumps(o)+"\n").encode())
+
+    def send_line(self, text):
+        """Dòng chat hoặc lệnh. Ghi nhớ phòng hiện tại (/join, /leave)."""
+        parts=text.split()
+        if parts[:1]==["/quit"]: self.quitting=True
+        self.post(self.sock,(text+"\n").encode())
+        if parts[:1]==["/join"] and len(parts)>1: self.room=parts[1]
+        if parts[:1]==["/leave"]: self.room=None
+
+    def send_pm(self, to, text):
+        self.send_json(self.sock,{"type":"msg","to":list(to),"text":text,"from":self.name})
+
+    def upload_report(self):
+        d=self.zout.get(self.sock)
+        return d.report() if d else None
+
+    # ───── send scheduler ─────
+    # Một thread duy nhất ghi ra socket. Dòng chat / lệnh / gói JSON (ctl) luôn đi
+    # trước; các upload đang chạy xen kẽ mỗi lượt một chunk (round-robin), nên
+    # không frame nào bị cắt ngang và gõ chat vẫn nhanh khi đang gửi file lớn.
+    # Upload "xfer" chỉ được gửi khi còn credit: tối đa WINDOW byte chưa được
+    # server ack (file_ack). Cỡ chunk theo thông lượng đo được (~SLICE giây/lần ghi).
+    def kick(self):
+        # gọi khi đang giữ self.cv
+        self.cv.notify()
+        if not self.sched_on:
+            self.sched_on=True; threading.Thread(target=self.sched,daemon=True).start()
+
+    def post(self, sock, data):
+        with self.cv: self.ctlq.append((sock,data)); self.kick()
+
+    def flush(self, secs=2):
+        """Chờ các dòng ctl đã xếp được ghi xong (trước khi đóng socket)."""
+        ev=threading.Event(); self.post(None,ev); ev.wait(secs)
+
+    def credit(self, up):
+        if not up["ranges"]: return False
+        a=self.acks.get(up["xid"]) if up["xid"] else None
+        return not a or up["ranges"][0][0]-(a[0] or 0) < WINDOW
+
+    def chunk_size(self):
+        n=int(self.rate*SLICE)
+        return min(CHUNK_MAX, max(CHUNK, 1<<(n.bit_length()-1) if n else CHUNK))
+
+    def sched(self):
+        turn=0
+        while True:
+            with self.cv:
+                self.cv.wait_for(lambda: self.ctlq or any(self.credit(u) for u in self.ups))
+                item=self.ctlq.popleft() if self.ctlq else None
+                if item is None:
+                    ready=[u for u in self.ups if self.credit(u)]
+                    up=ready[turn%len(ready)]; turn+=1
+            if item is None: self.send_chunk(up); continue
+            if item[0] is None: item[1].set(); continue  # flush()
+            try: item[0].sendall(self.wire(item[0],item[1]))
+            except OSError: pass                         # thread đọc lo kết nối lại
+
+    def wire(self, sock, data, z=True):
+        # nén nếu kết nối có cap "zlib", message đủ dài và (file) nội dung nén được
+        d=self.zout.get(sock)
+        return d.pack(data) if d and z and len(data)>=ZMIN else data
+
+    def send_chunk(self, up):
+        off,end=up["ranges"][0]; fn,sz,tid=up["fn"],up["sz"],up["tid"]
+        up["fp"].seek(off); chunk=up["fp"].read(min(self.chunk_size(),end-off))
+        if tid: data=pack_chunk(tid,off,chunk) if "xfer" in self.server_caps else pack_frame(tid,up["seq"],chunk)
+        else: data=(json.dumps({"type":"file_chunk","filename":fn,"from":self.name,
+                                "data":base64.b64encode(chunk).decode()})+"\n").encode()
+        t=time.monotonic()
+        try: up["sock"].sendall(self.wire(up["sock"],data,up["z"]))
+        except OSError as e: self.finish(up,e); return
+        self.rate=0.8*self.rate+0.2*len(data)/max(time.monotonic()-t,1e-4)
+        off+=len(chunk); up["seq"]+=1
+        self.progress(up,"send",fn,off/sz*100 if sz else 100.0)
+        if off<end and chunk: up["ranges"][0][0]=off; return
+        with self.cv: up["ranges"].pop(0)
+        if not up["ranges"]: self.finish(up)
+
+    def finish(self, up, err=None):
+        with self.cv:
+            if up in self.ups: self.ups.remove(up)
+        up["err"]=err; up["done"].set()
+
+    def progress(self, st, kind, fn, pct):
+        if int(pct)==st["pct"]: return
+        st["pct"]=int(pct); now=time.monotonic()
+        if pct<100 and now-self.prog_t<PROGRESS: return
+        self.prog_t=now; self.emit("progress",kind,fn,pct)
+
+    # ───── nhận ─────
+    def recv_thread(self):
+        while self.recv_loop(self.sock) and not self.quitting:
+            if not self.reconnect(): break
+        self.emit("closed")
+
+    def recv_loop(self, sock):
+        """Đọc tới khi mất kết nối; True nếu nên thử kết nối lại."""
+        dec=Decoder(raw=True); seen=time.monotonic()
+        while True:
+            try:
+                if self.beat and not select.select([sock],[],[],self.beat)[0]:
+                    if self.dead and time.monotonic()-seen>=self.dead:
+                        sock.close(); return True           # half-open: server không còn trả lời
+                    self.send_json(sock,{"type":"ping"}); continue
+                d=sock.recv(65536); seen=time.monotonic()
+                if not d: return True
+                for fr in dec.feed(d):
+                    if fr[0]=="bin": self.to_disk(self.file_data,fr[1:],len(fr[3])); continue
+                    if fr[0]=="raw": self.to_disk(self.file_data,(fr[1],None,fr[2]),len(fr[2])); continue   # file trong kho server
+                    line=fr[1]
+                    if not line: continue
+                    try:
+                        pk=json.loads(line); t=pk.get("type")
+                        if t=="file_start": self.to_disk(self.file_start,(pk,))
+                        elif t=="file_chunk": self.to_disk(self.file_chunk,(pk,),len(pk["data"]))
+                        elif t=="file_end": self.to_disk(self.file_end,(pk,))
+                        elif t in ("invite","friendreq"): self.emit(t,pk)
+                        elif t=="msg": self.emit("pm",pk)
+                        elif t=="welcome": self.on_welcome(pk)
+                        elif t=="ping": self.send_json(sock,{"type":"pong"})
+                        elif t=="sync": self.on_sync(pk)
+                        elif t in ("file_ack","file_resume"): self.on_ack(pk)
+                        elif t=="file_reject": self.on_reject(pk)
+                        elif t=="file_need": self.file_need(pk)
+                    except json.JSONDecodeError:
+                        self.track(line); self.emit("line",line)
+            except (OSError, FrameError): return True
+            except: return False
+
+    def to_disk(self, fn, args, n=0):
+        """Xếp fn(*args) cho thread ghi đĩa, giữ thứ tự; chờ khi hàng đợi đã đầy."""
+        with self.wcv:
+            self.wcv.wait_for(lambda: self.wbytes<WQ_MAX)
+            self.wq.append((fn,args,n)); self.wbytes+=n; self.wcv.notify_all()
+            if self.disk_on: return
+            self.disk_on=True
+        threading.Thread(target=self.disk,daemon=True).start()
+
+    def disk(self):
+        while True:
+            with self.wcv:
+                self.wcv.wait_for(lambda: self.wq)
+                batch=list(self.wq); self.wq.clear()
+            for fn,args,_n in batch:
+                try: fn(*args)
+                except Exception: traceback.print_exc()
+            for tr in self.dirty: self.flush_file(tr)
+            self.dirty.clear()
+            with self.wcv:
+                self.wbytes-=sum(n for _f,_a,n in batch); self.wcv.notify_all()
+
+    def file_start(self, pk):
+        fn, sz, sender = pk["filename"], pk["size"], pk["from"]
+        key=pk.get("xid") or fn
+        tr=self.transfers.get(key)
+        if tr or pk.get("fill"):              # gửi tiếp / gửi bù cho transfer đang nhận
+            if tr and "tid" in pk: self.rtids[pk["tid"]]=key
+            return
+        os.makedirs(self.downloads,exist_ok=True)
+        # ghi ngay vào file tạm cạnh bản lưu: giữ lại chỉ là đổi tên, bỏ qua thì /save sau
+        f=tempfile.NamedTemporaryFile(dir=self.downloads,prefix=".",suffix=".part",delete=False)
+        try: os.posix_fallocate(f.fileno(),0,sz)   # cấp sẵn: ghi sau không phải nới file
+        except (AttributeError,OSError,ValueError): f.truncate(sz)
+        name=fn
+        if pk.get("xid") and any(t["fn"]==fn for t in self.transfers.values()):
+            name=f"{pk['xid'][:6]}-{fn}"      # cùng tên, đang nhận song song
+        with self.flock:
+            self.transfers[key]={"fn":fn,"name":name,"f":f,"got":0,"size":sz,"keep":None,"view":False,
+                                 "path":f.name,"xid":pk.get("xid"),"sha":pk.get("sha256"),"from":sender,
+                                 "have":[],"tries":0,"stored":pk.get("stored"),"pct":-1,
+                                 "buf":[],"boff":0,"blen":0}
+        if "tid" in pk: self.rtids[pk["tid"]]=key
+        self.emit("file_offer",key,{"filename":fn,"size":sz,"from":sender})
+
+    def decide(self, key, keep, view=False):
+        """Trả lời file_offer: keep = lưu vào downloads/, view = mở sau khi lưu.
+        Gọi trước hay sau khi file nhận xong đều được."""
+        with self.flock:
+            tr=self.transfers.get(key) or self.done.pop(key,None)
+            if not tr: return
+            tr["keep"], tr["view"] = keep, view
+            ready=key not in self.transfers
+        if ready: self.place(tr)
+
+    def place(self, tr):
+        if not tr["keep"]:
+            self.skipped[tr["fn"]]=tr["path"]; self.emit("file_skipped",tr["fn"],tr["path"]); return
+        p=os.path.join(self.downloads,tr["name"])
+        os.replace(tr["path"],p)
+        self.emit("file_saved",tr["fn"],p,tr["view"])
+
+    def save(self, fn):
+        """Giữ một file đã bỏ qua; trả về đường dẫn mới hoặc None."""
+        src=self.skipped.pop(fn,None)
+        if not src or not os.path.exists(src): return None
+        p=os.path.join(self.downloads,fn)
+        os.replace(src,p)
+        return p
+
+    def file_chunk(self, pk):
+        tr=self.transfers.get(pk.get("xid") or pk["filename"])
+        if tr: self.write_chunk(tr,base64.b64decode(pk["data"]))
+
+    def file_data(self, tid, seq, payload, crc=None):
+        tr=self.transfers.get(self.rtids.get(tid))
+        if tr: self.write_chunk(tr,payload,seq if crc is not None else None,crc)
+
+    def write_chunk(self, tr, chunk, off=None, crc=None):
+        if crc is not None and zlib.crc32(chunk)!=crc: return   # hỏng: file_end sẽ xin lại
+        if off is None: off=tr["have"][-1][1] if tr["have"] else 0
+        if tr["buf"] and (off!=tr["boff"]+tr["blen"] or tr["blen"]+len(chunk)>WBATCH): self.flush_file(tr)
+        if not tr["buf"]:
+            tr["boff"]=off; self.dirty.append(tr)
+        tr["buf"].append(chunk); tr["blen"]+=len(chunk)
+        add_range(tr["have"],off,off+len(chunk))
+        tr["got"]=sum(b-a for a,b in tr["have"])
+        self.progress(tr,"recv",tr["fn"],tr["got"]/tr["size"]*100 if tr["size"] else 100.0)
+
+    def flush_file(self, tr):
+        if not tr["buf"] or tr["f"].closed: return
+        tr["f"].seek(tr["boff"]); tr["f"].write(b"".join(tr["buf"]))
+        tr["buf"], tr["blen"] = [], 0
+
+    def file_end(self, pk):
+        fn=pk["filename"]; key=pk.get("xid") or fn
+        self.rtids.pop(pk.get("tid"),None)
+        tr=self.transfers.get(key)
+        if not tr: return
+        self.flush_file(tr)
+        gaps=missing(tr)
+        if not gaps and tr["sha"] and file_hash(tr["f"])!=tr["sha"]:
+            gaps=[[0,tr["size"]]]; tr["have"]=[]
+        if gaps and tr["xid"] and tr["tries"]<REFILL and not tr["stored"]:   # chỉ xin lại đoạn thiếu / hỏng
+            tr["tries"]+=1
+            self.emit("file_retry",fn,sum(n for _o,n in gaps))
+            self.send_json(self.sock,{"type":"file_need","xid":tr["xid"],"to":tr["from"],"ranges":gaps})
+            return
+        tr["f"].close()
+        with self.flock:
+            del self.transfers[key]
+            if not gaps and tr["keep"] is None:
+                self.done[key]=tr; return     # chờ decide()
+        if not gaps: self.place(tr); return
+        hint=" – /fetch to download it again" if tr["stored"] else ""
+        self.emit("file_error",fn,f"corrupted (expected {tr['size']}, got {tr['got']}){hint}")
+        os.remove(tr["path"])
+
+    # ───── upload ─────
+    def on_ack(self, pk):
+        a=self.acks.get(pk.get("xid"))
+        if not a: return
+        with self.cv:
+            a[0]=pk.get("offset"); self.cv.notify()  # ack mới: upload có thêm credit
+        if pk["type"]=="file_resume" or pk.get("done"): a[1].set()
+
+    def on_reject(self, pk):
+        tid=pk.get("tid")
+        if tid is None: return
+        with self.cv:
+            self.rejected[tid]=pk.get("reason") or "rejected"
+            for up in [u for u in self.ups if u["tid"]==tid]: self.finish(up,Rejected(self.rejected[tid]))
+        a=self.acks.get(pk.get("xid"))
+        if a: a[1].set()                      # transfer đang chờ trả lời file_start
+
+    def refused(self, tid):
+        if tid in self.rejected: raise Rejected(self.rejected.pop(tid))
+
+    def wait_ack(self, xid, sock, secs=60):
+        """Chờ trả lời file_resume / ack cuối; False nếu kết nối đã đổi hoặc quá hạn."""
+        ev=self.acks[xid][1]
+        for _ in range(secs*2):
+            if ev.wait(0.5): ev.clear(); return True
+            if self.sock is not sock: return False
+        return False
+
+    def resume_upload(self, xid, tid, fn, old):
+        """Chờ thread đọc kết nối lại rồi hỏi server đã relay tới offset nào;
+        None = server không còn giữ transfer (gửi lại từ đầu)."""
+        for _ in range(600):
+            if self.sock is not old or self.quitting: break
+            time.sleep(0.5)
+        if self.sock is old: raise OSError("not reconnected")
+        self.acks[xid]=[None,threading.Event()]
+        self.send_json(self.sock,{"type":"file_resume","xid":xid,"tid":tid,"filename":fn})
+        return self.acks[xid][0] if self.wait_ack(xid,self.sock,10) else None
+
+    def send_ranges(self, sock, fp, tid, ranges, fn, sz, xid=None, z=False):
+        """Giao các đoạn [đầu, cuối) cho scheduler rồi chờ gửi xong; OSError nếu socket hỏng.
+        xid: tính credit theo ack của server; z: nội dung nén được (packable)."""
+        ranges=[[a,b] for a,b in ranges if a<b]
+        self.refused(tid)
+        if not ranges: return
+        up={"sock":sock,"fp":fp,"tid":tid,"ranges":ranges,"fn":fn,"sz":sz,"xid":xid,"seq":0,"z":z,
+            "done":threading.Event(),"err":None,"pct":-1}
+        with self.cv: self.ups.append(up); self.kick()
+        up["done"].wait()
+        if up["err"]: raise up["err"]
+
+    def send_file(self, path, tags=()):
+        """Gửi file ở thread riêng (sự kiện sent / send_failed khi xong)."""
+        t=threading.Thread(target=self.transfer,args=(path,list(tags)),daemon=True); t.start()
+        return t
+
+    def transfer(self, path, tags):
+        sock=self.sock
+        fn,sz=os.path.basename(path),os.path.getsize(path)
+        start={"type":"file_start","filename":fn,"size":sz,"to":tags,"from":self.name}
+        tid=next(self.tid_seq) if "bin" in self.server_caps else None
+        xfer=tid and "xfer" in self.server_caps
+        if tid: start["tid"]=tid
+        if "zlib" in self.server_caps:
+            with open(path,"rb") as fp: start["compress"]=packable(fp.read(65536))
+        if xfer:
+            with open(path,"rb") as fp: start.update(xid=secrets.token_hex(8), sha256=file_hash(fp))
+            self.uploads[start["xid"]]={"path":path,"to":set(tags),"left":{},"until":None}
+            self.acks[start["xid"]]=[0,threading.Event()]
+        end={k:start[k] for k in ("filename","from","tid","xid") if k in start}
+        end["type"]="file_end"
+        off=None
+        with open(path,"rb") as fp:
+            while True:
+                try:
+                    if off is None:
+                        self.send_json(sock,start); off=0
+                        if xfer and "blob" in self.server_caps and not tags and self.wait_ack(start["xid"],sock,10):
+                            self.refused(tid)
+                            off=self.acks[start["xid"]][0] or 0    # server đã có nội dung: bỏ qua dữ liệu
+                                                                   # (file gửi @user không vào kho: không chờ)
+                    self.send_ranges(sock,fp,tid,[[off,sz]],fn,sz,xfer and start["xid"],start.get("compress"))
+                    self.send_json(sock,end)
+                    if not xfer or self.wait_ack(start["xid"],sock):
+                        self.refused(tid); break          # server đã nhận hết (hoặc đã từ chối)
+                except Rejected as e:
+                    self.acks.pop(start.get("xid"),None); self.uploads.pop(start.get("xid"),None)
+                    self.emit("send_failed",fn,str(e)); return
+                except OSError:
+                    if not xfer: self.emit("send_failed",fn,""); return
+                try: off=self.resume_upload(start["xid"],tid,fn,sock)  # rớt mạng: gửi tiếp từ offset server đã có
+                except OSError:
+                    self.uploads.pop(start["xid"],None); self.emit("send_failed",fn,""); return
+                sock=self.sock
+        self.acks.pop(start.get("xid"),None)
+        if xfer: self.uploads[start["xid"]]["until"]=time.monotonic()+NEED_TTL   # còn chờ file_need
+        self.emit("sent",fn)
+
+    def file_need(self, pk):
+        # người nhận thiếu / hỏng một số đoạn: gửi bù riêng cho họ, tối đa REFILL lần mỗi người
+        now=time.monotonic()
+        for x in [x for x,u in list(self.uploads.items()) if u["until"] and u["until"]<now]: self.uploads.pop(x,None)
+        up,frm=self.uploads.get(pk.get("xid")),pk.get("from")
+        if not up or not isinstance(frm,str) or (up["to"] and frm not in up["to"]): return
+        left=up["left"].get(frm,REFILL)
+        if left<=0 or not os.path.exists(up["path"]): return
+        up["left"][frm]=left-1
+        ranges=need_ranges(pk.get("ranges"),os.path.getsize(up["path"]))
+        if ranges:
+            threading.Thread(target=self.refill,args=(self.sock,up["path"],dict(pk,ranges=ranges)),daemon=True).start()
+
+    def refill(self, sock, path, pk):
+        fn,sz=os.path.basename(path),os.path.getsize(path)
+        tid=next(self.tid_seq)
+        start={"type":"file_start","filename":fn,"size":sz,"to":[pk["from"]],"from":self.name,
+               "xid":pk["xid"],"tid":tid,"fill":True}
+        try:
+            with open(path,"rb") as fp:
+                if "zlib" in self.server_caps: start["compress"]=packable(fp.read(65536))
+                self.send_json(sock,start)
+                self.send_ranges(sock,fp,tid,[[off,min(off+n,sz)] for off,n in pk.get("ranges") or ()],fn,sz,
+                                 z=start.get("compress"))
+            self.send_json(sock,dict(start,type="file_end"))
+        except (OSError, Rejected): pass
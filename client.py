@@ -1,27 +1,33 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Client v15 – +/pdf, async transfer thread, corruption check, forward support.
+Client v16 – giao diện dòng lệnh + pop-up Tk trên lõi mạng chatcore.Client.
+
+Mọi thứ về mạng (login, kết nối lại, scheduler gửi, nhận / ghép file) nằm ở
+chatcore; file này chỉ đọc lệnh, in sự kiện và hỏi người dùng. Pop-up chạy
+trên thread riêng và trả lời qua core (decide(), hàng lệnh) nên không chặn
+việc nhận chat / file.
 """
 
-import socket, threading, datetime, json, base64, os, shlex, tempfile, subprocess, platform, shutil
+import threading, datetime, os, shlex, tempfile, subprocess, platform
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from urllib.request import urlretrieve
 from PIL import Image, ImageTk
 try: import readline
 except ImportError: readline=None
+from chatcore import Client
 
 HOST, PORT = '127.0.0.1', 12345
-CHUNK, BAR = 4096, 20
+BAR = 20
 
-username=""; current_room=[None]
-transfers, skipped, cmdq = {}, {}, []
+core=None                              # chatcore.Client, tạo trong main()
+cmdq=[]                                # lệnh do pop-up sinh ra, chạy trước input()
 
 # ───── command groups ─────
-MENU ={"/room","/create","/join","/rename","/delete","/count","/online","/clean","/quit"}
-CHAT ={"/leave","/rename","/users","/recall","/reply","/pin","/pinned","/unpin","/msg",
-       "/invitefriend","/forward"}
+MENU ={"/room","/create","/join","/rename","/delete","/count","/online","/stats","/clean","/quit","/search"}
+CHAT ={"/leave","/rename","/users","/recall","/reply","/pin","/pinned","/unpin","/msg","/more",
+       "/invitefriend","/forward","/fetch"}
 FILE ={"/sendfile","/pic","/mp3","/mp4","/text","/gif","/pdf","/open","/save"}
 FRI  ={"/addfriend","/acceptfriend","/myfriends","/unfriend","/block"}
 
@@ -36,6 +42,8 @@ def bar(p): f=int(p/BAR); return "#"*f+"."*(BAR-f)
 def sname(n): return n[:20]+"…" if len(n)>20 else n
 
 # ───── pop-ups ─────
+def popup(fn,*args): threading.Thread(target=fn,args=args,daemon=True).start()
+
 def gif_popup(p):
     img=Image.open(p); frames=[]
     try:
@@ -48,8 +56,7 @@ def gif_popup(p):
     loop(); root.mainloop()
 
 def open_file(p):
-    if p.lower().endswith(".gif"):
-        threading.Thread(target=gif_popup,args=(p,),daemon=True).start()
+    if p.lower().endswith(".gif"): popup(gif_popup,p)
     elif platform.system()=="Windows": os.startfile(p)
     elif platform.system()=="Darwin": subprocess.Popen(["open",p])
     else: subprocess.Popen(["xdg-open",p])
@@ -66,95 +73,56 @@ def friend_popup(pk):
         cmdq.append(f"/acceptfriend {pk['from']}")
     root.destroy()
 
-# ───── network receive ─────
-def send_json(s,o): s.sendall((json.dumps(o)+"\n").encode())
-
-def recv_thread(sock):
-    buf=""
-    while True:
-        try:
-            d=sock.recv(65536)
-            if not d: print(ts(),"Disconnected"); break
-            buf+=d.decode()
-            while "\n" in buf:
-                line,buf=buf.split("\n",1)
-                if not line: continue
-                try:
-                    pk=json.loads(line); t=pk.get("type")
-                    if t=="file_start": file_start(pk)
-                    elif t=="file_chunk": file_chunk(pk)
-                    elif t=="file_end": file_end(pk)
-                    elif t=="invite": invite_popup(pk)
-                    elif t=="friendreq": friend_popup(pk)
-                    elif t=="msg": print(f"{ts()} [PM] {pk['from']}: {pk['text']}")
-                except json.JSONDecodeError:
-                    print(line)
-        except: break
-
-def file_start(pk):
-    fn, sz, sender = pk["filename"], pk["size"], pk["from"]
+def file_popup(key,info):
+    # file đã bắt đầu được nhận; câu trả lời tới lúc nào cũng được
     root=tk.Tk(); root.withdraw()
     choice = messagebox.askyesnocancel(
         "Incoming file",
-        f"{sender} sent {fn} ({sz} B).\n"
+        f"{info['from']} sent {info['filename']} ({info['size']} B).\n"
         "Yes = Open & Save   No = Save   Cancel = Skip"
     )
-    keep = choice is not None
-    view = choice is True
     root.destroy()
-    os.makedirs("downloads",exist_ok=True)
-    f=open(os.path.join("downloads",fn),"wb") if keep else tempfile.NamedTemporaryFile(delete=False)
-    transfers[fn]={"f":f,"got":0,"size":sz,"keep":keep,"view":view}
-
-def file_chunk(pk):
-    tr=transfers.get(pk["filename"])
-    if tr:
-        chunk=base64.b64decode(pk["data"]); tr["f"].write(chunk); tr["got"]+=len(chunk)
-        pct=tr["got"]/tr["size"]*100
-        print(f"\r{ts()} Recv {sname(pk['filename'])} [{bar(pct)}] {pct:5.1f}%",end="",flush=True)
-
-def file_end(pk):
-    fn=pk["filename"]; tr=transfers.pop(fn,None)
-    if not tr: return
-    tr["f"].close()
-    ok = tr["got"] == tr["size"]
-    p = os.path.join("downloads",fn) if tr["keep"] else tr["f"].name
-    if ok:
-        print(f"\r{ts()} Saved {fn}",' '*8)
-        if tr["view"]: open_file(p)
-        if not tr["keep"]: skipped[fn]=p
-    else:
-        print(f"\r{ts()} ERROR: {fn} corrupted (expected {tr['size']}, got {tr['got']})",' '*8)
-        if not tr["keep"]: os.remove(p)
+    core.decide(key, choice is not None, choice is True)
+
+# ───── sự kiện từ core ─────
+def on_progress(kind,fn,pct):
+    print(f"\r{ts()} {'Send' if kind=='send' else 'Recv'} {sname(fn)} [{bar(pct)}] {pct:5.1f}%",end="",flush=True)
+
+def on_saved(fn,p,view):
+    print(f"\r{ts()} Saved {os.path.basename(p)}",' '*8)
+    if view: open_file(p)
+
+EVENTS={
+    "line":         print,
+    "pm":           lambda pk: print(f"{ts()} [PM] {pk['from']}: {pk['text']}"),
+    "invite":       lambda pk: popup(invite_popup,pk),
+    "friendreq":    lambda pk: popup(friend_popup,pk),
+    "file_offer":   lambda key,info: popup(file_popup,key,info),
+    "progress":     on_progress,
+    "file_retry":   lambda fn,n: print(f"\r{ts()} {fn}: {n} B missing, re-requesting",' '*8),
+    "file_saved":   on_saved,
+    "file_skipped": lambda fn,p: print(f"\r{ts()} Skipped {fn} – /save {fn} to keep it",' '*8),
+    "file_error":   lambda fn,text: print(f"\r{ts()} ERROR: {fn} {text}",' '*8),
+    "sent":         lambda fn: print(f"\r{ts()} File {fn} sent.",' '*8),
+    "send_failed":  lambda fn,why: print(f"\r{ts()} File {fn} failed{': '+why if why else ''}."),
+    "status":       lambda text: print(ts(),text),
+    "closed":       lambda: print(ts(),"Disconnected"),
+}
 
 # ───── send-file helpers ─────
-def transfer(sock,path,tags):
-    fn,sz=os.path.basename(path),os.path.getsize(path)
-    send_json(sock,{"type":"file_start","filename":fn,"size":sz,"to":tags,"from":username})
-    sent=0
-    with open(path,"rb") as fp:
-        while (chunk:=fp.read(CHUNK)):
-            sent+=len(chunk); pct=sent/sz*100
-            send_json(sock,{"type":"file_chunk","filename":fn,
-                            "data":base64.b64encode(chunk).decode(),"from":username})
-            print(f"\r{ts()} Send {sname(fn)} [{bar(pct)}] {pct:5.1f}%",end="",flush=True)
-    send_json(sock,{"type":"file_end","filename":fn,"from":username})
-    print(f"\r{ts()} File {fn} sent.",' '*8)
-
-def browse(ftype,tags,sock):
+def browse(ftype,tags):
     root=tk.Tk(); root.withdraw()
     p=filedialog.askopenfilename(filetypes=[ftype]); root.destroy()
-    if p:
-        threading.Thread(target=transfer,args=(sock,p,tags),daemon=True).start()
+    if p: core.send_file(p,tags)
 
-def fetch_gif(sock,url,tags):
+def fetch_gif(url,tags):
     tmp=os.path.join(tempfile.gettempdir(), os.path.basename(url.split('/')[-1] or "tmp.gif"))
     urlretrieve(url,tmp)
-    transfer(sock,tmp,tags)
+    core.transfer(tmp,tags)
     os.remove(tmp)
 
 # ───── sender loop ─────
-def sender(sock):
+def sender():
     FT={"/sendfile":("All","*.*"),
         "/pic":     ("Images","*.jpg *.jpeg *.png"),
         "/mp3":     ("Audio","*.mp3 *.wav"),
@@ -168,49 +136,53 @@ def sender(sock):
 
         parts=shlex.split(raw); cmd=parts[0]
         tags=[p[1:] for p in parts[1:] if p.startswith("@")]
-        room=current_room[0]
+        room=core.room
 
         if cmd in CHAT|FILE and not room and cmd not in {"/rename","/forward"}:
             print("Join a room first."); continue
         if cmd=="/clean" and room:
             print("Cannot /clean inside a room."); continue
 
-        if cmd in FT:
-            browse(FT[cmd],tags,sock)
-        elif cmd=="/gif":
-            if len(parts)<2: print("Usage /gif <url>"); continue
-            threading.Thread(target=fetch_gif,args=(sock,parts[1],tags),daemon=True).start()
-        elif cmd=="/open":
-            if len(parts)<2: print("Usage /open <file>"); continue
-            fn=parts[1]
-            p=os.path.join("downloads",fn) if os.path.exists(os.path.join("downloads",fn)) else skipped.get(fn)
-            open_file(p) if p and os.path.exists(p) else print("File not found.")
-        elif cmd=="/save":
-            if len(parts)<2 or parts[1] not in skipped: print("Usage /save <skipped_file>"); continue
-            fn=parts[1]; os.makedirs("downloads",exist_ok=True)
-            shutil.move(skipped[fn],os.path.join("downloads",fn)); del skipped[fn]; print("Saved.")
-        elif cmd=="/clean":
-            os.system("cls" if platform.system()=="Windows" else "clear")
-            sock.sendall((cmd+"\n").encode())
-        elif cmd=="/msg":
-            txt=" ".join(p for p in parts[1:] if not p.startswith("@"))
-            send_json(sock,{"type":"msg","to":tags,"text":txt,"from":username})
-        else:
-            sock.sendall((raw+"\n").encode())
-            if cmd=="/join" and len(parts)>1: current_room[0]=parts[1]
-            if cmd=="/leave": current_room[0]=None
-            if cmd=="/quit": break
+        try:
+            if cmd in FT:
+                browse(FT[cmd],tags)
+            elif cmd=="/gif":
+                if len(parts)<2: print("Usage /gif <url>"); continue
+                threading.Thread(target=fetch_gif,args=(parts[1],tags),daemon=True).start()
+            elif cmd=="/open":
+                if len(parts)<2: print("Usage /open <file>"); continue
+                fn=parts[1]
+                p=os.path.join(core.downloads,fn)
+                p=p if os.path.exists(p) else core.skipped.get(fn)
+                open_file(p) if p and os.path.exists(p) else print("File not found.")
+            elif cmd=="/save":
+                if len(parts)<2 or parts[1] not in core.skipped: print("Usage /save <skipped_file>"); continue
+                print("Saved." if core.save(parts[1]) else "File not found.")
+            elif cmd=="/clean":
+                os.system("cls" if platform.system()=="Windows" else "clear")
+                core.send_line(cmd)
+            elif cmd=="/stats":
+                r=core.upload_report()
+                if r: print("Upload compression:",r)
+                core.send_line(raw)
+            elif cmd=="/msg":
+                core.send_pm(tags," ".join(p for p in parts[1:] if not p.startswith("@")))
+            else:
+                core.send_line(raw)
+                if cmd=="/quit": break
+        except OSError:
+            print("Not connected.")
 
 # ───── main ─────
 def main():
-    global username
-    sock=socket.socket(); sock.connect((HOST,PORT))
-    print(sock.recv(1024).decode(),end='')
-    username=input(">> ").strip()
-    sock.sendall((username+"\n").encode())
-    print(sock.recv(1024).decode(),end='')
-    threading.Thread(target=recv_thread,args=(sock,),daemon=True).start()
-    sender(sock); sock.close()
+    global core
+    core=Client(HOST,PORT)
+    name=input("Enter username:\n>> ").strip()   # hỏi tên trước khi kết nối: không tốn hạn login của server
+    hello=core.connect()
+    if not hello.startswith("Enter username:"): print(hello,end='')
+    for ev,fn in EVENTS.items(): core.on(ev,fn)
+    core.start(name)
+    sender(); core.close()
 
 if __name__=="__main__":
     main()
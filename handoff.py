@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Nâng cấp server không ngắt kết nối (server.py --handoff PATH).
+
+Server đang chạy nghe thêm trên Unix socket PATH. Chạy server.py mới với cùng
+PATH: process mới nối vào, server cũ dừng vòng lặp (loop mode: chỉ thread
+event loop đổi trạng thái), ghi nốt store / journal rồi gửi toàn bộ trạng thái
+RAM. Mọi socket (socket nghe, kết nối client) và file đang mở (file đang gửi
+bằng sendfile, bản tạm của upload vào kho) trong trạng thái được thay bằng số
+thứ tự, fd thật đi kèm bằng SCM_RIGHTS, bên nhận mở lại đúng các object đó.
+Process mới trả "ok" -> server cũ thoát mà không đóng kết nối nào (fd vẫn mở
+ở process mới), dữ liệu client gửi trong lúc đó nằm chờ trong kernel. Không có
+"ok" (process mới chết / quá hạn) thì server cũ chạy tiếp như chưa có gì.
+
+Khung: HEAD (số fd, độ dài pickle), rồi từng lô tối đa MAX_FDS fd, mỗi lô đi
+kèm đúng 1 byte, rồi phần pickle.
+"""
+
+import io, os, pickle, socket, struct
+
+HEAD = struct.Struct("!IQ")                     # số fd, độ dài pickle
+MAX_FDS = 250                                   # fd mỗi sendmsg (kernel: SCM_MAX_FD = 253)
+WAIT = 30                                       # giây chờ bên kia
+
+class Packer(pickle.Pickler):
+    def __init__(self, f, fds):
+        super().__init__(f, pickle.HIGHEST_PROTOCOL)
+        self.fds, self.ids = fds, {}            # fd sẽ gửi; id(object) -> số thứ tự
+
+    def persistent_id(self, obj):
+        if isinstance(obj, socket.socket): kind = "sock"
+        elif isinstance(obj, (io.BufferedReader, io.BufferedRandom)): kind = "file"
+        else: return None
+        if (obj.closed if kind == "file" else obj.fileno() < 0): return ("closed",)
+        i = self.ids.get(id(obj))
+        if i is None:
+            if kind == "file": obj.flush()
+            i = self.ids[id(obj)] = len(self.fds); self.fds.append(obj.fileno())
+        return (kind, i, obj.mode if kind == "file" else None)
+
+class Unpacker(pickle.Unpickler):
+    def __init__(self, f, fds):
+        super().__init__(f)
+        self.fds, self.objs = fds, {}
+
+    def persistent_load(self, pid):
+        if pid[0] == "closed": return None
+        kind, i, mode = pid
+        if i not in self.objs:
+            self.objs[i] = socket.socket(fileno=self.fds[i]) if kind == "sock" else os.fdopen(self.fds[i], mode)
+        return self.objs[i]
+
+def listen(path):
+    if os.path.exists(path): os.unlink(path)     # socket của process trước
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path); s.listen(1)
+    return s
+
+def connect(path):
+    """Nối tới server đang chạy trên path; None nếu không có server nào."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try: s.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        s.close(); return None
+    s.settimeout(WAIT)
+    return s
+
+def recv_all(s, n):
+    buf = bytearray()
+    while len(buf) < n:
+        d = s.recv(min(n - len(buf), 1 << 20))
+        if not d: raise ConnectionError("handoff peer closed")
+        buf += d
+    return bytes(buf)
+
+def give(ctl, state):
+    """Gửi state (kèm fd); True nếu process mới đã nhận và tiếp quản."""
+    ctl.settimeout(WAIT)
+    f, fds = io.BytesIO(), []
+    Packer(f, fds).dump(state)
+    body = f.getvalue()
+    try:
+        ctl.sendall(HEAD.pack(len(fds), len(body)))
+        for i in range(0, len(fds), MAX_FDS):
+            socket.send_fds(ctl, [b"F"], fds[i:i + MAX_FDS])
+        ctl.sendall(body)
+        return ctl.recv(2) == b"ok"
+    except OSError:
+        return False
+
+def take(ctl):
+    """Nhận state của server cũ (server cũ đang chờ ack())."""
+    n, size = HEAD.unpack(recv_all(ctl, HEAD.size))
+    fds = []
+    while len(fds) < n:
+        _d, got, _flags, _addr = socket.recv_fds(ctl, 1, MAX_FDS)
+        if not got: raise ConnectionError("handoff peer closed")
+        fds += got
+    return Unpacker(io.BytesIO(recv_all(ctl, size)), fds).load()
+
+def ack(ctl):
+    """Báo server cũ thoát rồi chờ nó thoát hẳn (nhả cổng metrics, PATH…)."""
+    ctl.sendall(b"ok")
+    try: ctl.recv(1)
+    except OSError: pass
+    ctl.close()
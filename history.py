@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lịch sử phòng: ring buffer cố định + chỉ mục id -> ô, tra cứu O(1).
+
+Mỗi phần tử là tuple (id, sender, line) như deque cũ; khi đầy, phần tử cũ
+nhất bị ghi đè và id của nó bị xoá khỏi chỉ mục.
+"""
+
+class History:
+    __slots__ = ("cap", "buf", "start", "n", "idx")
+
+    def __init__(self, cap=1000):
+        self.cap, self.buf = cap, [None]*cap
+        self.start = self.n = 0
+        self.idx = {}                               # id -> ô trong buf
+
+    def append(self, entry):
+        """Thêm entry; trả về phần tử cũ nhất bị ghi đè (None nếu chưa đầy)."""
+        old = None
+        if self.n == self.cap:                      # đầy: ghi đè phần tử cũ nhất
+            slot = self.start
+            old = self.buf[slot]
+            del self.idx[old[0]]
+            self.start = (slot + 1) % self.cap
+        else:
+            slot = (self.start + self.n) % self.cap
+            self.n += 1
+        self.buf[slot] = entry
+        self.idx[entry[0]] = slot
+        return old
+
+    def get(self, mid):
+        slot = self.idx.get(mid)
+        return None if slot is None else self.buf[slot]
+
+    def replace(self, mid, entry):
+        """Thay nội dung tại chỗ (vd. /recall); False nếu id đã bị đẩy ra."""
+        slot = self.idx.get(mid)
+        if slot is None: return False
+        self.buf[slot] = entry
+        return True
+
+    def first_id(self):
+        return self.buf[self.start][0] if self.n else None
+
+    def before(self, mid, k):
+        """Tối đa k phần tử có id < mid (cũ -> mới); id trong ring luôn tăng
+        dần nên tìm nhị phân."""
+        lo, hi = 0, self.n
+        while lo < hi:
+            m = (lo + hi) // 2
+            if self.buf[(self.start + m) % self.cap][0] < mid: lo = m + 1
+            else: hi = m
+        return [self.buf[(self.start + i) % self.cap] for i in range(max(0, lo - k), lo)]
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):                             # cũ -> mới
+        for i in range(self.n):
+            yield self.buf[(self.start + i) % self.cap]
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lưu đồ thị bạn bè / chặn / lời mời và danh sách phòng (server.py --state DIR).
+
+Ghi: mỗi thay đổi là một bản ghi JSON một dòng, xếp vào hàng đợi; writer
+thread gom lô, append vào wal.<gen> rồi fsync -> lệnh không chờ đĩa. Khi
+đuôi log đủ dài, writer chuyển sang wal.<gen+1> và chạy một process con
+(python3 journal.py compact DIR GEN) đọc snapshot + các wal <= gen, ghi
+snapshot mới rồi xoá các wal đó; server không tốn CPU / GIL cho việc này.
+
+Đọc (khởi động): snapshot (pickle các dict set, mỗi tên chỉ một object nên
+pickle chỉ ghi một lần, nạp nhanh) + phát lại các wal có gen >= gen của
+snapshot; đuôi log ngắn (SNAP_EVERY) nên phần phát lại nhỏ. Dòng cuối dở dang (server chết giữa lúc ghi)
+bị bỏ qua. Mỗi lần khởi động ghi sang một wal mới nên không nối vào dòng hỏng.
+Các bản ghi được áp dụng bằng chính Social nên phát lại luôn khớp với RAM.
+
+  python3 journal.py compact DIR       gộp các log cũ ngay (trừ log mới nhất: server
+                                       có thể đang ghi vào nó)
+  python3 journal.py show DIR          in số user / cạnh / phòng
+"""
+
+import gc, json, os, pickle, queue, re, subprocess, sys, threading, time
+from state import Social
+
+SNAP_EVERY = 20_000                                 # bản ghi trong đuôi log trước khi gộp
+BATCH = 1000                                        # bản ghi tối đa mỗi lần ghi + fsync
+WAL = re.compile(r"wal\.(\d+)")
+
+def empty():
+    return {"gen": 0, "friends": {}, "blocks": {}, "pending": {}, "rooms": None}
+
+def apply(d, soc, rec):
+    """Áp dụng một bản ghi lên snapshot d (soc là Social bọc các dict của d)."""
+    op, *a = rec
+    if op in ("request", "accept", "unfriend", "rename"): getattr(soc, op)(*a)
+    elif op == "block":
+        b = d["blocks"].setdefault(a[0], set())
+        b.add(a[1]) if a[2] else b.discard(a[1])
+    else:
+        if d["rooms"] is None: d["rooms"] = {}
+        rooms = d["rooms"]
+        if op == "create": rooms.setdefault(a[0], [])
+        elif op == "delete": rooms.pop(a[0], None)
+        elif op == "pin" and a[0] in rooms: rooms[a[0]].append(tuple(a[1:]))
+        elif op == "unpin" and a[0] in rooms: rooms[a[0]] = [p for p in rooms[a[0]] if p[0] != a[1]]
+
+def gens(path):
+    return sorted(int(m[1]) for m in map(WAL.fullmatch, os.listdir(path)) if m)
+
+def load(path, upto=None):
+    """(trạng thái, số bản ghi đã phát lại, gen wal lớn nhất) từ snapshot + các wal."""
+    on = gc.isenabled()
+    gc.disable()                                    # hàng triệu set mới: GC quét lại vô ích
+    try: return _load(path, upto)
+    finally:
+        if on: gc.enable()
+
+def _load(path, upto):
+    for _ in range(3):                              # bị gộp giữa lúc đọc: đọc lại
+        snap = os.path.join(path, "snapshot")
+        try:
+            with open(snap, "rb") as f: d = pickle.load(f)
+        except FileNotFoundError: d = empty()
+        soc, n, last = Social(), 0, d["gen"] - 1
+        soc.friends, soc.blocks, soc.pending = d["friends"], d["blocks"], d["pending"]
+        try:
+            for g in gens(path):
+                if g < d["gen"] or (upto is not None and g > upto): continue
+                if g != last + 1: raise FileNotFoundError   # thiếu gen: snapshot vừa được thay
+                with open(os.path.join(path, f"wal.{g}"), "rb") as f:
+                    for line in f:
+                        try: rec = json.loads(line)
+                        except ValueError: break    # dòng cuối dở dang
+                        apply(d, soc, rec); n += 1
+                last = g
+        except FileNotFoundError: continue
+        return d, n, last
+    raise OSError(f"{path}: log changed while loading")
+
+def compact(path, upto):
+    """Gộp snapshot + wal <= upto thành snapshot mới (gen upto+1), xoá các wal đó."""
+    d, _, _ = load(path, upto)
+    if upto < d["gen"]: return                      # đã gộp rồi
+    d["gen"] = upto + 1
+    names = {}                                      # một object cho mỗi tên
+    one = lambda n: names.setdefault(n, n)
+    for k in ("friends", "blocks", "pending"):
+        d[k] = {one(u): {one(v) for v in s} for u, s in d[k].items() if s}
+    tmp = os.path.join(path, "snapshot.tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump(d, f, pickle.HIGHEST_PROTOCOL); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(path, "snapshot"))
+    for g in gens(path):
+        if g <= upto: os.remove(os.path.join(path, f"wal.{g}"))
+
+
+class Journal:
+    def __init__(self, path, write=True):
+        """write=False: chỉ đọc (các worker phụ ở chế độ --workers), put() bỏ qua."""
+        self.path, self.write = path, write
+        os.makedirs(path, exist_ok=True)
+        self.q, self.child = queue.SimpleQueue(), None
+
+    def load(self):
+        """Nạp trạng thái đã lưu; rooms là None nếu chưa từng lưu phòng nào."""
+        t = time.perf_counter()
+        d, self.tail, self.gen = load(self.path)
+        self.ms = (time.perf_counter() - t) * 1000
+        self.room_pins = d["rooms"] or {}
+        self.open()
+        return d
+
+    def open(self, gen=None, tail=0):
+        """Ghi sang log mới sau gen (mặc định: log đã nạp / đã đóng). server.py
+        --handoff: process mới nhận gen, tail của process cũ, không cần nạp lại."""
+        if gen is not None: self.gen, self.tail = gen, tail
+        if not self.write: return
+        self.gen += 1                               # log mới cho lần chạy này
+        self.f = open(os.path.join(self.path, f"wal.{self.gen}"), "ab")
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Ghi nốt, dừng writer, chờ process gộp đang chạy (chỉ một process gộp
+        mỗi lúc) – sau đó process khác tiếp quản thư mục được."""
+        if not self.write: return
+        self.q.put(None); self.thread.join()
+        if self.child: self.child.wait(); self.child = None
+
+    # ---- ghi (không chặn) ----
+    def put(self, *rec):
+        if self.write: self.q.put(rec)
+
+    def sync(self):
+        """Chờ mọi bản ghi đã xếp tới thời điểm này nằm trên đĩa."""
+        if not self.write: return
+        done = threading.Event()
+        self.q.put(done); done.wait()
+
+    def _writer(self):
+        while True:
+            try: recs = [self.q.get(timeout=1)]
+            except queue.Empty: recs = []           # rảnh: gộp nốt nếu process con trước đã xong
+            while recs and len(recs) < BATCH:
+                try: recs.append(self.q.get_nowait())
+                except queue.Empty: break
+            marks = [r for r in recs if isinstance(r, threading.Event)]
+            stop = None in recs
+            recs = [r for r in recs if r is not None and not isinstance(r, threading.Event)]
+            if recs:
+                self.f.write(b"".join(json.dumps(r).encode() + b"\n" for r in recs))
+                self.f.flush(); os.fsync(self.f.fileno())
+                self.tail += len(recs)
+            for m in marks: m.set()
+            if stop:
+                self.f.close(); return
+            if self.tail >= SNAP_EVERY and (self.child is None or self.child.poll() is not None):
+                self.rotate()
+
+    def rotate(self):
+        # log hiện tại đóng lại, process con gộp nó vào snapshot
+        self.f.close(); self.tail = 0
+        self.child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "compact", self.path, str(self.gen)])
+        self.gen += 1
+        self.f = open(os.path.join(self.path, f"wal.{self.gen}"), "ab")
+
+
+if __name__ == "__main__":
+    cmd, path = sys.argv[1], sys.argv[2]
+    if cmd == "compact":
+        compact(path, int(sys.argv[3]) if len(sys.argv) > 3 else max(gens(path), default=0) - 1)
+    elif cmd == "show":
+        t = time.perf_counter(); d, n, _ = load(path)
+        print(f"{len(d['friends'])} users, {sum(map(len, d['friends'].values())) // 2} friend edges, "
+              f"{sum(map(len, d['blocks'].values()))} blocks, {sum(map(len, d['pending'].values()))} pending, "
+              f"rooms {sorted(d['rooms'] or ())}; {n} log records replayed, loaded in {time.perf_counter() - t:.2f}s")
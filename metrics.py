@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bộ đếm / histogram cho các đường nóng của server, xuất dạng text Prometheus
+qua một HTTP endpoint cục bộ (server.py --metrics PORT, GET /metrics).
+
+Ghi không cần khoá: mỗi thread có một shard riêng (threading.local) và chỉ
+thread đó ghi vào; lúc scrape mới cộng các shard lại. Thread kết thúc gọi
+retire() để gộp shard vào phần chung (thread mode: mỗi kết nối hai thread).
+Histogram có mốc cố định; observe() chỉ là bisect + hai phép cộng.
+Metric dạng "gauge" (hoặc counter đếm sẵn ở nơi khác) đăng ký bằng hàm, chỉ
+được gọi khi scrape. TimedLock thay threading.Lock để đo thời gian chờ lock;
+chỉ bấm giờ khi không lấy được lock ngay, nên đường không tranh chấp gần như
+không tốn thêm gì (bench/metrics.py đo chi phí).
+"""
+
+import threading, time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECONDS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+COUNTS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Metrics:
+    def __init__(self):
+        self.defs = {}                          # name -> (type, help, mốc histogram, hàm)
+        self.local = threading.local()
+        self.lock, self.shards = threading.Lock(), []
+        self.base = ({}, {})                    # counter, histogram của các thread đã kết thúc
+
+    def define(self, name, typ, doc, buckets=SECONDS, fn=None):
+        """fn(): giá trị lúc scrape – một số hoặc [(labels, số)]."""
+        self.defs[name] = (typ, doc, buckets if typ == "histogram" else None, fn)
+
+    def shard(self):
+        s = self.local.s = ({}, {})
+        with self.lock: self.shards.append(s)
+        return s
+
+    def inc(self, name, n=1, lab=()):
+        """lab: tuple các cặp (tên nhãn, giá trị), vd. (("room", "room1"),)."""
+        try: c = self.local.s[0]
+        except AttributeError: c = self.shard()[0]
+        k = (name, lab)
+        c[k] = c.get(k, 0) + n
+
+    def observe(self, name, v, lab=()):
+        try: h = self.local.s[1]
+        except AttributeError: h = self.shard()[1]
+        k = (name, lab)
+        b = h.get(k)
+        if b is None: b = h[k] = [0] * (len(self.defs[name][2]) + 2)    # từng mốc, +Inf, tổng
+        b[bisect_left(self.defs[name][2], v)] += 1; b[-1] += v
+
+    def retire(self):
+        """Gọi ở cuối thread: gộp shard của thread vào phần chung."""
+        s = self.local.__dict__.pop("s", None)
+        if s is None: return
+        with self.lock:
+            self.shards.remove(s)
+            merge(self.base, s)
+
+    def collect(self):
+        out = ({}, {})
+        with self.lock:
+            for s in [self.base] + self.shards: merge(out, s)
+        return out
+
+    def render(self):
+        c, h = self.collect()
+        rows = {}
+        for (name, lab), v in c.items(): rows.setdefault(name, []).append((lab, v))
+        for (name, lab), v in h.items(): rows.setdefault(name, []).append((lab, v))
+        out = []
+        for name, (typ, doc, bk, fn) in self.defs.items():
+            out += [f"# HELP {name} {doc}", f"# TYPE {name} {typ}"]
+            if fn:
+                v = fn()
+                for lab, x in (v if isinstance(v, list) else [((), v)]):
+                    out.append(f"{name}{labels(lab)} {x}")
+                continue
+            for lab, v in sorted(rows.get(name, ())):
+                if typ != "histogram":
+                    out.append(f"{name}{labels(lab)} {v}"); continue
+                acc = 0
+                for le, x in zip([f"{b:g}" for b in bk] + ["+Inf"], v):
+                    acc += x
+                    out.append(f"{name}_bucket{labels(lab + (('le', le),))} {acc}")
+                out += [f"{name}_sum{labels(lab)} {v[-1]:.6g}", f"{name}_count{labels(lab)} {acc}"]
+        return "\n".join(out) + "\n"
+
+def merge(dst, src):
+    # dict.copy() / list() là một thao tác nguyên tử với GIL: thread chủ shard vẫn ghi tiếp được
+    c, h = dst
+    for k, v in src[0].copy().items(): c[k] = c.get(k, 0) + v
+    for k, v in src[1].copy().items():
+        v, acc = list(v), h.get(k)
+        h[k] = v if acc is None else [a + b for a, b in zip(acc, v)]
+
+def labels(lab):
+    if not lab: return ""
+    esc = lambda s: str(s).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in lab) + "}"
+
+M = Metrics()
+LOCK_WAIT = "chat_lock_wait_seconds"
+M.define(LOCK_WAIT, "histogram", "Time spent waiting for a contended lock.")
+
+class TimedLock:
+    """threading.Lock, ghi thời gian chờ vào LOCK_WAIT{lock=name} khi phải chờ.
+    Đắt hơn lock thường ~0.15 µs mỗi lần lấy: dùng cho lock lấy một lần mỗi
+    thao tác, không cho lock lấy một lần mỗi người nhận (Outbox)."""
+    __slots__ = ("lock", "lab")
+    def __init__(self, name):
+        self.lock, self.lab = threading.Lock(), (("lock", name),)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False): return True
+        if not blocking: return False
+        t = time.perf_counter()
+        ok = self.lock.acquire(True, timeout)
+        M.observe(LOCK_WAIT, time.perf_counter() - t, self.lab)
+        return ok
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    __enter__ = acquire
+    def __exit__(self, *_):
+        self.lock.release()
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404); return
+        try: body = M.render().encode()
+        finally: M.retire()                     # mỗi request một thread: không giữ shard lại
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+def serve(host, port):
+    """Chạy endpoint trên thread nền; trả về server (đã bind)."""
+    srv = ThreadingHTTPServer((host, port), Handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hàng đợi gửi có giới hạn cho từng kết nối (slow-consumer policy).
+
+Broadcast chỉ put() vào hàng đợi rồi trả về ngay; việc ghi ra socket do
+writer của kết nối đó làm (thread riêng ở thread mode, event loop ở loop mode).
+Các buffer được giữ nguyên (một bytes broadcast dùng chung cho mọi người nhận)
+và ghi ra theo lô bằng một lệnh ghi vector (sendmsg); frames/writes đếm số
+message và số syscall ghi để thấy mức gộp. FileSpan (một đoạn file trên đĩa)
+được xếp như một message nhưng ghi bằng sendfile, không chiếm giới hạn byte.
+Có z (proto.Deflater, cap "zlib"): message được nén ngay khi xếp vào hàng, sau
+khi đã quyết định nhận, nên thứ tự trên luồng nén luôn khớp thứ tự gửi.
+Khi hàng đợi vượt giới hạn (số message hoặc số byte), policy theo loại dữ liệu:
+  drop        – bỏ message (dòng chat), báo lại số dòng bị bỏ sau đó
+  pause       – vẫn nhận tới 2x giới hạn, người gửi phải chờ xả (relay file)
+  disconnect  – ngắt kết nối consumer
+"""
+
+import os, threading
+from collections import deque
+from proto import ZMIN
+
+OK, DROP, PAUSE, KILL = "ok", "drop", "pause", "disconnect"
+POLICIES = (DROP, PAUSE, KILL)
+
+class FileSpan:
+    """n byte đầu của file path, chép thẳng từ page cache ra socket."""
+    __slots__ = ("f", "off", "left")
+    def __init__(self, path, n):
+        self.f, self.off, self.left = open(path, "rb"), 0, n
+
+    def send(self, sock, limit):
+        n = min(self.left, limit)
+        if sock.gettimeout() != 0:              # socket chặn (thread mode): socket.sendfile tự chờ
+            sent = sock.sendfile(self.f, self.off, n)
+        elif hasattr(os, "sendfile"):           # socket.sendfile không nhận socket non-blocking
+            sent = os.sendfile(sock.fileno(), self.f.fileno(), self.off, n)
+        else:
+            self.f.seek(self.off); sent = sock.send(self.f.read(n))
+        if not sent: raise OSError("file truncated")
+        return sent
+
+    def skip(self, n):
+        self.off += n; self.left -= n
+        if not self.left: self.f.close()
+
+    def close(self):
+        self.f.close()
+
+class Outbox:
+    def __init__(self, max_msgs, max_bytes, policy, ready=None):
+        self.q, self.size = deque(), 0
+        self.max_msgs, self.max_bytes, self.policy = max_msgs, max_bytes, policy
+        self.ready = ready              # gọi khi hàng đợi từ rỗng -> có dữ liệu
+        self.low = []                   # hook một lần khi xả xuống dưới nửa giới hạn
+        self.dropped = 0
+        self.frames, self.writes = 0, 0 # số buffer đã ghi xong / số lần ghi
+        self.closed = False
+        self.z = None                   # Deflater khi client có cap "zlib"
+        self.cv = threading.Condition(threading.Lock())
+
+    def over(self, n, k=1):
+        return len(self.q) + 1 > k*self.max_msgs or self.size + n > k*self.max_bytes
+
+    def below_half(self):
+        return len(self.q) <= self.max_msgs//2 and self.size <= self.max_bytes//2
+
+    def put(self, data, kind="ctl", zip=None):
+        """zip: None = nén nếu là text (frame nhị phân thì không), True/False = ép."""
+        n = 0 if type(data) is FileSpan else len(data); act = OK
+        with self.cv:
+            if self.closed: return KILL
+            if self.over(n):
+                act = self.policy.get(kind, KILL)
+                if act == PAUSE and self.over(n, 2): act = KILL
+                if act == DROP: self.dropped += 1
+                if act != PAUSE: return act
+            wake = not self.q
+            if self.dropped and kind != "file":
+                note = f"[server] {self.dropped} message(s) dropped – connection too slow\n".encode()
+                self.q.append(note); self.size += len(note); self.dropped = 0
+            if self.z and n >= ZMIN and (data[0] != 0 if zip is None else zip):
+                data = self.z.pack(data); n = len(data)
+            self.q.append(data); self.size += n
+            self.cv.notify()
+        if wake and self.ready: self.ready()
+        return act
+
+    def peek(self, limit, count=1024):
+        """Các buffer đầu hàng đợi, tổng tối đa ~limit byte và count buffer
+        (ít nhất 1 buffer). FileSpan luôn được trả về một mình."""
+        with self.cv:
+            out, n = [], 0
+            for b in self.q:
+                if type(b) is FileSpan:
+                    if not out: out.append(b)
+                    break
+                if out and (n + len(b) > limit or len(out) == count): break
+                out.append(b); n += len(b)
+            return out
+
+    def consume(self, n):
+        """Bỏ n byte đã ghi ra socket khỏi đầu hàng đợi."""
+        with self.cv:
+            if not self.q: return       # close(discard=True) đã bỏ hàng đợi
+            if n: self.writes += 1
+            while n:
+                b = self.q[0]
+                if type(b) is FileSpan:
+                    b.skip(n); n = 0
+                    if not b.left: self.q.popleft(); self.frames += 1
+                elif len(b) <= n:
+                    self.q.popleft(); n -= len(b); self.size -= len(b); self.frames += 1
+                else:
+                    self.q[0] = memoryview(b)[n:]; self.size -= n; n = 0
+            hooks = []
+            if self.low and self.below_half():
+                hooks, self.low = self.low, []
+            self.cv.notify_all()
+        for h in hooks: h()
+
+    def wait(self, linger=0, full=0):
+        """Chờ có dữ liệu; False khi đã đóng và xả hết. linger > 0: có dữ liệu
+        rồi thì chờ thêm tối đa linger giây (hoặc tới khi đủ full byte) để gộp."""
+        with self.cv:
+            while not self.q and not self.closed:
+                self.cv.wait()
+            if linger and self.q:
+                self.cv.wait_for(lambda: self.closed or self.size >= full, linger)
+            return bool(self.q)
+
+    def wait_low(self, timeout):
+        with self.cv:
+            return self.cv.wait_for(lambda: self.closed or self.below_half(), timeout)
+
+    def close(self, discard=False):
+        with self.cv:
+            self.closed = True
+            if discard:
+                for b in self.q:
+                    if type(b) is FileSpan: b.close()
+                self.q.clear(); self.size = 0
+            hooks, self.low = self.low, []
+            self.cv.notify_all()
+        for h in hooks: h()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Protocol helpers dùng chung cho server.py và client.py.
+
+Luồng TCP gồm hai loại frame:
+  * dòng text / JSON kết thúc bằng "\\n" (như cũ);
+  * frame nhị phân cho dữ liệu file: byte 0x00, rồi header cố định
+    (transfer id, sequence number, length) và payload thô.
+Frame nhị phân chỉ được dùng khi hai bên đã thoả thuận cap "bin" lúc login;
+cap "resume" bật token phiên + gói "sync" để kết nối lại chỉ nhận phần thiếu.
+Cap "xfer": frame nhị phân v2 (bit cao của tid bật) mang offset + crc32 của
+chunk thay cho seq, để gửi tiếp từ offset đã ack và xin lại đúng đoạn thiếu.
+Cap "blob": server có kho file (blobs.py) và gửi file lưu sẵn bằng frame raw
+(bit RAW của tid): chỉ một header cho cả file, len là kích thước file, dữ liệu
+theo sau được decode thành từng mẩu khi tới, không đệm cả frame.
+Cap "zlib": mỗi chiều của kết nối có một luồng deflate; message đủ dài và nén
+được đi trong frame nén (bit ZIP của tid), Decoder giải nén rồi đọc tiếp phần
+bên trong như dữ liệu thường, nên mọi loại frame khác vẫn dùng nguyên.
+Cap "ping": bên nào không nhận được gì trong `ping` giây (welcome báo) thì gửi
+{"type":"ping"}, bên kia trả {"type":"pong"}; im lặng quá `dead` giây là kết nối
+đã chết – server đóng, client kết nối lại.
+Chuyển kết nối sang process khác (server.py --handoff): Deflater.cut() kết thúc
+phần từ điển cũ, process mới nén tiếp bằng luồng raw; Decoder pickle được –
+giữ 32 KB vừa giải nén làm từ điển cho luồng giải nén raw ở process mới.
+"""
+
+import json, struct, time, zlib
+
+ENC = 'utf-8'
+BIN = 0x00                                  # byte mở đầu frame nhị phân
+FRAME = struct.Struct("!BIII")              # marker, tid, seq, len
+OFFSET = struct.Struct("!Q")                # v2: offset ngay sau FRAME (seq = crc32)
+V2 = 1 << 31                                # bit của tid đánh dấu frame v2
+RAW = 1 << 30                               # bit của tid đánh dấu frame raw (server -> client)
+ZIP = 1 << 29                               # bit của tid đánh dấu frame nén (cap "zlib")
+CAPS = {"bin", "resume", "xfer", "blob", "zlib", "ping"}    # các capability hỗ trợ
+ZMIN = 128                                  # message ngắn hơn gửi nguyên: header + flush ăn hết phần lợi
+ZWIN = 32768                                # cửa sổ deflate: từ điển cần để giải nén tiếp
+ZBITS, ZMEM = 13, 5                         # cửa sổ 8 KB, memLevel 5 của bên nén: ~50 KB mỗi kết nối
+                                            # thay vì ~256 KB (15, 8); bên giải nén cửa sổ 15 vẫn đọc được
+# đầu file đã nén sẵn: jpg, png, gif, zip/docx, gzip, 7z, rar, bz2, xz, mp3, ogg, webm/mkv
+PACKED = (b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"PK\x03\x04", b"\x1f\x8b", b"7z\xbc\xaf",
+          b"Rar!", b"BZh", b"\xfd7zXZ", b"ID3", b"\xff\xfb", b"OggS", b"\x1a\x45\xdf\xa3")
+NEED_RANGES = 64                            # số đoạn tối đa trong một file_need
+NEED_MAX = 3                                # số lần một người nhận được xin gửi bù một transfer
+MAX_LINE = 1 << 20                          # dòng text/JSON dài nhất (byte)
+MAX_FRAME = 1 << 20                         # payload frame nhị phân lớn nhất
+LONG = 1024                                 # dòng dài hơn: decode riêng, không gom
+
+def pack_line(obj):
+    return (json.dumps(obj) + "\n").encode(ENC)
+
+def pack_frame(tid, seq, payload):
+    return FRAME.pack(BIN, tid, seq, len(payload)) + payload
+
+def pack_chunk(tid, off, payload, crc=None):
+    """Frame v2: chunk ở offset off, crc32 tính từ payload nếu không đưa sẵn."""
+    if crc is None: crc = zlib.crc32(payload)
+    return FRAME.pack(BIN, tid | V2, crc, len(payload)) + OFFSET.pack(off) + payload
+
+def raw_head(tid, n):
+    """Header frame raw: n byte dữ liệu thô (thường là sendfile) đi ngay sau."""
+    return FRAME.pack(BIN, tid | RAW, 0, n)
+
+def need_ranges(ranges, size, limit=NEED_RANGES):
+    """Các đoạn [offset, độ dài] hợp lệ của một file_need: bỏ đoạn sai kiểu hoặc
+    nằm ngoài file, gộp các đoạn chồng / liền nhau; quá limit đoạn thì đoạn cuối
+    kéo tới hết đoạn thừa. Không bao giờ dài hơn size byte tổng cộng."""
+    iv = []
+    for r in ranges if isinstance(ranges, list) else ():
+        if isinstance(r, list) and len(r) == 2 and all(type(x) is int for x in r) and 0 <= r[0] < size and r[1] > 0:
+            iv.append((r[0], min(r[0] + r[1], size)))
+    out = []
+    for a, b in sorted(iv):
+        if out and a <= out[-1][1]: out[-1][1] = max(out[-1][1], b)
+        else: out.append([a, b])
+    if len(out) > limit: out[limit-1:] = [[out[limit-1][0], out[-1][1]]]
+    return [[a, b - a] for a, b in out]
+
+def packable(head):
+    """Đoạn đầu file có đáng nén không: nhận diện định dạng đã nén (kể cả mp4/mov
+    qua "ftyp"), còn lại nén thử mức 1 và chỉ nhận nếu nhỏ đi ít nhất 10%."""
+    if head.startswith(PACKED) or head[4:8] == b"ftyp": return False
+    return len(zlib.compress(head, 1)) < 0.9 * len(head)
+
+class Deflater:
+    """Luồng nén một chiều của một kết nối. Mỗi message thành một frame nén
+    (Z_SYNC_FLUSH), dùng chung từ điển với các message trước nên dòng chat
+    ngắn vẫn nén được. Đếm byte vào / ra và giây CPU để chỉnh mức nén."""
+    def __init__(self, level=6, raw=False):
+        # raw: nối tiếp luồng của process khác sau cut() – không header zlib
+        self.z = zlib.compressobj(level, zlib.DEFLATED, -ZBITS if raw else ZBITS, ZMEM)
+        self.raw, self.out, self.cpu = 0, 0, 0.0
+
+    def pack(self, data):
+        t = time.thread_time()
+        c = self.z.compress(data) + self.z.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu += time.thread_time() - t
+        self.raw += len(data); self.out += FRAME.size + len(c)
+        return FRAME.pack(BIN, ZIP, 0, len(c)) + c
+
+    def cut(self):
+        """Frame Z_FULL_FLUSH: dữ liệu sau nó không tham chiếu phần trước, nên
+        một Deflater(raw=True) mới nén tiếp được trên cùng luồng của bên nhận."""
+        c = self.z.flush(zlib.Z_FULL_FLUSH)
+        return FRAME.pack(BIN, ZIP, 0, len(c)) + c
+
+    def report(self):
+        if not self.raw: return "no compressed data"
+        return (f"{self.raw} B -> {self.out} B ({self.out/self.raw:.0%}), "
+                f"{self.cpu*1000:.1f} ms CPU ({self.raw/max(self.cpu,1e-9)/1e6:.0f} MB/s)")
+
+class FrameError(ValueError):
+    """Frame vượt giới hạn kích thước – luồng không còn tin được, nên ngắt."""
+
+class Decoder:
+    """Tách luồng byte thành ("line", str), ("bin", tid, seq, payload) hoặc,
+    với frame v2, ("bin", tid, offset, payload, crc32). raw=True (client):
+    frame raw trả về dần dạng ("raw", tid, mẩu dữ liệu), không giới hạn max_frame.
+    Frame nén được giải nén tại chỗ; phần giải nén cũng chịu max_line / max_frame.
+
+    Làm việc trên bytes: dữ liệu nối vào một bytearray, vị trí đã đọc chỉ là
+    offset, phần đã xử lý bị xoá một lần mỗi feed(); các dòng liền nhau được
+    decode một lượt rồi mới tách. Chỉ decode khi đã đủ dòng, nên ký tự UTF-8
+    bị tách giữa hai lần recv vẫn đúng ("\\n" không nằm trong ký tự nhiều byte).
+    Dòng dài quá max_line hoặc payload lớn hơn max_frame -> FrameError.
+    """
+    def __init__(self, max_line=MAX_LINE, max_frame=MAX_FRAME, raw=False):
+        self.buf, self.pos, self.scan = bytearray(), 0, 0
+        self.max_line, self.max_frame = max_line, max_frame
+        self.raw, self.rtid, self.left = raw, 0, 0  # frame raw đang đọc dở: tid, số byte còn lại
+        self.zd = None                              # luồng giải nén, tạo khi gặp frame nén đầu tiên
+        self.zwin = bytearray()                     # phần giải nén gần nhất (>= ZWIN byte nếu có)
+
+    def __getstate__(self):
+        d = {k: v for k, v in self.__dict__.items() if k != "zd"}
+        d["buf"], d["pos"], d["scan"] = self.buf[self.pos:], 0, self.scan - self.pos
+        d["zd"] = self.zd is not None
+        return d
+
+    def __setstate__(self, d):
+        # process mới: luồng giải nén raw với từ điển là cửa sổ cuối của luồng cũ
+        self.__dict__.update(d)
+        if d["zd"]: self.zd = zlib.decompressobj(-15, zdict=bytes(self.zwin[-ZWIN:]))
+        else: self.zd = None
+
+    def feed(self, data):
+        buf = self.buf
+        if self.pos:                            # bỏ phần đã trả về ở lần trước
+            del buf[:self.pos]
+            self.scan -= self.pos; self.pos = 0
+        buf += data
+        while self.pos < len(buf):
+            pos = self.pos
+            if self.left:                           # giữa frame raw: trả phần đã tới
+                end = min(len(buf), pos + self.left)
+                with memoryview(buf) as mv:
+                    piece = bytes(mv[pos:end])
+                self.left -= end - pos
+                self.pos = self.scan = end
+                yield ("raw", self.rtid, piece); continue
+            if buf[pos] == BIN:
+                if len(buf) - pos < FRAME.size: return
+                _m, tid, seq, n = FRAME.unpack_from(buf, pos)
+                if tid & RAW and self.raw:
+                    self.rtid, self.left = tid ^ RAW, n
+                    self.pos = self.scan = pos + FRAME.size; continue
+                if n > self.max_frame: raise FrameError(f"frame of {n} B")
+                head = pos + FRAME.size + (OFFSET.size if tid & V2 else 0)
+                end = head + n
+                if len(buf) < end: return
+                if tid == ZIP:                      # thay frame bằng phần giải nén rồi đọc tiếp
+                    self.zd = self.zd or zlib.decompressobj()
+                    try: data = self.zd.decompress(buf[head:end], self.max_line + self.max_frame)
+                    except zlib.error as e: raise FrameError(f"bad compressed frame: {e}")
+                    if self.zd.unconsumed_tail: raise FrameError("compressed frame too large")
+                    self.zwin += data
+                    if len(self.zwin) > 2 * ZWIN: del self.zwin[:-ZWIN]
+                    buf[pos:end] = data
+                    self.scan = pos; continue
+                with memoryview(buf) as mv:
+                    payload = bytes(mv[head:end])
+                self.pos = self.scan = end
+                if tid & V2:
+                    yield ("bin", tid ^ V2, OFFSET.unpack_from(buf, pos + FRAME.size)[0], payload, seq)
+                else:
+                    yield ("bin", tid, seq, payload)
+            else:
+                end = buf.find(b"\n", max(pos, self.scan))
+                if end < 0:
+                    if len(buf) - pos > self.max_line: raise FrameError("line too long")
+                    self.scan = len(buf); return    # lần sau chỉ tìm phần mới
+                if end - pos >= LONG:               # dòng dài: decode riêng
+                    line = buf[pos:end].decode(ENC, "replace")
+                    self.pos = self.scan = end + 1
+                    yield ("line", line); continue
+                end = buf.rfind(b"\n", end)        # dòng ngắn: gom cả loạt phía sau
+                z = buf.find(b"\0", pos, end)      # dừng trước frame nhị phân kế tiếp
+                if z >= 0:
+                    end = buf.rfind(b"\n", pos, z)
+                    if end < 0: end = buf.find(b"\n", z)   # byte 0 nằm giữa dòng
+                lines = buf[pos:end].decode(ENC, "replace").split("\n")
+                self.pos = self.scan = end + 1
+                for line in lines: yield ("line", line)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token bucket cho giới hạn tốc độ của server (server.py --limit).
+
+Bucket nạp `rate` token mỗi giây, giữ tối đa `burst`. allow() chỉ lấy khi đủ
+token – dòng chat / lệnh vượt mức bị từ chối; check() chỉ xem, không lấy, để
+người gọi xét mọi bucket của một dòng trước rồi mới trừ. take() luôn lấy và cho phép
+âm – byte file không bỏ được, người gọi ngừng đọc từ người gửi đúng số giây
+trả về cho tới khi trả hết nợ. Limiter giữ một bucket cho mỗi khoá (tên user
+hoặc tên phòng) của một loại giới hạn; bucket đã đầy lại (không ai dùng) bị
+dọn khi bảng lớn, nên bảng không phình theo số user từng thấy.
+"""
+
+import time
+from metrics import TimedLock
+
+class Bucket:
+    __slots__ = ("rate", "burst", "level", "t")
+
+    def __init__(self, rate, burst, now):
+        self.rate, self.burst = rate, burst
+        self.level, self.t = burst, now
+
+    def fill(self, now):
+        self.level = min(self.burst, self.level + (now - self.t) * self.rate)
+        self.t = now
+
+    def allow(self, n, now):
+        """0 nếu đủ (đã trừ n), nếu không: số giây tới khi đủ."""
+        self.fill(now)
+        if self.level >= n:
+            self.level -= n; return 0.0
+        return (n - self.level) / self.rate
+
+    def check(self, n, now):
+        """Như allow() nhưng không trừ."""
+        self.fill(now)
+        return 0.0 if self.level >= n else (n - self.level) / self.rate
+
+    def take(self, n, now):
+        """Trừ n, có thể thành âm; trả về số giây để trả hết nợ."""
+        self.fill(now)
+        self.level -= n
+        return -self.level / self.rate if self.level < 0 else 0.0
+
+
+class Limiter:
+    """Bucket theo khoá cho một loại giới hạn; rate 0 = tắt (luôn cho phép)."""
+    SWEEP = 4096                                    # dọn bucket đầy khi bảng lớn hơn
+
+    def __init__(self, name, rate, burst=0):
+        self.rate, self.burst = rate, burst or 2 * rate
+        self.lock, self.buckets = TimedLock(name), {}
+
+    def bucket(self, key, now):
+        # gọi khi đang giữ lock
+        b = self.buckets.get(key)
+        if b is None:
+            if len(self.buckets) >= self.SWEEP: self.sweep(now)
+            b = self.buckets[key] = Bucket(self.rate, self.burst, now)
+        return b
+
+    def sweep(self, now):
+        full = [k for k, b in self.buckets.items() if b.level + (now - b.t) * b.rate >= b.burst]
+        for k in full: del self.buckets[k]
+
+    def allow(self, key, n=1):
+        if not self.rate: return 0.0
+        now = time.monotonic()
+        with self.lock:
+            return self.bucket(key, now).allow(n, now)
+
+    def check(self, key, n=1):
+        if not self.rate: return 0.0
+        now = time.monotonic()
+        with self.lock:
+            return self.bucket(key, now).check(n, now)
+
+    def take(self, key, n):
+        if not self.rate: return 0.0
+        now = time.monotonic()
+        with self.lock:
+            return self.bucket(key, now).take(n, now)
+
+    def rename(self, old, new):
+        with self.lock:
+            b = self.buckets.pop(old, None)
+            if b: self.buckets[new] = b
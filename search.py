@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chỉ mục ngược cho /search trên lịch sử một phòng.
+
+Mỗi từ (chữ thường, \\w+ nên có cả tiếng Việt) -> danh sách id tăng dần của
+các message đang nằm trong History. id được cấp tăng dần nên thêm là append;
+message bị đẩy khỏi ring luôn là id nhỏ nhất của mọi từ trong nó, nên bỏ nó
+chỉ là tăng con trỏ đầu danh sách (cắt bớt khi phần chết quá nửa); /recall
+xoá đúng id đó (tìm nhị phân). Tìm: tìm nhị phân tới trang cần xem rồi đi
+ngược trên danh sách ngắn nhất, kiểm tra các từ còn lại bằng tìm nhị phân –
+chi phí theo số kết quả trả về, không theo độ dài lịch sử. Mỗi lần tìm xét
+tối đa SCAN ứng viên; chưa đủ trang thì trả về con trỏ để tìm tiếp.
+"""
+
+import re
+from bisect import bisect_left
+
+WORD = re.compile(r"\w+")
+TAG = re.compile(r"\[\w+ #\d+\] ")                  # "[MSG #12] " đầu dòng
+SCAN = 50_000                                       # ứng viên tối đa mỗi lần tìm
+
+def body(line):
+    """Phần nội dung của một dòng lịch sử (bỏ "người gửi: " và phần trích của reply)."""
+    return line.split('»: ', 1)[-1] if '»: ' in line else line.split(': ', 1)[-1]
+
+def words(text):
+    return set(WORD.findall(text.casefold()))
+
+def terms(line):
+    return words(TAG.sub("", body(line)))
+
+
+class Index:
+    __slots__ = ("ids", "head")
+
+    def __init__(self):
+        self.ids, self.head = {}, {}                # từ -> [id tăng dần]; từ -> vị trí phần tử sống đầu
+
+    def add(self, mid, line):
+        for t in terms(line):
+            lst = self.ids.get(t)
+            if lst is None: self.ids[t], self.head[t] = [mid], 0
+            else: lst.append(mid)
+
+    def evict(self, mid, line):
+        """mid vừa bị đẩy khỏi History (luôn là id cũ nhất còn lại)."""
+        for t in terms(line):
+            lst = self.ids.get(t)
+            if lst is None: continue
+            h = self.head[t]
+            while h < len(lst) and lst[h] <= mid: h += 1
+            self.trim(t, lst, h)
+
+    def remove(self, mid, line):
+        """mid bị /recall: bỏ khỏi mọi từ của nội dung cũ."""
+        for t in terms(line):
+            lst = self.ids.get(t)
+            if lst is None: continue
+            h = self.head[t]
+            i = bisect_left(lst, mid, h)
+            if i < len(lst) and lst[i] == mid: del lst[i]
+            self.trim(t, lst, h)
+
+    def trim(self, t, lst, h):
+        if h >= len(lst):
+            del self.ids[t], self.head[t]
+        elif h > 64 and 2 * h > len(lst):           # phần chết quá nửa: cắt bỏ
+            del lst[:h]; self.head[t] = 0
+        else: self.head[t] = h
+
+    def find(self, query, before=None, n=20, ok=None):
+        """(id mới -> cũ có đủ mọi từ trong query, id < before, ok(id) đúng;
+        con trỏ before cho trang sau hoặc None nếu đã hết)."""
+        ws = words(query)
+        if not ws or any(w not in self.ids for w in ws): return [], None
+        lists = sorted(((self.ids[w], self.head[w]) for w in ws), key=lambda p: len(p[0]) - p[1])
+        (lst, h), rest = lists[0], lists[1:]
+        i = len(lst) if before is None else bisect_left(lst, before, h)
+        out, stop = [], max(h, i - SCAN)
+        while i > stop and len(out) < n:
+            i -= 1; mid = lst[i]
+            if all((j := bisect_left(o, mid, oh)) < len(o) and o[j] == mid for o, oh in rest) \
+               and (ok is None or ok(mid)):
+                out.append(mid)
+        return out, (lst[i] if i > h else None)
@@ -4,76 +4,652 @@
 Server v18-fix – đầy đủ lệnh menu / friend + forward, file-limit, cleanup.
 """
 
-import socket, threading, datetime, json, sys
+import socket, threading, selectors, argparse, datetime, json, sys, os, base64, itertools, time, signal, secrets
+import subprocess, tempfile, re, heapq, traceback
 from collections import deque
+from proto import Decoder, FrameError, CAPS, Deflater, pack_frame, pack_chunk, raw_head, need_ranges, NEED_MAX
+from outbox import Outbox, FileSpan, DROP, PAUSE, KILL, POLICIES
+from blobs import Blobs, SHA
+from state import State, Room, Social, Sessions, Presence
+from store import Store
+from search import body
+from journal import Journal
+from bus import Bus, Hub
+from metrics import M, TimedLock, COUNTS, serve as serve_metrics
+from ratelimit import Limiter
+from wheel import Wheel
+import handoff
 
 HOST, PORT, ENC = '127.0.0.1', 12345, 'utf-8'
+MODE = "loop"                  # "loop" (selectors) | "thread" (thread-per-client)
+WORKERS = 1                    # >1: nhiều process worker chung cổng (SO_REUSEPORT)
 MAX_MB = 50                    # giới hạn kích thước upload
+BLOB_DAYS = 7                  # kho file (--blobs): ngày giữ file kể từ lần tải cuối …
+BLOB_MB = 2048                 # … và tổng dung lượng (MB), quá thì xoá file ít dùng nhất
+ACK_EVERY = 64 * 1024          # byte giữa hai gói file_ack gửi về sender (cap "xfer")
+HISTORY_CAP = 1000             # số message giữ trong RAM mỗi phòng
+JOIN_REPLAY = 50               # số message gửi lại khi /join (/more để xem tiếp)
+SEARCH_PAGE = 20               # kết quả mỗi trang /search
+OUT_MAX_MSGS = 4096            # hàng đợi gửi mỗi kết nối: số message …
+OUT_MAX_KB   = 4096            # … và số KB
+POLICY = {"chat": DROP, "file": PAUSE, "ctl": KILL}   # xử lý khi hàng đợi đầy
+RESUME_TTL = 300               # giây giữ phiên sau khi rớt mạng (resume bằng token)
+PAUSE_MAX = 30                 # giây tối đa relay file chờ một consumer chậm
+WRITE_MAX = 256*1024           # byte tối đa mỗi lần ghi socket
+FLUSH_MS = 1                   # gom các message nhỏ tới cùng socket trong cửa sổ này
+PRESENCE_MS = 250              # gom thông báo bạn bè online/offline theo người nhận (0 = gửi ngay)
+ZLEVEL = 1                     # mức nén zlib cho client có cap "zlib" (0 = không nén; bench/compress.py)
+METRICS = 0                    # cổng HTTP /metrics trên 127.0.0.1 (0 = tắt); worker i dùng cổng + i
+LIMITS = {"msg": (20, 40), "cmd": (30, 60), "file_kb": (32768, 65536),   # mỗi user: (mỗi giây, burst)
+          "room_msg": (200, 400), "room_file_kb": (65536, 131072)}       # mỗi phòng, trên mỗi worker
+MAX_CONNS = 0                  # kết nối đồng thời mỗi worker (0 = không giới hạn)
+MAX_TRANSFERS = 256            # upload đang relay mỗi worker …
+MAX_USER_TRANSFERS = 4         # … và của một user
+LOGIN_TIMEOUT = 300            # giây từ lúc kết nối tới khi login xong (0 = không hạn)
+PING = 30                      # cap "ping": giây không nhận được byte nào thì gửi ping (0 = tắt)
+DEAD = 90                      # … và sau chừng này giây im lặng thì coi như đã chết, đóng
+IDLE = 0                       # client không có cap "ping": giây im lặng trước khi đóng (0 = không đóng)
+BEAT_BATCH = 256               # kết nối xét mỗi lượt heartbeat; còn nữa thì lượt sau, sau một vòng select
 
 # ────────── trạng thái toàn cục ──────────
-clients, user_rooms = {}, {}
-rooms = {"room1": [], "room2": [], "room3": []}
-msg_id   = {r: 1 for r in rooms}
-history  = {r: deque(maxlen=1000) for r in rooms}   # (id, sender, line)
-pins     = {r: [] for r in rooms}                   # (pin_no, id, line)
-pin_no   = {r: 1 for r in rooms}
-active   = {}                                       # (sock,fname)->{'rec':…}
-
-friends, blocks, pending = {}, {}, {}               # friend system
-lock = threading.Lock()
+# Không còn lock toàn cục: State (user/phòng), mỗi Room, Social (bạn bè) và
+# bảng file-transfer có lock riêng, không bao giờ gửi mạng khi đang giữ lock.
+st = State(["room1", "room2", "room3"], HISTORY_CAP) # user<->sock, phòng -> Room
+clients, user_rooms, rooms = st.clients, st.user_rooms, st.rooms
+social   = Social()                                 # friends / blocks / pending
+presence = Presence()                               # thông báo online/offline chờ gửi
+active   = {}                                       # (sock,key)->{'rec':…}, key = xid hoặc tên file
+remote   = {}                                       # (sender,key)->{'rec':…} file từ worker khác
+tids     = {}                                       # (sock,tid của sender)->key
+held     = {}                                       # xid -> (sender, tr, hạn): sender rớt mạng giữa chừng
+needs    = {}                                       # (sender, xid) -> {'to': {người nhận: lần xin bù còn lại}, …}
+ft_lock  = TimedLock("ft")                          # bảo vệ active / tids / remote / held / needs
+tid_seq  = itertools.count(1)                       # tid toàn cục khi relay
+caps     = {}                                       # sock -> capability đã thoả thuận
+blobs    = None                                     # kho file theo sha256 (--blobs)
+io_done  = [0, 0]                                   # frames, writes của kết nối đã đóng
+zip_done = [0, 0, 0.0]                              # byte vào / ra, giây CPU nén của kết nối đã đóng
+stats_lock = threading.Lock()
+sessions = Sessions(RESUME_TTL)                     # token -> phiên (cap "resume")
+lim      = {}                                       # loại giới hạn -> Limiter (set_limits)
+beats    = Wheel()                                  # hạn login / ping / chết của mọi kết nối
+reaped   = {"login": 0, "dead": 0, "idle": 0}       # kết nối bị đóng vì quá hạn, theo lý do
+due, reap_logged = deque(), 0                       # kết nối tới hạn chưa xét; tổng reaped đã in
 
 # ────────── helpers ──────────
 def ts(fmt="[%H:%M:%S]"): return datetime.datetime.now().strftime(fmt)
-def safe(sock, data):
-    try: sock.sendall(data if isinstance(data,bytes) else data.encode(ENC))
-    except: pass
+if hasattr(socket.socket, "sendmsg"):
+    def sendv(sock, bufs):                      # một syscall cho cả lô, không nối buffer
+        return sock.sendmsg(bufs)
+else:                                           # Windows: không có sendmsg
+    def sendv(sock, bufs):
+        return sock.send(b"".join(bufs))
+def sendout(sock, bufs):
+    # đoạn file trong kho đi thẳng từ đĩa ra socket, còn lại ghi vector
+    if type(bufs[0]) is FileSpan: return bufs[0].send(sock, WRITE_MAX)
+    return sendv(sock, bufs)
+def io_stats():
+    with stats_lock:
+        f, w = io_done
+    for c in list(conns.values()):
+        f += c.out.frames; w += c.out.writes
+    return f, w
+def zip_stats():
+    with stats_lock:
+        r, o, cpu = zip_done
+    for c in list(conns.values()):
+        z = c.out.z
+        if z: r += z.raw; o += z.out; cpu += z.cpu
+    return r, o, cpu
+def safe(sock, data, kind="ctl", zip=None):
+    # chỉ xếp vào hàng đợi của kết nối, không bao giờ chặn người gọi
+    c = conns.get(sock)
+    if not c: return KILL
+    res = c.out.put(data.encode(ENC) if isinstance(data,str) else data, kind, zip)
+    if res == KILL: kill(sock)
+    return res
 def bc(room, line, exc=None):
-    with lock: rec = list(rooms.get(room, []))
+    t = time.perf_counter()
+    rec = st.members(room)
+    data = (line + "\n").encode(ENC)
+    n = lost = 0
     for c in rec:
-        if c is not exc: safe(c, line + "\n")
-def bc_pkt(pkt, rec, exc=None):
+        if c is not exc:
+            n += 1
+            if safe(c, data, "chat") == DROP: lost += 1
+    lab = (("room", room),)
+    M.inc("chat_room_messages_out_total", n, lab); M.inc("chat_room_bytes_out_total", n*len(data), lab)
+    if lost: M.inc("chat_room_dropped_total", lost, lab)
+    M.observe("chat_broadcast_fanout", n, BC); M.observe("chat_broadcast_seconds", time.perf_counter()-t, BC)
+def bc_pkt(pkt, rec, exc=None, kind="ctl"):
+    if not rec: return []
+    t = time.perf_counter()
     data = (json.dumps(pkt) + "\n").encode(ENC)
-    for c in rec:
-        if c is not exc: safe(c, data)
+    slow = [c for c in rec if c is not exc and safe(c, data, kind) == PAUSE]
+    M.observe("chat_broadcast_fanout", len(rec), BC_PKT); M.observe("chat_broadcast_seconds", time.perf_counter()-t, BC_PKT)
+    return slow
+def set_limits():
+    for k, (rate, burst) in LIMITS.items():
+        u = 1024 if k.endswith("_kb") else 1    # bucket byte file tính bằng byte
+        lim[k] = Limiter(f"limit_{k}", rate * u, burst * u)
+set_limits()
+LIMIT_MSG = {"msg": "too many messages", "cmd": "too many commands", "room_msg": "room is busy"}
+def charge(checks):
+    # checks: ((loại, khoá), …); xem mọi bucket trước, chỉ trừ khi tất cả còn token:
+    # dòng bị phòng bận từ chối không tốn token của chính user. (loại, giây chờ) nếu vượt.
+    for kind, key in checks:
+        w = lim[kind].check(key)
+        if w:
+            M.inc("chat_rate_limited_total", 1, (("kind", kind),))
+            return kind, w
+    for kind, key in checks: lim[kind].take(key, 1)
+    return None
+def over(cli, checks):
+    # True nếu vượt mức. Báo client một lần mỗi đợt bị chặn.
+    hit = charge(checks)
+    if hit:
+        kind, w = hit
+        c, now = conns.get(cli), time.monotonic()
+        if c and now >= c.warned:
+            c.warned = now + w
+            safe(cli, f"{ts()} Rate limit: {LIMIT_MSG[kind]}, wait {w:.1f}s.\n")
+        return True
+    return False
+def file_rate(sock, n):
+    # byte file vượt hạn mức user / phòng: ngừng đọc từ người gửi tới khi trả hết nợ
+    room = user_rooms.get(sock)
+    w = max(lim["file_kb"].take(clients.get(sock), n), lim["room_file_kb"].take(room, n) if room else 0.0)
+    if w <= 0: return
+    M.inc("chat_rate_limited_total", 1, (("kind", "file"),))
+    if MODE != "loop":
+        time.sleep(min(w, PAUSE_MAX)); return   # thread đọc của chính người gửi
+    c = conns.get(sock)
+    if c and not c.hold:
+        c.hold = True; set_interest(c)
+        later(min(w, PAUSE_MAX), lambda: loop_unhold(c))
+def keepalive(sock):
+    # client không có cap "ping" (và half-open khi đang gửi): kernel bỏ kết nối sau khoảng DEAD giây
+    if not DEAD: return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(DEAD / 2)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(DEAD / 6)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        if hasattr(socket, "TCP_USER_TIMEOUT"):  # dữ liệu gửi đi không được ack
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(DEAD * 1000))
+    except OSError: pass
+def refuse(sock):
+    # quá MAX_CONNS: báo rồi đóng ngay, không tạo Conn
+    M.inc("chat_admission_rejected_total", 1, (("what", "connection"),))
+    try: sock.send(b"Server full, try again later.\n")
+    except OSError: pass
+    sock.close()
 def snippet(line, n=60):
-    txt = line.split('»: ',1)[-1] if '»: ' in line else line.split(': ',1)[-1]
+    txt = body(line)
     return (txt[:n] + "…") if len(txt) > n else txt
 def notify_friend(name, online=True):
-    msg = f"[Friend] {name} is now " + ("online" if online else "offline")
-    with lock:
-        for c,u in clients.items():
-            if name in friends.get(u,set()):
-                safe(c, msg + "\n")
+    # chỉ bạn của name (chỉ mục ngược) đang ở worker này; gom trong PRESENCE_MS
+    fans = [u for u in social.fans(name) if st.sock_of(u)]
+    if not fans: return
+    if not PRESENCE_MS:
+        msg = presence_line([(name, online)])
+        for u in fans:
+            c = st.sock_of(u)
+            if c: safe(c, msg, "chat")
+        M.inc("chat_presence_lines_total", len(fans))
+    elif presence.add(name, online, fans):
+        later(PRESENCE_MS/1000, flush_presence)
+def flush_presence():
+    n = 0
+    for u, ch in presence.take().items():
+        c = st.sock_of(u)
+        if c: safe(c, presence_line(ch), "chat"); n += 1
+    M.inc("chat_presence_lines_total", n)
+def presence_line(ch):
+    if len(ch) == 1:
+        n, on = ch[0]
+        return f"[Friend] {n} is now {'online' if on else 'offline'}\n".encode(ENC)
+    part = lambda on: ", ".join(n for n, o in ch if o == on)
+    return ("[Friend] " + "; ".join(f"{k}: {part(on)}" for k, on in (("online", True), ("offline", False))
+                                    if part(on)) + "\n").encode(ENC)
+
+# ────────── metrics (metrics.py) ──────────
+# Đếm ở đường nóng (ghi vào shard của thread, không khoá); các số đã có sẵn ở
+# nơi khác (hàng đợi, nén, bảng transfer) chỉ được đọc khi scrape.
+BC, BC_PKT = (("fn", "bc"),), (("fn", "bc_pkt"),)
+M.define("chat_room_messages_in_total", "counter", "Messages posted to a room by users of this worker.")
+M.define("chat_room_bytes_in_total", "counter", "Bytes of message text posted to a room.")
+M.define("chat_room_messages_out_total", "counter", "Room lines queued to recipients.")
+M.define("chat_room_bytes_out_total", "counter", "Bytes of room lines queued to recipients.")
+M.define("chat_room_dropped_total", "counter", "Room lines dropped because the recipient was too slow.")
+M.define("chat_broadcast_fanout", "histogram", "Recipients per broadcast.", COUNTS)
+M.define("chat_broadcast_seconds", "histogram", "Time to encode and enqueue one broadcast.")
+M.define("chat_command_seconds", "histogram", "Time to handle one command or chat line.")
+M.define("chat_connections_opened_total", "counter", "Accepted connections.")
+M.define("chat_connections_closed_total", "counter", "Closed connections.")
+M.define("chat_connections_killed_total", "counter", "Connections closed by the server (send queue overflow or failed write).")
+M.define("chat_connections_reaped_total", "counter", "Connections closed for a missed login, heartbeat or idle deadline.")
+M.define("chat_logins_total", "counter", "Successful logins.")
+M.define("chat_rate_limited_total", "counter", "Lines refused or file reads held by a rate limit.")
+M.define("chat_admission_rejected_total", "counter", "Connections or uploads refused by admission control.")
+M.define("chat_presence_lines_total", "counter", "Friend online/offline lines queued (one per recipient per window).")
+M.define("chat_connections", "gauge", "Open connections.", fn=lambda: len(conns))
+M.define("chat_users_online", "gauge", "Logged-in users on this worker.", fn=lambda: len(clients))
+M.define("chat_file_transfers", "gauge", "File transfers in progress.",
+         fn=lambda: [((("state", k),), len(v)) for k, v in (("active", active), ("held", held), ("remote", remote))])
+M.define("chat_file_transfer_bytes", "gauge", "Bytes relayed so far by transfers in progress.",
+         fn=lambda: sum(tr['off'] for tr in list(active.values())))
+M.define("chat_file_bytes_relayed_total", "counter", "File payload bytes received from senders.")
+M.define("chat_file_bytes_out_total", "counter", "File frame bytes queued to receivers.")
+M.define("chat_output_messages_total", "counter", "Buffers written to sockets.", fn=lambda: io_stats()[0])
+M.define("chat_output_writes_total", "counter", "Socket write calls.", fn=lambda: io_stats()[1])
+M.define("chat_zlib_bytes_in_total", "counter", "Bytes before compression.", fn=lambda: zip_stats()[0])
+M.define("chat_zlib_bytes_out_total", "counter", "Bytes after compression.", fn=lambda: zip_stats()[1])
+M.define("chat_zlib_cpu_seconds_total", "counter", "CPU time spent compressing.", fn=lambda: round(zip_stats()[2], 6))
+
+# ────────── op dùng chung (một process hoặc --workers) ──────────
+# Mọi thay đổi trạng thái dùng chung (phòng, lịch sử, pin, bạn bè, ai online ở
+# phòng nào) và mọi thứ gửi tới người có thể ở worker khác đi qua emit().
+# Một process: áp dụng ngay. --workers: gửi lên hub (bus.py), hub phát lại theo
+# một thứ tự duy nhất, mỗi worker áp dụng cùng dãy op -> id message khớp nhau.
+# Các hàm on_* chỉ gửi tới socket của chính worker đang chạy chúng.
+WID = 0                                             # số thứ tự worker (0 nếu 1 process)
+bus = None
+
+def emit(op, *args, wait=False):
+    """wait=True: chờ op được áp dụng rồi trả về kết quả của on_<op>."""
+    if bus is None: return OPS[op](*args)
+    return bus.send(op, args, wait)
+
+def on_online(name, wid):
+    if not st.claim(name, wid): return False
+    social.ensure(name)
+    notify_friend(name, True)
+    return True
+
+def on_offline(name, room, wid):
+    if not st.owns(name, wid): return           # tên đã sang kết nối mới (resume)
+    st.release(name)
+    notify_friend(name, False)
+    with ft_lock:
+        for k in [k for k in remote if k[0] == name and not remote[k]['xid']]: del remote[k]
+    if room: bc(room, f"{ts()} **{name} disconnected.**")
+
+def on_rename(old, new):
+    if not st.rename_dir(old, new): return False
+    if not social.rename(old, new):             # tên của user offline còn dữ liệu bạn bè
+        st.rename_dir(new, old); return False
+    sessions.rename(old, new)
+    for k in ("msg", "cmd", "file_kb"): lim[k].rename(old, new)
+    return True
+
+def on_say(room, line, exc=None):
+    bc(room, line, exc=st.sock_of(exc) if exc else None)
+
+def on_post(room, sender, tag, body):
+    r = st.room(room)
+    if not r: return None
+    mid, line = r.post(sender, lambda mid: f"[{tag} #{mid}] {body}")
+    if bus is None or st.sock_of(sender):       # chỉ worker của người gửi đếm phần vào
+        lab = (("room", room),)
+        M.inc("chat_room_messages_in_total", 1, lab); M.inc("chat_room_bytes_in_total", len(body.encode(ENC)), lab)
+    bc(room, line)
+    return mid
+
+def on_recall(room, mid, usr):
+    r = st.room(room)
+    if r and not r.recall(mid, usr): bc(room, f"[MSG #{mid}] (recalled)")
+
+def on_pin(room, mid, usr):
+    r = st.room(room)
+    no = r.pin(mid) if r else None
+    if no is not None: bc(room, f"{ts()} **{usr} pinned message #{mid} (pin {no})**")
+
+def on_unpin(room, no, usr):
+    r = st.room(room)
+    if r and r.unpin(no): bc(room, f"{ts()} **{usr} unpinned item {no}**")
+
+def on_create(room):
+    return st.create(room) is not None
+
+def on_delete(room):
+    members = st.delete(room)
+    if members is None: return False
+    note = f"{ts()} Room '{room}' deleted\n".encode(ENC)
+    for c in members: safe(c, note)
+    return True
+
+def on_social(meth, *a):
+    return getattr(social, meth)(*a)
+
+def on_deliver(names, data, kind="ctl"):
+    for n in names:
+        c = st.sock_of(n)
+        if c: safe(c, data, kind)
+
+def on_pm(sender, to, data):
+    for c in st.named(to, sender, social):
+        if clients.get(c) != sender: safe(c, data, "chat")
+
+def on_down(wid):
+    # worker wid chết: người dùng của nó coi như offline, phiên được giữ để resume
+    gone = st.drop_worker(wid)
+    for t, n in sessions.of_worker(wid):
+        if n in gone: sessions.park(t, n, gone[n])
+    for n in gone: notify_friend(n, False)
+
+def on_sess_claim(token):
+    got = sessions.claim(token)
+    if not got: return None
+    kind, v = got
+    if kind == "parked": return v
+    wid, name = v                               # kết nối cũ đã chết nhưng server chưa biết
+    if wid == WID:
+        old = next((c for c in conns.values() if c.token == token), None)
+        if old:
+            old.token = None                    # không park lại phiên cũ
+            disconnect(old.sock, quiet=True)
+            try: old.sock.shutdown(socket.SHUT_RDWR)    # thread mode: thread đọc thoát recv
+            except OSError: pass
+    return name, st.release(name)               # tên được giải phóng ngay trên mọi worker
+
+def on_ft_open(sender, room, to, p, store=False):
+    tr = new_tr(st.recipients(room, to, sender, social), p, store)
+    with ft_lock:
+        remote[(sender, ft_key(p))] = tr
+        track_need(sender, tr, p)
+    relay_pkt(None, tr, p)
+
+def on_ft_json(sender, p):
+    tr = remote.get((sender, ft_key(p)))
+    if tr: bc_pkt(p, tr['rec'], kind="file")
+
+def on_ft_data(sender, key, seq, payload, crc=None):
+    tr = remote.get((sender, key))
+    if tr and 'tid' in tr: relay_frame(None, tr, sender, seq, payload, crc)
+
+def on_ft_close(sender, p):
+    with ft_lock:
+        tr = remote.pop((sender, ft_key(p)), None)
+        end_need(sender, p.get("xid"))
+    if tr: relay_pkt(None, tr, p)
+
+def on_blob(room, to, sender, meta):
+    # file đã vào kho: mỗi worker gửi từ đĩa cho người nhận có cap "blob" của nó
+    me = st.sock_of(sender)
+    for c in st.recipients(room, to, sender, social):
+        if c is not me and "blob" in caps.get(c,()) and not social.blocked(clients.get(c), meta["from"]):
+            send_blob(c, meta)
+
+OPS = {"online":on_online, "offline":on_offline, "rename":on_rename, "move":st.move,
+       "say":on_say, "post":on_post, "recall":on_recall, "pin":on_pin, "unpin":on_unpin,
+       "create":on_create, "delete":on_delete, "social":on_social, "deliver":on_deliver,
+       "pm":on_pm, "down":on_down, "ft_open":on_ft_open, "ft_json":on_ft_json,
+       "ft_data":on_ft_data, "ft_close":on_ft_close, "blob":on_blob, "sess_claim":on_sess_claim,
+       "sess_open":sessions.open, "sess_park":sessions.park, "sess_end":sessions.end}
+
+def apply(op, args):
+    return OPS[op](*args)
 
 # ────────── file-transfer ──────────
+# Người nhận cùng worker được relay trực tiếp; ở chế độ --workers các gói file
+# còn được gửi qua bus (chỉ tới worker khác) để on_ft_* relay cho người nhận ở đó.
+# Cap "xfer": transfer có xid + sha256, chunk mang offset + crc32; server ack
+# offset liên tục đã relay, giữ transfer khi sender rớt mạng để nó gửi tiếp
+# (file_resume), và chuyển file_need (đoạn người nhận còn thiếu) về sender.
+# Có kho (--blobs): upload "xfer" được ghi vào kho; người nhận có cap "blob"
+# không nhận relay mà nhận từ kho khi upload xong, người vào sau dùng /fetch,
+# /forward chỉ gửi lại tham chiếu sha256. Nội dung đã có trong kho và không ai
+# cần relay trực tiếp: server trả file_resume offset = size, sender bỏ qua dữ liệu.
+FILE_LINE = re.compile(r"(?:\[MSG #\d+\] \(FWD by .+?\) )*\[FILE #\d+\] (.+?) sent (.+) "
+                       r"\((\d+) B\) \[sha256 ([0-9a-f]{16})\]$")
+def name_list(v):
+    return isinstance(v, list) and all(isinstance(x, str) for x in v)
+
+def well_formed(t, p):
+    # gói file_* từ client, kiểm trước khi chạm tới p["filename"] / p["size"]
+    if not isinstance(p.get("filename"), str) or type(p.get("tid", 0)) is not int: return False
+    if t == "file_start":
+        return type(p.get("size")) is int and p["size"] >= 0 and (p.get("to") is None or name_list(p["to"]))
+    return t != "file_chunk" or isinstance(p.get("data"), str)
+
+def ft_key(p):
+    # gói bù (fill) cho từng người nhận chạy song song, không đè transfer gốc
+    key = p.get("xid") or p["filename"]
+    return f"{key}+{p.get('tid')}" if p.get("fill") else key
+
+def new_tr(rec, p, store=False):
+    if store: rec = [c for c in rec if "blob" not in caps.get(c,())]    # nhận từ kho khi xong
+    tr = {'rec': rec, 'name': p["filename"], 'xid': p.get("xid"), 'off': 0, 'acked': 0,
+          'z': bool(p.get("compress"))}       # sender đã thử: nội dung nén được
+    if "tid" in p:                              # sender dùng frame nhị phân
+        tr['tid'] = next(tid_seq)
+        tr['v2'] = [c for c in rec if "xfer" in caps.get(c,())]
+        tr['bin'] = [c for c in rec if "bin" in caps.get(c,()) and "xfer" not in caps.get(c,())]
+        tr['old'] = [c for c in rec if "bin" not in caps.get(c,())]
+    return tr
+
 def ft_start(sock, p):
     sender = clients[sock]
     fname, size, to = p["filename"], p["size"], p.get("to")
     if size > MAX_MB*1024*1024:
         safe(sock, f"File exceeds {MAX_MB} MB limit.\n"); return
-    with lock:
-        room = user_rooms[sock]
-        if not room:
-            safe(sock, "Join a room first.\n"); return
-        rec = [c for c,u in clients.items()
-               if (not to or u in to) and c in rooms[room]
-               and sender not in blocks.get(u,set())]
-        active[(sock,fname)] = {'rec': rec}
+    room = user_rooms.get(sock); r = st.room(room)
+    if not r:
+        safe(sock, "Join a room first.\n"); return
+    why = admit(sock, sender, room, p)
+    if why:
+        reject(sock, p, why); return
+    store = stores(sock, p)
+    tr = new_tr(st.recipients(room, to, sender, social), p, store)
+    key = ft_key(p)
+    ask = store and "blob" in caps.get(sock,())  # sender chờ trả lời: có thể bỏ qua dữ liệu
+    if store:
+        tr.update(room=room, to=to, sha=p["sha256"], size=size)
+        if ask and bus is None and not (tr['v2'] or tr['bin'] or tr['old']) and blobs.find(tr['sha']):
+            tr['off'] = size                    # đã có trong kho, không ai cần relay
+        else:
+            tr['up'] = blobs.upload(tr['sha'], size, f"{WID}-{tr['tid']}")
+    with ft_lock:
+        active[(sock,key)] = tr
+        if "tid" in p: tids[(sock,p["tid"])] = key
+        old = held.pop(tr['xid'], None) if tr['xid'] else None  # gửi lại từ đầu thay cho resume
+        track_need(sender, tr, p)
+        gone = expired()
+    if old and 'up' in old[1]: old[1]['up'].abort()
+    end_held(gone)
+    if not p.get("fill"):
+        tag = f" [sha256 {tr['sha'][:16]}]" if store else ""
+        emit("post", room, sender, "FILE", f"{sender} sent {fname} ({size} B){tag}")
+    if ask: safe(sock, json.dumps({"type":"file_resume","xid":tr['xid'],"offset":tr['off']})+"\n")
+    relay_pkt(sock, tr, p)
+    if bus: bus.send("ft_open", (sender, room, to, p, store), others=True)
 
-        fid = msg_id[room]; msg_id[room] += 1
-        line = f"[FILE #{fid}] {sender} sent {fname} ({size} B)"
-        history[room].append((fid, sender, line))
+def admit(sock, sender, room, p):
+    # None nếu nhận upload, nếu không: lý do. Dòng FILE cũng là một message vào phòng.
+    with ft_lock:
+        n, mine = len(active), sum(1 for k in active if k[0] is sock)
+    if n >= MAX_TRANSFERS: return "server busy, too many transfers"
+    if mine >= MAX_USER_TRANSFERS: return f"at most {MAX_USER_TRANSFERS} uploads at a time"
+    if not p.get("fill"):
+        hit = charge((("msg", sender), ("room_msg", room)))
+        if hit: return f"rate limit, {LIMIT_MSG[hit[0]]} (wait {hit[1]:.1f}s)"
+    return None
 
-    bc(room, line)
-    bc_pkt(p, rec, exc=sock)
+def reject(sock, p, why):
+    # client có caps nhận file_reject (huỷ upload đó); client cũ một dòng chữ
+    M.inc("chat_admission_rejected_total", 1, (("what", "transfer"),))
+    if sock in caps:
+        safe(sock, json.dumps({"type":"file_reject","filename":p["filename"],"xid":p.get("xid"),
+                               "tid":p.get("tid"),"reason":why})+"\n")
+    else: safe(sock, f"{ts()} Upload {p['filename']} refused: {why}.\n")
+
+def stores(sock, p):
+    # chỉ lưu upload gửi frame v2 có xid + sha256 (client có cap "xfer"), không lưu gói bù;
+    # file gửi riêng cho @user không vào kho (/fetch, /forward không biết ai được xem)
+    return bool(blobs and p.get("xid") and "tid" in p and not p.get("fill") and not p.get("to")
+                and p["size"] <= blobs.max_bytes and "xfer" in caps.get(sock,()) and isinstance(p.get("sha256"), str)
+                and SHA.fullmatch(p["sha256"]))
+
+def file_meta(line):
+    """filename / size / sha256 (16 ký tự đầu) / from của một dòng FILE trong kho
+    (kể cả dòng đã /forward); None nếu dòng không phải file đã lưu."""
+    m = FILE_LINE.match(line)
+    return m and {"filename":m[2], "size":int(m[3]), "sha256":m[4], "from":m[1]}
+
+def send_blob(sock, meta):
+    # file_start (stored), một frame raw mà dữ liệu đi bằng sendfile, file_end
+    path = blobs.find(meta["sha256"]) if blobs else None
+    if not path: return False
+    size, tid = os.path.getsize(path), next(tid_seq)
+    head = dict(meta, type="file_start", size=size, sha256=os.path.basename(path),
+                xid=secrets.token_hex(8), tid=tid, stored=True)
+    safe(sock, json.dumps(head)+"\n", "file")
+    if size:
+        safe(sock, raw_head(tid, size), "file"); safe(sock, FileSpan(path, size), "file")
+    safe(sock, json.dumps({"type":"file_end","filename":head["filename"],"xid":head["xid"],
+                           "tid":tid})+"\n", "file")
+    return True
+
+def expired():
+    # gọi khi giữ ft_lock; trả về các transfer giữ quá hạn mà không ai resume
+    now = time.monotonic()
+    gone = [held.pop(x)[:2] for x in [x for x, h in held.items() if h[2] < now]]
+    for sender, tr in gone: end_need(sender, tr['xid'])
+    return gone
+
+def end_held(gone):
+    # báo kết thúc để người nhận tự xin phần thiếu (file_need) khi sender quay lại
+    for sender, tr in gone:
+        if 'up' in tr: tr['up'].abort()
+        p = {"type":"file_end","filename":tr['name'],"xid":tr['xid']}
+        relay_pkt(None, tr, p)
+        if bus: bus.send("ft_close", (sender, p), others=True)
+
+def ft_resume(sock, p):
+    # sender kết nối lại: gắn transfer đang giữ vào socket mới, trả offset đã relay
+    xid, tid, off = p.get("xid"), p.get("tid"), None
+    with ft_lock:
+        gone = expired()
+        h = held.get(xid)
+        if h and h[0] == clients[sock] and isinstance(tid, int):
+            tr = held.pop(xid)[1]; off = tr['off']
+            active[(sock,xid)] = tr; tids[(sock,tid)] = xid
+    end_held(gone)
+    safe(sock, json.dumps({"type":"file_resume","xid":xid,"offset":off})+"\n")
+
+def track_need(sender, tr, p):
+    # gọi khi giữ ft_lock: ghi ai (ở worker này) được xin gửi bù transfer xid của sender
+    if not tr['xid'] or p.get("fill"): return
+    now = time.monotonic()
+    for k in [k for k, n in needs.items() if n['until'] < now]: del needs[k]
+    needs[(sender, tr['xid'])] = {'to': {clients.get(c): NEED_MAX for c in tr['rec']},
+                                  'size': p["size"], 'until': float("inf")}
+
+def end_need(sender, xid):
+    # gọi khi giữ ft_lock: transfer xong, người nhận còn RESUME_TTL giây để xin phần thiếu
+    n = needs.get((sender, xid))
+    if n: n['until'] = time.monotonic() + RESUME_TTL
+
+def ft_need(sock, p):
+    # người nhận xin lại các đoạn thiếu / hỏng: chỉ người nhận của transfer đó,
+    # tối đa NEED_MAX lần, các đoạn đã gộp và cắt theo kích thước file
+    usr = clients[sock]
+    if over(sock, (("cmd", usr),)): return
+    to, xid = p.get("to"), p.get("xid")
+    with ft_lock:
+        n = needs.get((to, xid)) if isinstance(to, str) and isinstance(xid, str) else None
+        left = n['to'].get(usr, 0) if n and n['until'] >= time.monotonic() else 0
+        if left: n['to'][usr] = left - 1
+    if not left:
+        safe(sock, "Cannot re-request that file.\n"); return
+    ranges = need_ranges(p.get("ranges"), n['size'])
+    if not ranges: return
+    if not st.is_online(to):
+        safe(sock, "Sender offline, cannot re-request file.\n"); return
+    emit("deliver", [to], (json.dumps({"type":"file_need","xid":xid,"to":to,"ranges":ranges,
+                                       "from":usr})+"\n").encode(ENC))
+
+def relay_pkt(sock, tr, p):
+    if 'tid' not in tr:
+        throttle(sock, bc_pkt(p, tr['rec'], exc=sock, kind="file")); return
+    slow = bc_pkt(dict(p, tid=tr['tid']), tr['bin'] + tr['v2'], exc=sock, kind="file")
+    slow += bc_pkt({k:v for k,v in p.items() if k!="tid"}, tr['old'], exc=sock, kind="file")
+    throttle(sock, slow)
 
 def ft_chunk(sock, p):
-    rec = active.get((sock,p["filename"]),{}).get("rec",[])
-    bc_pkt(p, rec, exc=sock)
+    tr = active.get((sock,ft_key(p)))
+    if not tr: return
+    d = p["data"]                               # client cũ: base64, tính theo byte đã giải mã
+    n = len(d) * 3 // 4 - d[-2:].count("=")
+    M.inc("chat_file_bytes_relayed_total", n)
+    tr['off'] += n
+    file_rate(sock, n)
+    throttle(sock, bc_pkt(p, tr['rec'], exc=sock, kind="file"))
+    if bus: bus.send("ft_json", (clients.get(sock), p), others=True)
+
+def ft_frame(sock, tid, seq, payload, crc=None):
+    key = tids.get((sock,tid))
+    tr = active.get((sock,key))
+    if not tr or 'tid' not in tr: return
+    sender = clients.get(sock)
+    M.inc("chat_file_bytes_relayed_total", len(payload))
+    file_rate(sock, len(payload))
+    relay_frame(sock, tr, sender, seq, payload, crc)
+    if 'up' in tr and crc is not None: tr['up'].write(seq, payload)
+    if bus: bus.send("ft_data", (sender, key, seq, payload, crc), others=True)
+    if crc is not None and tr['off'] - tr['acked'] >= ACK_EVERY:
+        tr['acked'] = tr['off']
+        safe(sock, json.dumps({"type":"file_ack","xid":tr['xid'],"offset":tr['off']})+"\n")
+
+def relay_frame(sock, tr, sender, seq, payload, crc=None):
+    # crc None: frame v1 (seq), ngược lại frame v2 (seq là offset)
+    off = tr['off'] if crc is None else seq
+    if off <= tr['off']: tr['off'] = max(tr['off'], off + len(payload))
+    slow, out = [], 0
+    if tr['v2']:                                # crc của sender đi nguyên tới người nhận
+        data, rec = pack_chunk(tr['tid'], off, payload, crc), [c for c in tr['v2'] if c is not sock]
+        slow = [c for c in rec if safe(c, data, "file", tr['z']) == PAUSE]
+        out += len(data) * len(rec)
+    if tr['bin']:                               # payload chuyển tiếp nguyên vẹn
+        data, rec = pack_frame(tr['tid'], seq, payload), [c for c in tr['bin'] if c is not sock]
+        slow += [c for c in rec if safe(c, data, "file", tr['z']) == PAUSE]
+        out += len(data) * len(rec)
+    if out: M.inc("chat_file_bytes_out_total", out)
+    if tr['old']:                               # client cũ: base64 JSON, encode 1 lần
+        slow += bc_pkt({"type":"file_chunk","filename":tr['name'],"from":sender,
+                        "data":base64.b64encode(payload).decode()}, tr['old'], exc=sock, kind="file")
+    throttle(sock, slow)
+
+def throttle(sock, slow):
+    # có consumer vượt giới hạn: dừng đọc từ người gửi tới khi chúng xả bớt
+    # (người gửi ở worker khác – sock None – không dừng được, chỉ còn giới hạn 2x)
+    if not slow or sock is None: return
+    if MODE == "loop":
+        loop_pause(conns.get(sock), slow); return
+    for c in slow:
+        cc = conns.get(c)
+        if cc and not cc.out.wait_low(PAUSE_MAX):
+            kill(c)
 
 def ft_end(sock, p):
-    rec = active.pop((sock,p["filename"]),{}).get("rec",[])
-    bc_pkt(p, rec, exc=sock)
+    with ft_lock:
+        tr = active.pop((sock,ft_key(p)),None)
+        tids.pop((sock,p.get("tid")),None)
+        if tr and not p.get("fill"): end_need(clients.get(sock), tr['xid'])
+    if not tr: return
+    stored = 'sha' in tr and ('up' not in tr or blobs.commit(tr['up']))
+    if tr['xid']:                               # ack cuối: sender mới coi là gửi xong
+        safe(sock, json.dumps({"type":"file_ack","xid":tr['xid'],"offset":tr['off'],"done":True})+"\n")
+    relay_pkt(sock, tr, p)
+    sender = clients.get(sock)
+    if bus: bus.send("ft_close", (sender, p), others=True)
+    if stored:
+        emit("blob", tr['room'], tr['to'], sender,
+             {"filename":tr['name'], "size":tr['size'], "sha256":tr['sha'], "from":sender})
+    elif 'sha' in tr:
+        safe(sock, f"{ts()} {tr['name']}: upload incomplete or corrupted – not stored.\n")
 
 # ────────── help text ──────────
 CAT = {"1":"menu","2":"chat","3":"file","4":"friend",
@@ -92,11 +668,12 @@ HELP = {
 "menu":(
 "/room               – list rooms\n"
 "/create <name>      – create room\n"
-"/join   <name>      – join room\n"
+"/join   <name>      – join room (+ since_id: only newer msgs)\n"
 "/rename <new>       – change username\n"
 "/delete <room>      – delete room\n"
 "/count              – user count per room\n"
 "/online             – total online users\n"
+"/stats              – output batching / compression counters\n"
 "/clean              – clear screen (menu only)\n"
 "/quit               – logout"),
 "chat":(
@@ -109,6 +686,8 @@ HELP = {
 "/pinned             – list pins\n"
 "/unpin <pin_no>     – remove pin\n"
 "/forward <id> <r>   – forward msg/file to room r\n"
+"/more [n]           – older messages\n"
+"/search <words>     – find messages (in:<room> from:<user>; /search again: older)\n"
 "/msg @User <txt>    – private message\n"
 "/invitefriend <usr> – invite friend to room"),
 "file":(
@@ -120,7 +699,8 @@ HELP = {
 "/pdf                – PDF document (.pdf)\n"
 "/gif <url>          – fetch & send GIF\n"
 "/open <file>        – open file\n"
-"/save <file>        – save skipped file"),
+"/save <file>        – save skipped file\n"
+"/fetch <id>         – download a stored file again"),
 "friend":(
 "/addfriend <usr>    – send request\n"
 "/acceptfriend <usr> – accept request\n"
@@ -129,8 +709,12 @@ HELP = {
 "/block     <usr>    – block/unblock user")
 }
 
+CMDS = {ln.split()[0]: (("cmd", ln.split()[0]),) for v in HELP.values() for ln in v.splitlines()}
+CMDS.update({c: (("cmd", c),) for c in ("/help", "msg", "other")})   # nhãn của chat_command_seconds
+
 # ────────── command handler ──────────
 def cmd(cli, text):
+    if bus: bus.settle()                    # thấy được các op client này vừa gửi
     args = text.split()
     cmd = args[0]
     usr  = clients[cli]
@@ -148,124 +732,94 @@ def cmd(cli, text):
         return
 
     # ===== MENU AREA =====
-    if cmd == "/room":  tell("Rooms: " + ", ".join(rooms)); return
+    if cmd == "/room":  tell("Rooms: " + ", ".join(list(rooms))); return
 
     if cmd == "/create":
         if len(args)<2: tell("Usage: /create <room>"); return
         r=args[1]
-        with lock:
-            if r in rooms: tell("Room exists"); return
-            rooms[r]=[]; msg_id[r]=1; history[r]=deque(maxlen=1000); pins[r]=[]; pin_no[r]=1
+        if not emit("create", r, wait=True): tell("Room exists"); return
         tell(f"Room '{r}' created."); return
 
     if cmd == "/join":
-        if len(args)<2: tell("Usage: /join <room>"); return
-        r=args[1]
-        with lock:
-            if r not in rooms: tell("Room not found"); return
-            prev=user_rooms[cli]
-            if prev and cli in rooms[prev]:
-                rooms[prev].remove(cli)
-            rooms[r].append(cli); user_rooms[cli]=r
-        safe(cli, f"{ts()} Joined {r}\n")
-        with lock:
-            for _i,_s,ln in history[r]:
-                safe(cli, ln+"\n")
-            if pins[r]:
-                safe(cli,"-- PINNED --\n")
-                for no,_i,pl in pins[r]:
-                    safe(cli,f"{no}) {pl}\n")
-                safe(cli,"-------------\n")
-        bc(r, f"{ts()} **{usr} joined the room.**", exc=cli); return
+        if len(args)<2 or not all(a.isdigit() for a in args[2:4]):
+            tell("Usage: /join <room> [since_id [pin_rev]]"); return
+        since, rev = (list(map(int, args[2:4])) + [None, None])[:2]
+        if not join_room(cli, args[1], since, rev): tell("Room not found")
+        return
 
     if cmd == "/rename":
         if len(args)<2: tell("Usage: /rename <new>"); return
         new=args[1]
-        with lock:
-            if new in clients.values(): tell("Username taken"); return
-            friends[new] = friends.pop(usr,set())
-            blocks[new]  = blocks.pop(usr,set())
-            pending[new] = pending.pop(usr,set())
-            clients[cli] = new
-            usr = new
+        if not emit("rename", usr, new, wait=True): tell("Username taken"); return
+        st.rename(cli, new)
+        usr = new
         tell(f"Renamed to {new}"); return
 
     if cmd == "/delete":
         if len(args)<2: tell("Usage: /delete <room>"); return
         r=args[1]
-        with lock:
-            if r not in rooms: tell("Room not found"); return
-            for c in rooms[r]:
-                user_rooms[c]=None
-                safe(c,f"{ts()} Room '{r}' deleted\n")
-            del rooms[r]; msg_id.pop(r); history.pop(r); pins.pop(r); pin_no.pop(r)
+        if not emit("delete", r, wait=True): tell("Room not found"); return
         tell(f"Room '{r}' deleted."); return
 
     if cmd == "/count":
-        with lock:
-            tell(", ".join(f"{r}:{len(lst)}" for r,lst in rooms.items())); return
+        tell(", ".join(f"{r}:{n}" for r,n in st.counts())); return
 
     if cmd == "/online":
-        with lock:
-            tell(f"Online users: {len(clients)}"); return
+        tell(f"Online users: {st.online()}"); return
+
+    if cmd == "/stats":
+        f, w = io_stats()
+        tell(f"Output: {f} messages in {w} writes ({f/max(w,1):.1f} per syscall, "
+             f"{f-w} syscalls saved)")
+        r, o, cpu = zip_stats()
+        if r: tell(f"Compression: {r} B -> {o} B ({o/r:.0%}), {cpu*1000:.1f} ms CPU")
+        tell(f"Reaped: {reaped['login']} at login, {reaped['dead']} dead, {reaped['idle']} idle "
+             f"({len(conns)} connections watched)")
+        return
 
     if cmd == "/clean":
         safe(cli, "\033c"); return
 
     if cmd == "/quit":
+        c = conns[cli]
+        if c.token: emit("sess_end", c.token); c.token = None
         safe(cli, "Bye!\n"); disconnect(cli); return
 
     # ===== FRIEND SYSTEM =====
     if cmd in ("/addfriend","/acceptfriend","/myfriends","/unfriend","/block","/invitefriend"):
-        with lock:
-            friends.setdefault(usr,set())
-            blocks.setdefault(usr,set())
-            pending.setdefault(usr,set())
+        social.ensure(usr)
 
     if cmd == "/addfriend":
         if len(args)<2: tell("Usage: /addfriend <user>"); return
         target=args[1]
-        with lock:
-            tgt_cli = next((c for c,u in clients.items() if u==target),None)
-        if not tgt_cli:
+        if not st.is_online(target):
             tell("User not online."); return
-        if target in friends[usr] or usr in pending[target]:
+        if not emit("social", "request", usr, target, wait=True):
             tell("Already friends or pending."); return
-        pending[target].add(usr)
-        safe(tgt_cli, json.dumps({"type":"friendreq","from":usr})+"\n")
+        emit("deliver", [target], (json.dumps({"type":"friendreq","from":usr})+"\n").encode(ENC))
         tell("Request sent."); return
 
     if cmd == "/acceptfriend":
         if len(args)<2: tell("Usage: /acceptfriend <user>"); return
         req=args[1]
-        if req not in pending[usr]:
+        if not emit("social", "accept", usr, req, wait=True):
             tell("No pending request."); return
-        pending[usr].remove(req)
-        friends[usr].add(req)
-        friends.setdefault(req,set()).add(usr)
-        with lock:
-            req_cli = next((c for c,u in clients.items() if u==req),None)
-        if req_cli:
-            safe(req_cli, f"[Friend] {usr} accepted your request.\n")
+        emit("deliver", [req], f"[Friend] {usr} accepted your request.\n".encode(ENC))
         tell("Friend added."); return
 
     if cmd == "/myfriends":
-        tell("Friends: "+", ".join(sorted(friends[usr]) or ["(none)"])); return
+        tell("Friends: "+", ".join(social.friends_of(usr) or ["(none)"])); return
 
     if cmd == "/unfriend":
         if len(args)<2: tell("Usage: /unfriend <user>"); return
-        tgt=args[1]
-        friends[usr].discard(tgt)
-        friends.get(tgt,set()).discard(usr)
+        emit("social", "unfriend", usr, args[1])
         tell("Removed."); return
 
     if cmd == "/block":
         if len(args)<2: tell("Usage: /block <user>"); return
         tgt=args[1]
-        if tgt in blocks[usr]:
-            blocks[usr].remove(tgt); tell(f"Unblocked {tgt}")
-        else:
-            blocks[usr].add(tgt); tell(f"Blocked {tgt}")
+        tell(f"Blocked {tgt}" if emit("social", "toggle_block", usr, tgt, wait=True)
+             else f"Unblocked {tgt}")
         return
 
     if cmd == "/invitefriend":
@@ -273,205 +827,818 @@ def cmd(cli, text):
             tell("Join a room first."); return
         if len(args)<2:
             tell("Usage: /invitefriend <user>"); return
-        tgt=args[1]
-        with lock:
-            tgt_cli = next((c for c,u in clients.items() if u==tgt),None)
-        if tgt_cli:
-            safe(tgt_cli,json.dumps({"type":"invite","from":usr,"room":room})+"\n")
+        if st.is_online(args[1]):
+            emit("deliver", [args[1]], (json.dumps({"type":"invite","from":usr,"room":room})+"\n").encode(ENC))
             tell("Invite sent."); return
         tell("User not online."); return
 
+    if cmd == "/search":
+        c = conns[cli]
+        if len(args) == 1:                      # trang kế của lần tìm trước
+            if not c.found: tell("Usage: /search [in:<room>] [from:<user>] <words>"); return
+            where, who, q, before = c.found
+        else:
+            where, who, q, before = room, None, [], None
+            for a in args[1:]:
+                if a.startswith("in:"): where = a[3:]
+                elif a.startswith("from:"): who = a[5:]
+                else: q.append(a)
+            q = " ".join(q)
+            if not q: tell("Usage: /search [in:<room>] [from:<user>] <words>"); return
+        r = st.room(where) if where else None
+        if not r: tell("Room not found" if where else "Join a room first or use in:<room>"); return
+        hits, cur = r.search(q, who, before, SEARCH_PAGE)
+        c.found = (where, who, q, cur) if cur else None
+        if not hits and not cur:
+            tell("No more matches." if before else "No matches."); return
+        out = [f"-- SEARCH \"{q}\" in {where}" + (f" from {who}" if who else "") + " --\n"]
+        out += [f"#{mid} {s}: {snippet(line)}\n" for mid, s, line in hits]
+        out.append("-- /search for older matches --\n" if cur else "-- end --\n")
+        safe(cli, "".join(out)); return
+
     # ===== CHAT & FILE (need room) =====
     need_room = {"/leave","/users","/recall","/reply","/pin",
-                 "/pinned","/unpin","/forward"}
-    if cmd in need_room and not room:
+                 "/pinned","/unpin","/forward","/more","/fetch"}
+    rm = st.room(room) if room else None
+    if cmd in need_room and not rm:
         tell("Join a room first."); return
 
     if cmd == "/leave":
-        with lock:
-            rooms[room].remove(cli)
-            user_rooms[cli]=None
+        st.leave(cli); emit("move", usr, None)
         safe(cli,f"{ts()} Left room\n")
-        bc(room,f"{ts()} **{usr} left.**",exc=cli); return
+        emit("say", room, f"{ts()} **{usr} left.**", usr); return
+
+    if cmd == "/more":
+        n = min(int(args[1]), 500) if len(args)>1 and args[1].isdigit() else JOIN_REPLAY
+        c = conns[cli]
+        cur_room, oldest = c.cursor or (None, None)
+        page = rm.page(oldest, n) if cur_room == room and oldest else []
+        if not page:
+            tell("No older messages."); return
+        c.cursor = (room, page[0][0])
+        safe(cli, "".join(ln+"\n" for _i,_s,ln in page)); return
 
     if cmd == "/users":
-        with lock:
-            tell("Users: "+", ".join(clients[c] for c in rooms[room])); return
+        tell("Users: "+", ".join(st.roster_of(room))); return
 
     if cmd == "/recall":
         if len(args)<2 or not args[1].isdigit():
             tell("Usage: /recall <id>"); return
         rid=int(args[1])
-        with lock:
-            idx,rec=next(((i,h) for i,h in enumerate(history[room])
-                          if h[0]==rid),(None,None))
-            if not rec:
-                tell("ID not found"); return
-            if rec[1]!=usr:
-                tell("Only recall own msg"); return
-            history[room][idx]=(rid,usr,f"[MSG #{rid}] (recalled)")
-        bc(room,f"[MSG #{rid}] (recalled)"); return
+        rec=rm.get(rid)
+        if not rec:
+            tell("ID not found"); return
+        if rec[1] != usr:
+            tell("Only recall own msg"); return
+        emit("recall", room, rid, usr); return
 
     if cmd == "/reply":
         if len(args)<3 or not args[1].isdigit():
             tell("Usage: /reply <id> <txt>"); return
         oid=int(args[1]); txt=" ".join(args[2:])
-        with lock:
-            orig=next((h for h in history[room] if h[0]==oid),None)
+        orig=rm.get(oid)
         if not orig:
             tell("ID not found"); return
-        mid=msg_id[room]; msg_id[room]+=1
-        line=(f"[MSG #{mid}] {usr} reply {orig[1]} →#{oid} "
-              f"«{orig[1]}: {snippet(orig[2])}»: {txt}")
-        with lock:
-            history[room].append((mid,usr,line))
-        bc(room,line); return
+        emit("post", room, usr, "MSG", f"{usr} reply {orig[1]} →#{oid} "
+                                       f"«{orig[1]}: {snippet(orig[2])}»: {txt}"); return
 
     if cmd == "/pin":
         if len(args)<2 or not args[1].isdigit():
             tell("Usage: /pin <id>"); return
         mid=int(args[1])
-        with lock:
-            rec=next((h for h in history[room] if h[0]==mid),None)
-        if not rec:
+        if not rm.get(mid):
             tell("ID not found"); return
-        no=pin_no[room]; pin_no[room]+=1
-        pins[room].append((no,mid,rec[2]))
-        bc(room,f"{ts()} **{usr} pinned message #{mid} (pin {no})**"); return
+        emit("pin", room, mid, usr); return
 
     if cmd == "/pinned":
-        with lock: plist=pins[room][:]
+        plist=rm.pinned()
         if not plist:
-            bc(room,"No pinned items."); return
-        bc(room,"-- PINNED LIST --")
-        for no,_i,pl in plist:
-            bc(room,f"{no}) {pl}")
-        bc(room,"-----------------"); return
+            emit("say", room, "No pinned items."); return
+        emit("say", room, "\n".join(["-- PINNED LIST --"] + [f"{no}) {pl}" for no,_i,pl in plist]
+                                    + ["-----------------"])); return
 
     if cmd == "/unpin":
         if len(args)<2 or not args[1].isdigit():
             tell("Usage: /unpin <pin_no>"); return
         no=int(args[1])
-        with lock:
-            if not any(p[0]==no for p in pins[room]):
-                tell("Pin not found"); return
-            pins[room]=[p for p in pins[room] if p[0]!=no]
-        bc(room,f"{ts()} **{usr} unpinned item {no}**"); return
+        if all(p[0] != no for p in rm.pinned()):
+            tell("Pin not found"); return
+        emit("unpin", room, no, usr); return
 
     if cmd == "/forward":
         if len(args)<3 or not args[1].isdigit():
             tell("Usage: /forward <id> <room>"); return
         src_id=int(args[1]); dst=args[2]
-        if dst not in rooms:
+        drm=st.room(dst)
+        if not drm:
             tell("Target room not found"); return
         if dst == room:
             tell("Target room is current room"); return
-        with lock:
-            orig = next((h for h in history[room] if h[0]==src_id),None)
-            if not orig:
-                tell("ID not found"); return
-            mid = msg_id[dst]; msg_id[dst]+=1
-            line = f"[MSG #{mid}] (FWD by {usr}) {orig[2]}"
-            history[dst].append((mid, usr, line))
-        bc(dst,line)
+        orig = rm.get(src_id)
+        if not orig:
+            tell("ID not found"); return
+        emit("post", dst, usr, "MSG", f"(FWD by {usr}) {orig[2]}")
+        meta = blobs and file_meta(orig[2])
+        if meta and blobs.find(meta["sha256"]) and not social.blocked(usr, meta["from"]):
+            # file trong kho: phòng đích nhận từ kho (on_blob bỏ người chặn người gửi gốc)
+            emit("blob", dst, None, usr, meta)
         tell(f"Forwarded to {dst}."); return
 
+    if cmd == "/fetch":
+        if len(args)<2 or not args[1].isdigit():
+            tell("Usage: /fetch <id>"); return
+        if not blobs:
+            tell("No file store on this server."); return
+        if "blob" not in caps.get(cli,()):
+            tell("Your client cannot receive stored files."); return
+        orig = rm.get(int(args[1]))
+        meta = orig and file_meta(orig[2])
+        if not meta:
+            tell("No stored file with that ID"); return
+        if social.blocked(usr, meta["from"]):
+            tell("You blocked the sender of this file."); return
+        if not send_blob(cli, meta):
+            tell("File is no longer stored."); return
+        return
+
     # ---- unknown ----
     tell("Unknown command.")
 
+def join_room(cli, r, since=None, rev=None):
+    """Vào phòng r rồi gửi lại lịch sử. Có since: chỉ các message id > since,
+    và chỉ gửi lại danh sách pin nếu pin_rev khác rev. False nếu không có phòng."""
+    rm = st.join(cli, r)
+    if not rm: return False
+    usr = clients[cli]
+    emit("move", usr, r)
+    hist = rm.since(since, JOIN_REPLAY) if since is not None else None
+    if hist is None:                            # không biết client đã thấy gì: gửi đầy đủ
+        hist, since, rev = rm.page(None, JOIN_REPLAY), None, None
+    prev = rm.pin_rev()
+    plist = rm.pinned() if rev != prev else []  # chụp dưới lock, gửi sau khi nhả
+    last = hist[-1][0] if hist else since or 0
+    conns[cli].cursor = (r, hist[0][0] if hist else last + 1)
+    out = []
+    if "resume" in caps.get(cli, ()):           # trước phần replay: client biết các dòng sau thuộc phòng r
+        out.append(json.dumps({"type":"sync","room":r,"last":last,"pins":prev})+"\n")
+    out.append(f"{ts()} Joined {r}" + (f" ({len(hist)} new)" if since is not None else "") + "\n")
+    out += [ln+"\n" for _i,_s,ln in hist]
+    if len(hist) == JOIN_REPLAY and (since is None or hist[0][0] > since+1):
+        out.append("-- /more for older messages --\n")
+    if plist:
+        out += ["-- PINNED --\n"] + [f"{no}) {pl}\n" for no,_i,pl in plist] + ["-------------\n"]
+    safe(cli, "".join(out))
+    emit("say", r, f"{ts()} **{usr} joined the room.**", usr)
+    return True
+
 # ────────── routing ──────────
 def handle_text(cli,msg):
+    t = time.perf_counter()
+    usr=clients[cli]
     if msg.startswith("/"):
-        cmd(cli,msg); return
-    room=user_rooms[cli]
-    if not room:
-        safe(cli,"Join a room first\n"); return
-    mid=msg_id[room]; msg_id[room]+=1
-    line=f"[MSG #{mid}] {clients[cli]}: {msg}"
-    with lock:
-        history[room].append((mid,clients[cli],line))
-    bc(room,line)
+        if over(cli, (("cmd", usr),)): return
+        cmd(cli,msg)
+        lab = CMDS.get(msg.split(None,1)[0], CMDS["other"])
+    else:
+        room=user_rooms.get(cli); rm=st.room(room) if room else None
+        if not rm:
+            safe(cli,"Join a room first\n"); return
+        if over(cli, (("msg", usr), ("room_msg", room))): return
+        emit("post", room, usr, "MSG", f"{usr}: {msg}")
+        lab = CMDS["msg"]
+    M.observe("chat_command_seconds", time.perf_counter()-t, lab)
 
 def handle_private(cli,pk):
-    to=pk.get("to",[]); sender=clients[cli]
-    with lock:
-        rec=[c for c,u in clients.items()
-             if u in to and sender not in blocks.get(u,set())]
-    bc_pkt(pk,rec,exc=cli)
+    if not name_list(pk.get("to",[])):
+        safe(cli, "Bad message: \"to\" must be a list of names.\n"); return
+    if over(cli, (("msg", clients[cli]),)): return
+    emit("pm", clients[cli], pk.get("to",[]), (json.dumps(pk)+"\n").encode(ENC))
+
+# ────────── login / dispatch (dùng chung cho 2 mode) ──────────
+class Conn:
+    __slots__ = ("sock","addr","dec","out","name","ev","paused","cursor","found","token","hold","warned","born","seen")
+    def __init__(self, sock, addr, ready=None):
+        self.sock, self.addr, self.dec, self.name = sock, addr, Decoder(), None
+        self.born = self.seen = time.monotonic()  # lúc kết nối; lần cuối nhận được byte (bánh xe beats)
+        self.out = Outbox(OUT_MAX_MSGS, OUT_MAX_KB*1024, POLICY, ready)
+        self.ev, self.paused = 0, None
+        self.cursor = None                      # (room, id cũ nhất đã gửi) cho /more
+        self.found = None                       # (room, người gửi, từ khoá, con trỏ) cho /search tiếp
+        self.token = None                       # token phiên (cap "resume")
+        self.hold, self.warned = False, 0.0     # loop: ngừng đọc vì hạn mức byte file; hạn báo rate limit kế
+
+conns = {}                                          # sock -> Conn
+
+def login(sock, name):
+    if not emit("online", name, WID, wait=True):   # tên là duy nhất trên mọi worker
+        return False
+    if sock not in conns or not st.add(sock, name):
+        emit("offline", name, None, WID); return False
+    M.inc("chat_logins_total")
+    safe(sock,f"{ts()} Hello {name}! Type /help\n")
+    return True
+
+def resume(c, token):
+    """Nhận lại phiên theo token (phiên có thể ở worker khác); trả về (name, room) hoặc None."""
+    got = emit("sess_claim", token, wait=True) if isinstance(token, str) else None
+    if got: c.token = token
+    return got
+
+def greet(c, line):
+    # client mới gửi {"type":"login","name":…,"caps":[…]}, client cũ gửi tên trần;
+    # cap "resume": thêm "token" (phiên cũ) và "seen" {room: [id cuối, pin_rev]}
+    try: obj = json.loads(line)
+    except json.JSONDecodeError: obj = None
+    hello = isinstance(obj,dict) and obj.get("type") == "login"
+    name = (str(obj.get("name","")) if hello else line).strip() or f"Anon{c.addr[1]}"
+    prev = None
+    if hello:
+        off = ({"blob"} if not blobs else set()) | ({"zlib"} if not ZLEVEL else set()) | ({"ping"} if not PING else set())
+        want = obj.get("caps")
+        caps[c.sock] = (CAPS - off) & set(x for x in want if isinstance(x, str)) if isinstance(want, list) else set()
+        if "zlib" in caps[c.sock]: c.out.z = Deflater(ZLEVEL)
+        if "resume" in caps[c.sock]:
+            prev = resume(c, obj.get("token"))
+            if prev: name = prev[0]
+            c.token = c.token or secrets.token_urlsafe(16)
+    ok = login(c.sock, name)
+    if ok:
+        c.name = name
+        if c.token: emit("sess_open", c.token, WID, name)
+    if hello:
+        w = {"type":"welcome","caps":sorted(caps[c.sock])}
+        if c.token: w["token"] = c.token
+        if "ping" in caps[c.sock]: w["ping"], w["dead"] = PING, DEAD
+        room = ok and prev and prev[1]
+        if room and st.room(room): w["room"] = room
+        safe(c.sock, json.dumps(w)+"\n")
+        if "room" in w:                         # đưa lại vào phòng cũ, chỉ gửi phần thiếu
+            seen = (obj.get("seen") or {}).get(room)
+            seen = [x for x in seen if isinstance(x,int)][:2] if isinstance(seen,list) else []
+            join_room(c.sock, room, *seen)
+    if not ok: safe(c.sock, "Username taken, try again.\nEnter username:\n")
+
+def feed(c, data):
+    sock = c.sock
+    c.seen = time.monotonic()
+    try:
+        for fr in c.dec.feed(data):
+            if sock not in conns: return
+            if fr[0] == "bin":
+                if c.name is not None: ft_frame(sock, *fr[1:])
+            elif c.name is None:
+                greet(c, fr[1])
+            elif fr[1]:
+                on_line(sock, fr[1])
+    except FrameError:                          # không có "\n" / frame quá lớn: không đệm mãi
+        safe(sock, "Frame too large.\n"); disconnect(sock)
+    except Exception as e:                      # gói lạ làm handler lỗi: chỉ đóng kết nối này
+        print(ts(), f"Error from {c.name or c.addr}: {e!r}", flush=True)
+        traceback.print_exc()
+        disconnect(sock)
+
+def on_line(sock, line):
+    try:
+        obj=json.loads(line)
+        if isinstance(obj,dict) and obj.get("type"):
+            t=obj["type"]
+            if t in ("file_start","file_chunk","file_end") and not well_formed(t,obj):
+                safe(sock,"Bad file packet.\n"); return
+            if t=="file_start": ft_start(sock,obj)
+            elif t=="file_chunk": ft_chunk(sock,obj)
+            elif t=="file_end":  ft_end(sock,obj)
+            elif t=="file_resume": ft_resume(sock,obj)
+            elif t=="file_need": ft_need(sock,obj)
+            elif t=="msg":       handle_private(sock,obj)
+            elif t=="ping":      safe(sock,'{"type":"pong"}\n')   # "pong": c.seen đã cập nhật
+        else:
+            handle_text(sock,line)
+    except json.JSONDecodeError:
+        handle_text(sock,line)
 
 # ────────── client thread ──────────
 def client_thread(sock,addr):
+    if MAX_CONNS and len(conns) >= MAX_CONNS:
+        refuse(sock); return
+    c = conns[sock] = Conn(sock, addr)
+    M.inc("chat_connections_opened_total")
+    watch(c)
+    threading.Thread(target=writer_thread,args=(c,),daemon=True).start()
     try:
-        # ---- login ----
-        while True:
-            safe(sock,"Enter username:\n")
-            name=sock.recv(1024).decode(ENC).strip() or f"Anon{addr[1]}"
-            with lock:
-                if name not in clients.values():
-                    break
-            safe(sock,"Username taken, try again.\n")
-        with lock:
-            clients[sock]=name; user_rooms[sock]=None
-            friends.setdefault(name,set())
-            blocks.setdefault(name,set())
-            pending.setdefault(name,set())
-        notify_friend(name,True)
-        safe(sock,f"{ts()} Hello {name}! Type /help\n")
-
-        buf=""
-        while True:
-            data=sock.recv(65536)
+        safe(sock,"Enter username:\n")
+        while sock in conns:
+            try: data=sock.recv(65536)
+            except OSError: break
             if not data:
                 break
-            buf+=data.decode(ENC)
-            while "\n" in buf:
-                line,buf = buf.split("\n",1)
-                if not line:
-                    continue
-                try:
-                    obj=json.loads(line)
-                    if isinstance(obj,dict) and obj.get("type"):
-                        t=obj["type"]
-                        if t=="file_start": ft_start(sock,obj)
-                        elif t=="file_chunk": ft_chunk(sock,obj)
-                        elif t=="file_end":  ft_end(sock,obj)
-                        elif t=="msg":       handle_private(sock,obj)
-                    else:
-                        handle_text(sock,line)
-                except json.JSONDecodeError:
-                    handle_text(sock,line)
+            feed(c, data)
     finally:
         disconnect(sock)
+        M.retire()
+
+def writer_thread(c):
+    box = c.out
+    while box.wait(FLUSH_MS/1000, WRITE_MAX):
+        bufs = box.peek(WRITE_MAX)
+        try: n = sendout(c.sock, bufs)
+        except OSError:
+            kill(c.sock); break
+        box.consume(n)
+    try: c.sock.close()
+    except OSError: pass
+    M.retire()
+
+def kill(sock):
+    # ngắt consumer chậm / chết; thread đọc (hoặc event loop) sẽ gọi disconnect()
+    c = conns.get(sock)
+    if not c: return
+    if not c.out.closed: M.inc("chat_connections_killed_total")
+    c.out.close(discard=True)
+    if MODE == "loop":
+        disconnect(sock); return
+    try: sock.shutdown(socket.SHUT_RDWR)
+    except OSError: pass
+
+# ────────── hạn kết nối: login, heartbeat, idle (wheel.py) ──────────
+# Mỗi tick, heartbeat() lấy từ bánh xe các kết nối tới hạn và xét lại: chưa
+# login sau LOGIN_TIMEOUT -> đóng; client cap "ping" im lặng PING giây -> gửi
+# ping, DEAD giây -> đóng; client cũ im lặng IDLE giây -> đóng. Đọc dữ liệu chỉ
+# ghi c.seen, không đụng tới bánh xe. Đóng bằng disconnect() như mọi kết nối.
+REAP_MSG = {"login": "Login timed out.", "dead": "Connection timed out.", "idle": "Idle too long, bye."}
+
+def watch(c):
+    keepalive(c.sock)
+    beats.add(c, c.born + LOGIN_TIMEOUT)
+
+def beat(c, now):
+    """Xét một kết nối đã tới hạn; trả về hạn kế tiếp (None: thôi theo dõi)."""
+    quiet = now - c.seen
+    if c.name is None:
+        if not LOGIN_TIMEOUT: return now + (PING or IDLE or 60)     # chờ login rồi theo luật bên dưới
+        if now - c.born < LOGIN_TIMEOUT: return c.born + LOGIN_TIMEOUT
+        reap(c, "login"); return None
+    if PING and "ping" in caps.get(c.sock, ()):
+        if quiet < PING: return c.seen + PING
+        if quiet < DEAD:
+            safe(c.sock, '{"type":"ping"}\n'); return c.seen + DEAD
+        reap(c, "dead"); return None
+    if not IDLE: return None                    # client cũ: chỉ còn TCP keepalive
+    if quiet < IDLE: return c.seen + IDLE
+    reap(c, "idle"); return None
+
+def reap(c, why):
+    reaped[why] += 1
+    M.inc("chat_connections_reaped_total", 1, (("reason", why),))
+    safe(c.sock, f"{ts()} {REAP_MSG[why]}\n")
+    if MODE == "loop":
+        disconnect(c.sock); return
+    try: c.sock.shutdown(socket.SHUT_RD)        # thread đọc đang chờ recv() nhận b"" rồi disconnect()
+    except OSError: pass
+
+def heartbeat():
+    global reap_logged
+    now = time.monotonic()
+    due.extend(beats.pop(now))
+    for _ in range(min(len(due), BEAT_BATCH)):  # cả nghìn kết nối cùng hạn: chia lượt, chat không phải chờ
+        c = due.popleft()
+        if conns.get(c.sock) is not c: continue  # đã đóng
+        nxt = beat(c, now)
+        if nxt: beats.add(c, nxt)
+    n = sum(reaped.values()) - reap_logged
+    if n and not due:
+        reap_logged += n
+        print(ts(), f"Reaped {n} connections (so far: {reaped['login']} at login, "
+                    f"{reaped['dead']} dead, {reaped['idle']} idle)", flush=True)
+    if MODE == "loop": later(0 if due else beats.tick, heartbeat)
+
+def heartbeats():
+    # thread mode: một thread hẹn giờ cho mọi kết nối (daemon – không giữ process khi thoát)
+    while True:
+        time.sleep(0 if due else beats.tick); heartbeat()
+
+# ────────── event loop (selectors) ──────────
+# Một thread, socket non-blocking; mỗi kết nối chỉ giữ một Conn nhỏ.
+# put() vào Outbox đánh dấu kết nối "dirty"; sau mỗi vòng select, khi đã quá
+# FLUSH_MS kể từ lần put đầu tiên, mọi kết nối dirty được ghi ra một lượt.
+sel = None
+dirty = []                                          # Conn có dữ liệu chờ ghi
+paused = {}                                         # Conn người gửi -> hạn chờ
+loop_tid, wake_r, wake_w = None, None, None
+hand_srv = None                                     # Unix socket nhận yêu cầu tiếp quản (--handoff)
+timers, timer_seq = [], itertools.count()           # heap (hạn, seq, hàm), chỉ thread event loop
+
+def later(secs, fn):
+    # loop: fn chạy trên thread event loop (gọi từ chính thread đó);
+    # thread mode: thread hẹn giờ riêng
+    if MODE == "loop":
+        heapq.heappush(timers, (time.monotonic() + secs, next(timer_seq), fn)); return
+    def run():
+        fn(); M.retire()
+    threading.Timer(secs, run).start()
+
+def loop_ready(c):
+    dirty.append(c)
+    if threading.get_ident() != loop_tid:
+        try: wake_w.send(b"\0")
+        except OSError: pass
+
+def set_interest(c):
+    ev = (0 if c.paused or c.hold else selectors.EVENT_READ) | (selectors.EVENT_WRITE if c.out.q else 0)
+    if ev == c.ev: return
+    if not ev: sel.unregister(c.sock)
+    elif not c.ev: sel.register(c.sock, ev, c)
+    else: sel.modify(c.sock, ev, c)
+    c.ev = ev
+
+def loop_flush(c):
+    bufs = c.out.peek(WRITE_MAX)
+    if bufs:
+        try: n = sendout(c.sock, bufs)
+        except (BlockingIOError, InterruptedError): n = 0
+        except OSError: disconnect(c.sock); return
+        c.out.consume(n)
+    if c.sock in conns: set_interest(c)
+
+def loop_pause(c, slow):
+    if not c: return
+    c.paused = c.paused or set()
+    for s in slow:
+        cc = conns.get(s)
+        if cc and cc not in c.paused:
+            c.paused.add(cc); cc.out.low.append(lambda cc=cc: loop_resume(c, cc))
+    if c.paused:
+        paused[c] = time.monotonic() + PAUSE_MAX
+        set_interest(c)
+
+def loop_resume(c, cc):
+    if not c.paused: return
+    c.paused.discard(cc)
+    if not c.paused:
+        c.paused = None; paused.pop(c, None)
+        if c.sock in conns: set_interest(c)
+
+def loop_unhold(c):
+    c.hold = False
+    if c.sock in conns: set_interest(c)
+
+def loop_accept(s):
+    while True:
+        try: sock, addr = s.accept()
+        except (BlockingIOError, InterruptedError): return
+        if MAX_CONNS and len(conns) >= MAX_CONNS:
+            refuse(sock); continue
+        sock.setblocking(False)
+        c = Conn(sock, addr)
+        c.out.ready = lambda c=c: loop_ready(c)
+        conns[sock] = c; set_interest(c); watch(c)
+        M.inc("chat_connections_opened_total")
+        safe(sock, "Enter username:\n")
+
+def loop_read(c):
+    try: data = c.sock.recv(65536)
+    except (BlockingIOError, InterruptedError): return
+    except OSError: data = b""
+    if not data:
+        disconnect(c.sock); return
+    feed(c, data)
+
+def serve_loop(s):
+    global sel, loop_tid, wake_r, wake_w
+    sel = selectors.DefaultSelector()
+    loop_tid = threading.get_ident()
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False); wake_w.setblocking(False)
+    s.setblocking(False)
+    sel.register(s, selectors.EVENT_READ, "accept")
+    sel.register(wake_r, selectors.EVENT_READ, "wake")
+    if bus: sel.register(bus.sock, selectors.EVENT_READ, "bus")
+    if hand_srv: sel.register(hand_srv, selectors.EVENT_READ, "handoff")
+    for c in list(conns.values()): set_interest(c)  # kết nối nhận từ process cũ
+    flush_at = None
+    while True:
+        wait = 1.0 if paused else None
+        if flush_at is not None:
+            wait = max(0.0, min(wait or 1.0, flush_at - time.monotonic()))
+        if timers:
+            wait = max(0.0, min(1.0 if wait is None else wait, timers[0][0] - time.monotonic()))
+        for key, ev in sel.select(wait):
+            c = key.data
+            if c == "accept":
+                loop_accept(s); continue
+            if c == "wake":
+                try: wake_r.recv(4096)
+                except BlockingIOError: pass
+                continue
+            if c == "bus":
+                bus.pump(); continue
+            if c == "handoff":
+                hand_over(s); continue
+            if ev & selectors.EVENT_WRITE and c.sock in conns:
+                loop_flush(c)
+            if ev & selectors.EVENT_READ and c.sock in conns:
+                loop_read(c)
+        now = time.monotonic()                  # hẹn giờ đặt trong lúc chạy (later(0)) chờ vòng sau
+        while timers and timers[0][0] <= now:
+            heapq.heappop(timers)[2]()
+        if dirty:
+            now = time.monotonic()
+            if flush_at is None: flush_at = now + FLUSH_MS/1000
+            if now >= flush_at:
+                flush_at = None
+                while dirty:
+                    c = dirty.pop()
+                    if c.sock in conns: loop_flush(c)
+        if paused:                              # consumer chậm quá PAUSE_MAX -> ngắt
+            now = time.monotonic()
+            for c in [c for c,t in paused.items() if t < now]:
+                for cc in list(c.paused or ()):
+                    kill(cc.sock); loop_resume(c, cc)
 
 # ────────── disconnect ──────────
-def disconnect(sock):
-    name=clients.pop(sock,"?")
-    notify_friend(name,False)
-    r=user_rooms.pop(sock,None)
-    with lock:
-        if r and sock in rooms.get(r,[]):
-            rooms[r].remove(sock)
-        # dọn file-transfer dang dở
+def disconnect(sock, quiet=False):
+    # quiet: phiên đã chuyển sang kết nối khác (resume), không báo offline
+    c = conns.pop(sock, None)
+    if not c: return
+    M.inc("chat_connections_closed_total")
+    with stats_lock:
+        io_done[0] += c.out.frames; io_done[1] += c.out.writes
+        if c.out.z:
+            zip_done[0] += c.out.z.raw; zip_done[1] += c.out.z.out; zip_done[2] += c.out.z.cpu
+    name, r = st.remove(sock)
+    if name and not quiet: emit("offline", name, r, WID)
+    if name and c.token: emit("sess_park", c.token, name, r)
+    with ft_lock:
+        # dọn file-transfer dang dở; transfer có xid được giữ RESUME_TTL giây
         for k in list(active):
             if k[0] is sock:
-                active.pop(k,None)
-    if r:
-        bc(r,f"{ts()} **{name} disconnected.**",exc=sock)
+                tr = active.pop(k,None)
+                if name and tr.get('xid') and k[1] == tr['xid']:
+                    held[tr['xid']] = (name, tr, time.monotonic() + RESUME_TTL)
+        for k in list(tids):
+            if k[0] is sock:
+                tids.pop(k,None)
+        caps.pop(sock,None)
+    if MODE == "thread":
+        try: sock.settimeout(2)                 # writer xả nốt rồi tự đóng socket
+        except OSError: pass
+        c.out.close(); return
+    if c.out.q and not c.out.closed:            # loop: cố gửi nốt (vd. "Bye!")
+        try: sendout(sock, c.out.peek(WRITE_MAX))
+        except OSError: pass
+    c.out.close(discard=True)
+    paused.pop(c, None)
+    if c.ev: sel.unregister(sock)
     try:
         sock.close()
     except: pass
 
+# ────────── handoff: nâng cấp không ngắt kết nối (handoff.py) ──────────
+# Chỉ loop mode, một process: thread event loop là nơi duy nhất đổi trạng thái,
+# nên khi nó dừng ở hand_over() thì bản chụp nhất quán. time.monotonic() là đồng
+# hồ chung của cả máy: các hạn (phiên, transfer giữ, rate limit) dùng tiếp được.
+def snapshot(s):
+    live = []
+    for c in conns.values():
+        if c.out.z:                             # process mới nén tiếp bằng luồng raw
+            cut = c.out.z.cut(); c.out.q.append(cut); c.out.size += len(cut)
+        q = [b if type(b) is FileSpan else bytes(b) for b in c.out.q]
+        live.append((c.sock, c.addr, c.name, c.cursor, c.found, c.token, c.warned, c.dec,
+                     q, c.out.dropped, bool(c.out.z)))
+    jn = st.journal
+    return {"listen": s, "conns": live, "clients": clients, "user_rooms": user_rooms,
+            "where": st.where, "roster": st.roster,
+            "rooms": [(n, r.members, r.history, r.index, r.pins, r.pin_no, r.next_id) for n, r in rooms.items()],
+            "social": {"friends": social.friends, "blocks": social.blocks, "pending": social.pending},
+            "sessions": (sessions.live, sessions.parked), "presence": presence.pending,
+            "buckets": {k: l.buckets for k, l in lim.items()},
+            "active": active, "tids": tids, "held": held, "caps": caps, "tid": next(tid_seq),
+            "io": io_stats(), "zip": zip_stats(), "reaped": reaped, "journal": jn and (jn.gen, jn.tail)}
+
+def hand_over(s):
+    # process mới đã nối vào PATH: ghi nốt đĩa, gửi trạng thái + fd, chờ ack rồi thoát
+    try: ctl, _ = hand_srv.accept()
+    except OSError: return
+    t = time.perf_counter()
+    if st.store and st.store.write: st.store.sync()
+    if st.journal: st.journal.close()
+    try: ok = handoff.give(ctl, snapshot(s))
+    except Exception as e:                      # trạng thái không pickle được: ở lại phục vụ
+        print(ts(), f"Handoff error: {e!r}", flush=True); ok = False
+    if ok:
+        print(ts(), f"Handed {len(conns)} connections to the new server in "
+                    f"{(time.perf_counter() - t) * 1000:.0f} ms", flush=True)
+        os._exit(0)                             # không đóng gì: các fd đã thuộc process mới
+    ctl.close()
+    if st.journal: st.journal.open()
+    print(ts(), "Handoff failed, still serving", flush=True)
+
+def restore(d):
+    """Dựng lại trạng thái nhận từ server cũ; phòng dùng store / journal của process này."""
+    global tid_seq, reap_logged
+    for sock, addr, name, cursor, found, token, warned, dec, q, dropped, z in d["conns"]:
+        sock.setblocking(False)
+        c = conns[sock] = Conn(sock, addr)
+        c.out.ready = lambda c=c: loop_ready(c)
+        c.name, c.cursor, c.found, c.token, c.warned, c.dec = name, cursor, found, token, warned, dec
+        c.out.q.extend(q); c.out.dropped = dropped
+        c.out.size = sum(len(b) for b in q if type(b) is not FileSpan)
+        if z and ZLEVEL: c.out.z = Deflater(ZLEVEL, raw=True)
+        watch(c)                                # hạn tính lại từ lúc tiếp quản
+    clients.update(d["clients"]); user_rooms.update(d["user_rooms"])
+    st.socks.update((n, k) for k, n in d["clients"].items())
+    st.where.update(d["where"]); st.roster.update(d["roster"])
+    rooms.clear()
+    for n, members, h, idx, pins, pin_no, next_id in d["rooms"]:
+        r = rooms[n] = Room(n, st.cap)
+        r.store, r.journal = st.store, st.journal
+        if h.cap == st.cap: r.history, r.index = h, idx
+        else:
+            for e in h: r.keep(e)                   # --history đổi: dựng lại ring + chỉ mục
+        r.members, r.pins, r.pin_no, r.next_id = members, pins, pin_no, next_id
+    social.restore(d["social"])
+    sessions.live.update(d["sessions"][0]); sessions.parked.update(d["sessions"][1])
+    presence.pending = d["presence"]
+    if presence.pending: later(PRESENCE_MS/1000, flush_presence)
+    for k, b in d["buckets"].items():
+        if k not in lim: continue
+        for x in b.values(): x.rate, x.burst = lim[k].rate, lim[k].burst
+        lim[k].buckets = b
+    active.update(d["active"]); tids.update(d["tids"]); held.update(d["held"]); caps.update(d["caps"])
+    tid_seq = itertools.count(d["tid"])
+    io_done[:], zip_done[:] = d["io"], d["zip"]
+    reaped.update(d.get("reaped", {}))          # server cũ có thể chưa đếm
+    reap_logged = sum(reaped.values())
+
+# ────────── nhiều worker ──────────
+def serve_hub(n):
+    # process cha không nhận client: chỉ chạy hub, n worker là process con
+    # chạy lại server.py với cùng tham số (+ --worker i --bus <unix socket>)
+    path = os.path.join(tempfile.mkdtemp(prefix="chatbus"), "hub.sock")
+    hub = Hub(path, n)
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+                              + ["--worker", str(i), "--bus", path]) for i in range(n)]
+    try:
+        hub.start()
+        print(ts(), f"Hub: {n} workers on {HOST}:{PORT}", flush=True)
+        hub.serve()
+    finally:
+        for p in procs: p.terminate()
+        for p in procs: p.wait()
+        hub.close(); os.rmdir(os.path.dirname(path))
+
 # ────────── main ──────────
 def main():
-    with socket.socket(socket.AF_INET,socket.SOCK_STREAM) as s:
+    global HOST, PORT, MODE, OUT_MAX_MSGS, OUT_MAX_KB, PAUSE_MAX, HISTORY_CAP, JOIN_REPLAY
+    global RESUME_TTL, FLUSH_MS, PRESENCE_MS, MAX_CONNS, MAX_TRANSFERS, MAX_USER_TRANSFERS, WORKERS, WID, bus, blobs, MAX_MB, BLOB_DAYS, BLOB_MB, ZLEVEL, METRICS
+    global hand_srv, LOGIN_TIMEOUT, PING, DEAD, IDLE
+    ap = argparse.ArgumentParser(description="Multimedia chat server")
+    ap.add_argument("--host", default=HOST)
+    ap.add_argument("--port", type=int, default=PORT)
+    ap.add_argument("--mode", choices=("loop","thread"), default=MODE,
+                    help="loop = một event loop selectors; thread = thread-per-client")
+    ap.add_argument("--workers", type=int, default=WORKERS,
+                    help="số process worker chung cổng (SO_REUSEPORT, Linux; cần --mode loop)")
+    ap.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    ap.add_argument("--bus", help=argparse.SUPPRESS)
+    ap.add_argument("--out-msgs", type=int, default=OUT_MAX_MSGS,
+                    help="giới hạn hàng đợi gửi mỗi kết nối (số message)")
+    ap.add_argument("--out-kb", type=int, default=OUT_MAX_KB,
+                    help="giới hạn hàng đợi gửi mỗi kết nối (KB)")
+    ap.add_argument("--history", type=int, default=HISTORY_CAP,
+                    help="số message giữ trong RAM mỗi phòng")
+    ap.add_argument("--replay", type=int, default=JOIN_REPLAY,
+                    help="số message gửi lại khi /join")
+    ap.add_argument("--store", metavar="DB",
+                    help="file SQLite lưu lịch sử + pin (mặc định: chỉ RAM)")
+    ap.add_argument("--state", metavar="DIR",
+                    help="thư mục lưu bạn bè / chặn / lời mời + danh sách phòng (log + snapshot)")
+    ap.add_argument("--handoff", metavar="PATH",
+                    help="Unix socket để nâng cấp không ngắt kết nối: chạy server mới với cùng PATH, "
+                         "nó nhận mọi kết nối + trạng thái của server đang chạy (cần --mode loop, 1 process)")
+    ap.add_argument("--blobs", metavar="DIR",
+                    help="thư mục kho file: lưu upload, /fetch, dedupe (mặc định: chỉ relay)")
+    ap.add_argument("--blob-days", type=float, default=BLOB_DAYS,
+                    help="ngày giữ file trong kho kể từ lần tải cuối")
+    ap.add_argument("--blob-mb", type=int, default=BLOB_MB,
+                    help="tổng dung lượng kho (MB), quá thì xoá file ít dùng nhất")
+    ap.add_argument("--max-mb", type=int, default=MAX_MB,
+                    help="kích thước upload lớn nhất (MB)")
+    ap.add_argument("--flush-ms", type=float, default=FLUSH_MS,
+                    help="cửa sổ gộp các message nhỏ thành một lần ghi (0 = tắt)")
+    ap.add_argument("--zlib-level", type=int, choices=range(10), default=ZLEVEL,
+                    help="mức nén luồng cho client có cap zlib (0 = tắt)")
+    ap.add_argument("--metrics", type=int, default=METRICS, metavar="PORT",
+                    help="HTTP /metrics (Prometheus) trên 127.0.0.1:PORT, worker i: PORT+i (0 = tắt)")
+    ap.add_argument("--presence-ms", type=float, default=PRESENCE_MS,
+                    help="ms gom thông báo bạn bè online/offline theo người nhận (0 = gửi ngay)")
+    ap.add_argument("--resume-ttl", type=float, default=RESUME_TTL,
+                    help="giây giữ phiên sau khi rớt mạng để client resume")
+    ap.add_argument("--pause-max", type=float, default=PAUSE_MAX,
+                    help="giây relay file chờ consumer chậm trước khi ngắt nó")
+    ap.add_argument("--policy", default=",".join(f"{k}={v}" for k,v in POLICY.items()),
+                    help="kind=policy,… với kind chat|file|ctl, policy "+"|".join(POLICIES))
+    ap.add_argument("--limit", default=",".join(f"{k}={r}/{b}" for k,(r,b) in LIMITS.items()),
+                    help="kind=rate[/burst],… mỗi giây; kind "+"|".join(LIMITS)+" (0 = tắt)")
+    ap.add_argument("--login-timeout", type=float, default=LOGIN_TIMEOUT,
+                    help="giây từ lúc kết nối tới khi phải login xong (0 = không hạn)")
+    ap.add_argument("--ping", type=float, default=PING,
+                    help="giây im lặng trước khi ping client có cap ping (0 = tắt)")
+    ap.add_argument("--dead", type=float, default=DEAD,
+                    help="giây im lặng thì coi kết nối đã chết và đóng (cả TCP keepalive)")
+    ap.add_argument("--idle", type=float, default=IDLE,
+                    help="client không có cap ping: giây im lặng trước khi đóng (0 = không đóng)")
+    ap.add_argument("--max-conns", type=int, default=MAX_CONNS,
+                    help="kết nối đồng thời mỗi worker (0 = không giới hạn)")
+    ap.add_argument("--max-transfers", type=int, default=MAX_TRANSFERS,
+                    help="upload đang relay mỗi worker")
+    ap.add_argument("--max-user-transfers", type=int, default=MAX_USER_TRANSFERS,
+                    help="upload đang relay của một user")
+    a = ap.parse_args()
+    HOST, PORT, MODE = a.host, a.port, a.mode
+    OUT_MAX_MSGS, OUT_MAX_KB, PAUSE_MAX = a.out_msgs, a.out_kb, a.pause_max
+    HISTORY_CAP, JOIN_REPLAY = a.history, max(1, a.replay)
+    RESUME_TTL = sessions.ttl = a.resume_ttl
+    FLUSH_MS = max(0.0, a.flush_ms)
+    PRESENCE_MS = max(0.0, a.presence_ms)
+    ZLEVEL, METRICS = a.zlib_level, a.metrics
+    WORKERS = a.workers
+    MAX_MB, BLOB_DAYS, BLOB_MB = a.max_mb, a.blob_days, a.blob_mb
+    for kv in a.policy.split(","):
+        k, _, v = kv.partition("=")
+        if k not in POLICY or v not in POLICIES: ap.error(f"bad policy {kv!r}")
+        POLICY[k] = v
+    for kv in a.limit.split(","):
+        k, _, v = kv.partition("=")
+        rate, _, burst = v.partition("/")
+        if k not in LIMITS: ap.error(f"bad limit {kv!r}")
+        try: LIMITS[k] = (float(rate), float(burst) if burst else 2 * float(rate))
+        except ValueError: ap.error(f"bad limit {kv!r}")
+    set_limits()
+    MAX_CONNS, MAX_TRANSFERS, MAX_USER_TRANSFERS = a.max_conns, a.max_transfers, a.max_user_transfers
+    LOGIN_TIMEOUT, PING, DEAD, IDLE = max(0.0, a.login_timeout), max(0.0, a.ping), max(0.0, a.dead), max(0.0, a.idle)
+    if PING and DEAD <= PING: ap.error("--dead phải lớn hơn --ping")
+    if WORKERS > 1:
+        if MODE != "loop" or not hasattr(socket, "SO_REUSEPORT"):
+            ap.error("--workers cần --mode loop và SO_REUSEPORT (Linux)")
+        if a.worker is None:
+            serve_hub(WORKERS); return
+        WID = a.worker
+    if a.handoff and (MODE != "loop" or WORKERS > 1):
+        ap.error("--handoff cần --mode loop và một process")
+    took, t0 = None, time.perf_counter()
+    if a.handoff:                                   # có server đang chạy: nhận lại mọi thứ của nó
+        ctl = handoff.connect(a.handoff)
+        if ctl: took = handoff.take(ctl); handoff.ack(ctl)
+    # chỉ worker 0 ghi xuống đĩa, các worker khác áp dụng cùng op nên chỉ cần đọc;
+    # mở store trước khi nối bus để worker khác không thấy bảng meta của lần chạy cũ
+    st.cap, st.store = HISTORY_CAP, Store(a.store, write=WID == 0) if a.store else None
+    jn, saved = Journal(a.state, write=WID == 0) if a.state else None, None
+    if jn and took and took["journal"]:             # đĩa đã được server cũ ghi nốt
+        jn.open(*took["journal"]); social.journal = st.journal = jn
+    elif jn:
+        saved = jn.load()
+        social.restore(saved); social.journal = st.journal = jn
+        if saved["rooms"] is not None: rooms.clear(); rooms.update(dict.fromkeys(saved["rooms"]))
+        print(ts(), f"State: {len(saved['friends'])} users, {len(rooms)} rooms, "
+                    f"{jn.tail} log records replayed in {jn.ms:.0f} ms", flush=True)
+    if a.blobs: blobs = Blobs(a.blobs, BLOB_MB*1024*1024, BLOB_DAYS*86400)
+    if WORKERS > 1: bus = Bus(a.bus, WID, apply)
+    if took: restore(took)
+    else:
+        for r in list(rooms): rooms[r] = Room(r, st.cap, st.store, jn)
+    if jn:
+        if saved and saved["rooms"] is None:        # lần đầu: ghi các phòng mặc định
+            for r in rooms: jn.put("create", r)
+        jn.room_pins = {}                           # pin đã nằm trong các Room
+    if took: s = took["listen"]
+    else:
+        s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-        s.bind((HOST,PORT)); s.listen()
-        print(ts(),"Server listening",HOST,PORT)
+        if bus: s.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEPORT,1)
+        s.bind((HOST,PORT)); s.listen(socket.SOMAXCONN)
+    with s:
+        print(ts(),"Server listening",HOST,PORT,f"({MODE} mode)"
+              + (f" worker {WID}/{WORKERS}" if bus else ""), flush=True)
+        if took:
+            print(ts(), f"Took over {len(conns)} connections ({len(clients)} users, {len(rooms)} rooms) "
+                        f"in {(time.perf_counter() - t0) * 1000:.0f} ms", flush=True)
+        if a.handoff: hand_srv = handoff.listen(a.handoff)
+        if METRICS:
+            serve_metrics("127.0.0.1", METRICS + WID)
+            print(ts(), f"Metrics on http://127.0.0.1:{METRICS + WID}/metrics", flush=True)
+        if MODE == "loop": later(beats.tick, heartbeat)
+        else: threading.Thread(target=heartbeats, daemon=True).start()
+        if MODE == "loop":
+            serve_loop(s)
         while True:
             threading.Thread(target=client_thread,
                              args=s.accept(),daemon=True).start()
 
 if __name__=="__main__":
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
     try: main()
     except KeyboardInterrupt:
         sys.exit()
+    finally:
+        if st.store and st.store.write: st.store.sync()   # ghi nốt lịch sử còn trong hàng đợi
+        if st.journal: st.journal.sync()
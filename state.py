@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Trạng thái của server, chia thành các miền khoá độc lập.
+
+  State   – người dùng online <-> socket, sock -> phòng, danh sách phòng
+            (chỉ mục hai chiều, không phải quét toàn bộ client); thêm thư mục
+            toàn cục ai online / ở phòng nào, kể cả ở worker khác (--workers)
+  Room    – thành viên, lịch sử (+ chỉ mục /search), pin và bộ cấp id của MỘT
+            phòng (tuỳ chọn ghi xuống Store trên đĩa, xem store.py)
+  Social  – đồ thị bạn bè / chặn / lời mời đang chờ
+            (tuỳ chọn ghi vào Journal cùng danh sách phòng, xem journal.py)
+  Presence – thông báo bạn bè online / offline đang chờ gửi, gom theo người nhận
+  Sessions – token phiên để client kết nối lại (resume) mà không mất tên/phòng
+
+Mỗi lớp có lock riêng; khi phải lồng nhau thì luôn theo thứ tự
+State.lock -> Room.lock. Không hàm nào ở đây làm I/O mạng: người gọi lấy
+bản chụp (snapshot) rồi mới gửi sau khi đã nhả lock. Các lock là
+metrics.TimedLock: thời gian chờ khi tranh chấp được ghi theo tên miền khoá.
+"""
+
+import time
+from history import History
+from search import Index
+from metrics import TimedLock
+
+class Room:
+    __slots__ = ("name", "lock", "members", "history", "index", "pins", "pin_no", "next_id", "store", "journal")
+
+    def __init__(self, name, cap=1000, store=None, journal=None):
+        self.name, self.lock = name, TimedLock("room")
+        self.members = set()                        # {sock}
+        self.history = History(cap)                 # (id, sender, line) – phần mới nhất
+        self.index = Index()                        # từ -> id trong history (/search)
+        self.pins, self.pin_no = [], 1              # (pin_no, id, line)
+        self.next_id = 1
+        self.store, self.journal = store, journal
+        if store:                                   # chỉ nạp phần đuôi, không nạp cả log
+            for e in store.before(name, 1 << 62, cap): self.keep(tuple(e))
+            self.next_id = store.last_id(name) + 1
+            self.pins = [tuple(p) for p in store.pins(name)]
+        elif journal:                               # không có Store: pin nằm trong journal
+            self.pins = [tuple(p) for p in journal.room_pins.get(name, ())]
+        self.pin_no = max((p[0] for p in self.pins), default=0) + 1
+
+    def post(self, sender, make):
+        """Cấp id và ghi lịch sử trong cùng một đoạn khoá -> id không trùng,
+        lịch sử luôn tăng theo id. make(mid) trả về dòng hiển thị."""
+        with self.lock:
+            mid = self.next_id; self.next_id += 1
+            line = make(mid)
+            self.keep((mid, sender, line))
+            if self.store: self.store.append(self.name, mid, sender, line)
+        return mid, line
+
+    def keep(self, e):
+        # gọi khi đang giữ lock (hoặc lúc khởi tạo): history + chỉ mục cùng đổi
+        old = self.history.append(e)
+        if old: self.index.evict(old[0], old[2])
+        self.index.add(e[0], e[2])
+
+    def get(self, mid):
+        with self.lock:
+            rec = self.history.get(mid)
+        if rec is None and self.store:              # cũ hơn ring: đọc từ đĩa
+            rec = self.store.get(self.name, mid)
+        return rec
+
+    def recall(self, mid, usr):
+        """None nếu thành công, nếu không trả về thông báo lỗi."""
+        rec = self.get(mid)
+        if not rec: return "ID not found"
+        if rec[1] != usr: return "Only recall own msg"
+        line = f"[MSG #{mid}] (recalled)"
+        with self.lock:
+            if self.history.replace(mid, (mid, usr, line)): self.index.remove(mid, rec[2])
+            if self.store: self.store.update(self.name, mid, line)
+
+    def pin(self, mid):
+        rec = self.get(mid)
+        if not rec: return None
+        with self.lock:
+            no = self.pin_no; self.pin_no += 1
+            self.pins.append((no, mid, rec[2]))
+            if self.store: self.store.pin(self.name, no, mid, rec[2])
+            elif self.journal: self.journal.put("pin", self.name, no, mid, rec[2])
+            return no
+
+    def unpin(self, no):
+        with self.lock:
+            keep = [p for p in self.pins if p[0] != no]
+            if len(keep) == len(self.pins): return False
+            self.pins = keep
+            if self.store: self.store.unpin(self.name, no)
+            elif self.journal: self.journal.put("unpin", self.name, no)
+            return True
+
+    def page(self, before, n):
+        """Tối đa n message có id < before (None = mới nhất), cũ -> mới.
+        Lấy từ ring trước, thiếu thì đọc tiếp từ Store."""
+        with self.lock:
+            if before is None: before = self.next_id
+            out = self.history.before(before, n)
+        if len(out) < n and self.store:
+            edge = out[0][0] if out else before
+            out = [tuple(e) for e in self.store.before(self.name, edge, n - len(out))] + out
+        return out
+
+    def search(self, query, sender=None, before=None, n=20):
+        """([(id, sender, line)] mới -> cũ khớp mọi từ trong query, chỉ message
+        còn trong RAM; con trỏ before cho trang sau hoặc None)."""
+        with self.lock:
+            h = self.history
+            ok = (lambda mid: h.get(mid)[1] == sender) if sender else None
+            ids, cur = self.index.find(query, before, n, ok)
+            return [h.get(mid) for mid in ids], cur
+
+    def since(self, mid, n):
+        """Các message có id > mid (tối đa n mới nhất) – phần client còn thiếu.
+        None nếu mid không thuộc lịch sử phòng này (vd. server mất lịch sử)."""
+        with self.lock:
+            k = self.next_id - 1 - mid
+        if k < 0: return None
+        return self.page(None, min(k, n)) if k else []
+
+    def pinned(self):
+        with self.lock:
+            return list(self.pins)
+
+    def pin_rev(self):
+        """Số lần pin + unpin từ trước tới nay: đổi khi và chỉ khi danh sách pin đổi."""
+        with self.lock:
+            return 2*(self.pin_no - 1) - len(self.pins)
+
+    def replay(self, n):
+        """n message mới nhất + danh sách pin (cho /join)."""
+        return self.page(None, n), self.pinned()
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.members)
+
+
+class State:
+    def __init__(self, rooms=(), cap=1000, store=None):
+        self.lock, self.cap, self.store = TimedLock("state"), cap, store
+        self.journal = None                         # Journal: ghi tạo / xoá phòng
+        self.clients = {}                           # sock -> name
+        self.socks = {}                             # name -> sock
+        self.user_rooms = {}                        # sock -> room | None
+        self.rooms = {r: Room(r, cap, store) for r in rooms}
+        self.where = {}                             # name -> [worker, room] (mọi worker)
+        self.roster = {}                            # room -> {name} (mọi worker)
+
+    # ---- người dùng ----
+    def add(self, sock, name):
+        with self.lock:
+            if name in self.socks: return False
+            self.clients[sock] = name; self.socks[name] = sock
+            self.user_rooms[sock] = None
+            return True
+
+    def rename(self, sock, new):
+        with self.lock:
+            if new in self.socks: return False
+            del self.socks[self.clients[sock]]
+            self.clients[sock] = new; self.socks[new] = sock
+            return True
+
+    def remove(self, sock):
+        """Xoá khỏi mọi chỉ mục; trả về (name, room)."""
+        with self.lock:
+            name = self.clients.pop(sock, None)
+            if name is not None and self.socks.get(name) is sock:
+                del self.socks[name]
+            room = self.user_rooms.pop(sock, None)
+            r = self.rooms.get(room)
+            if r:
+                with r.lock: r.members.discard(sock)
+        return name, room
+
+    def name_of(self, sock):
+        return self.clients.get(sock)
+
+    def sock_of(self, name):
+        return self.socks.get(name)
+
+    def online(self):
+        with self.lock:
+            return len(self.where)
+
+    # ---- thư mục toàn cục (chỉ thay đổi qua op, xem server.emit) ----
+    def claim(self, name, wid):
+        """Giữ tên name cho worker wid; False nếu tên đang được dùng."""
+        with self.lock:
+            if name in self.where: return False
+            self.where[name] = [wid, None]
+            return True
+
+    def release(self, name):
+        """Bỏ name khỏi thư mục; trả về phòng nó đang ở (hoặc None)."""
+        with self.lock:
+            w = self.where.pop(name, None)
+            if w and w[1]: self.roster.get(w[1], set()).discard(name)
+            return w and w[1]
+
+    def rename_dir(self, old, new):
+        with self.lock:
+            if new in self.where: return False
+            w = self.where[new] = self.where.pop(old)
+            if w[1]:
+                names = self.roster.setdefault(w[1], set())
+                names.discard(old); names.add(new)
+            return True
+
+    def move(self, name, room):
+        with self.lock:
+            w = self.where.get(name)
+            if not w: return
+            if w[1]: self.roster.get(w[1], set()).discard(name)
+            w[1] = room
+            if room: self.roster.setdefault(room, set()).add(name)
+
+    def drop_worker(self, wid):
+        """Worker wid đã chết: bỏ mọi user của nó, trả về {tên: phòng} các user đó."""
+        with self.lock:
+            gone = [n for n, w in self.where.items() if w[0] == wid]
+        return {n: self.release(n) for n in gone}
+
+    def owns(self, name, wid):
+        w = self.where.get(name)
+        return w is not None and w[0] == wid
+
+    def is_online(self, name):
+        return name in self.where
+
+    def roster_of(self, room):
+        with self.lock:
+            return sorted(self.roster.get(room, ()))
+
+    # ---- phòng ----
+    def room(self, name):
+        return self.rooms.get(name)
+
+    def create(self, name):
+        with self.lock:
+            if name in self.rooms: return None
+            r = self.rooms[name] = Room(name, self.cap, self.store, self.journal)
+            if self.journal: self.journal.put("create", name)
+            return r
+
+    def delete(self, name):
+        """Xoá phòng; trả về các socket đang ở trong đó (None nếu không có phòng)."""
+        with self.lock:
+            r = self.rooms.pop(name, None)
+            if r is None: return None
+            if self.journal: self.journal.put("delete", name)
+            with r.lock:
+                members, r.members = r.members, set()
+            for c in members: self.user_rooms[c] = None
+            for n in self.roster.pop(name, ()):
+                if n in self.where: self.where[n][1] = None
+        if self.store: self.store.drop(name)
+        return members
+
+    def join(self, sock, name):
+        """Chuyển sock sang phòng name; trả về Room hoặc None nếu không có."""
+        with self.lock:
+            r = self.rooms.get(name)
+            if r is None: return None
+            prev = self.rooms.get(self.user_rooms.get(sock))
+            if prev is not None and prev is not r:
+                with prev.lock: prev.members.discard(sock)
+            with r.lock: r.members.add(sock)
+            self.user_rooms[sock] = name
+            return r
+
+    def leave(self, sock):
+        with self.lock:
+            name = self.user_rooms.get(sock)
+            r = self.rooms.get(name)
+            if r:
+                with r.lock: r.members.discard(sock)
+            self.user_rooms[sock] = None
+            return name
+
+    def members(self, name):
+        r = self.rooms.get(name)
+        return r.snapshot() if r else []
+
+    def counts(self):
+        with self.lock:
+            return [(n, len(self.roster.get(n, ()))) for n in self.rooms]
+
+    # ---- người nhận ----
+    def recipients(self, room, to, sender, social):
+        """Thành viên phòng (lọc theo danh sách `to` nếu có) không chặn sender."""
+        members = self.members(room)
+        with self.lock:
+            cand = [(c, self.clients.get(c)) for c in members]
+        if to:
+            to = set(to); cand = [(c, u) for c, u in cand if u in to]
+        return [c for c, u in cand if u is not None and not social.blocked(u, sender)]
+
+    def named(self, names, sender, social):
+        """Socket của các tên đang online, không chặn sender (PM)."""
+        with self.lock:
+            cand = [(self.socks[u], u) for u in set(names) if u in self.socks]
+        return [c for c, u in cand if not social.blocked(u, sender)]
+
+
+class Social:
+    """Mọi thay đổi được ghi vào journal (nếu có) ngay trong đoạn khoá, nên thứ tự
+    trong log đúng bằng thứ tự áp dụng trong RAM."""
+    def __init__(self, journal=None):
+        self.lock = TimedLock("social")
+        self.friends, self.blocks, self.pending = {}, {}, {}
+        self.journal = journal
+
+    def restore(self, d):
+        """Nhận các dict friends / blocks / pending đã nạp từ journal."""
+        with self.lock:
+            self.friends, self.blocks, self.pending = d["friends"], d["blocks"], d["pending"]
+
+    def ensure(self, name):
+        with self.lock:
+            self.friends.setdefault(name, set())
+            self.blocks.setdefault(name, set())
+            self.pending.setdefault(name, set())
+
+    def request(self, usr, target):
+        """Ghi lời mời usr -> target; False nếu đã là bạn hoặc đang chờ."""
+        with self.lock:
+            if target in self.friends.get(usr, ()) or usr in self.pending.get(target, ()):
+                return False
+            self.pending.setdefault(target, set()).add(usr)
+            if self.journal: self.journal.put("request", usr, target)
+            return True
+
+    def accept(self, usr, req):
+        with self.lock:
+            if req not in self.pending.get(usr, ()): return False
+            self.pending[usr].remove(req)
+            self.friends.setdefault(usr, set()).add(req)
+            self.friends.setdefault(req, set()).add(usr)
+            if self.journal: self.journal.put("accept", usr, req)
+            return True
+
+    def unfriend(self, usr, tgt):
+        with self.lock:
+            self.friends.get(usr, set()).discard(tgt)
+            self.friends.get(tgt, set()).discard(usr)
+            if self.journal: self.journal.put("unfriend", usr, tgt)
+
+    def toggle_block(self, usr, tgt):
+        """True nếu giờ tgt bị chặn, False nếu vừa bỏ chặn."""
+        with self.lock:
+            b = self.blocks.setdefault(usr, set())
+            on = tgt not in b
+            b.add(tgt) if on else b.remove(tgt)
+            if self.journal: self.journal.put("block", usr, tgt, on)
+            return on
+
+    def rename(self, old, new):
+        """False (không đổi gì) nếu tên mới đã có bạn / chặn / lời mời: của một
+        user đang offline, không được đè hay nhận thay."""
+        with self.lock:
+            if any(d.get(new) for d in (self.friends, self.blocks, self.pending)) or \
+               any(new in s for d in (self.blocks, self.pending) for s in d.values()):
+                return False
+            for d in (self.friends, self.blocks, self.pending):
+                d[new] = d.pop(old, set())
+            for f in self.friends[new]:                 # quan hệ bạn đối xứng: sửa cả phía kia
+                self.friends[f].discard(old); self.friends[f].add(new)
+            for d in (self.blocks, self.pending):       # ai chặn / đang mời tên cũ (hiếm: quét)
+                for s in d.values():
+                    if old in s: s.discard(old); s.add(new)
+            if self.journal: self.journal.put("rename", old, new)
+            return True
+
+    def friends_of(self, usr):
+        with self.lock:
+            return sorted(self.friends.get(usr, ()))
+
+    def blocked(self, usr, sender):
+        """usr có chặn sender không."""
+        return sender in self.blocks.get(usr, ())
+
+    def fans(self, name):
+        """Những người có name trong danh sách bạn. Quan hệ bạn luôn đối xứng
+        (accept / unfriend / rename sửa cả hai phía) nên friends[name] chính là
+        chỉ mục ngược: không phải quét mọi user đang online."""
+        with self.lock:
+            return list(self.friends.get(name, ()))
+
+
+class Presence:
+    """Gom thay đổi online / offline theo người nhận trong một cửa sổ ngắn. Khi
+    cả loạt client kết nối lại cùng lúc, mỗi người nhận được một dòng cho cả
+    cửa sổ thay vì một dòng cho từng người bạn; online rồi offline (hoặc ngược
+    lại) trong cùng cửa sổ thì triệt tiêu."""
+    def __init__(self):
+        self.lock = TimedLock("presence")
+        self.pending = {}                           # người nhận -> {tên: [trạng thái đầu, cuối]}
+
+    def add(self, name, online, fans):
+        """True nếu cửa sổ vừa mở (người gọi hẹn giờ take())."""
+        with self.lock:
+            start = not self.pending
+            for u in fans:
+                d = self.pending.setdefault(u, {})
+                if name in d: d[name][1] = online
+                else: d[name] = [online, online]
+            return start and bool(self.pending)
+
+    def take(self):
+        """{người nhận: [(tên, online)]} của cửa sổ, bỏ các cặp đã triệt tiêu."""
+        with self.lock:
+            p, self.pending = self.pending, {}
+        out = {}
+        for u, d in p.items():
+            ch = sorted((n, s[1]) for n, s in d.items() if s[0] == s[1])
+            if ch: out[u] = ch
+        return out
+
+
+class Sessions:
+    """Token -> phiên. Kết nối còn sống ở `live`; khi rớt mạng phiên được
+    giữ trong `parked` (tên + phòng) thêm ttl giây để client resume.
+    Ở chế độ --workers mọi worker giữ cùng bản (thay đổi qua op)."""
+    def __init__(self, ttl=300):
+        self.lock, self.ttl = TimedLock("sessions"), ttl
+        self.live = {}                              # token -> [worker, name]
+        self.parked = {}                            # token -> (name, room, hạn), theo thứ tự hạn
+
+    def open(self, token, wid, name):
+        with self.lock:
+            self.live[token] = [wid, name]
+
+    def park(self, token, name, room):
+        with self.lock:
+            if self.live.pop(token, None) is None: return
+            self.parked[token] = (name, room, time.monotonic() + self.ttl)
+
+    def end(self, token):
+        with self.lock:
+            self.live.pop(token, None); self.parked.pop(token, None)
+
+    def rename(self, old, new):
+        with self.lock:
+            for v in self.live.values():
+                if v[1] == old: v[1] = new
+
+    def of_worker(self, wid):
+        """[(token, name)] các phiên đang sống trên worker wid."""
+        with self.lock:
+            return [(t, v[1]) for t, v in self.live.items() if v[0] == wid]
+
+    def claim(self, token):
+        """("parked", (name, room)) | ("live", (worker, name)) | None. Phiên bị lấy ra."""
+        now = time.monotonic()
+        with self.lock:
+            while self.parked:                      # bỏ các phiên đã hết hạn
+                t = next(iter(self.parked))
+                if self.parked[t][2] > now: break
+                del self.parked[t]
+            if token in self.parked:
+                name, room, _exp = self.parked.pop(token)
+                return "parked", (name, room)
+            if token in self.live:
+                return "live", tuple(self.live.pop(token))
+        return None
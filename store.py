@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lưu lịch sử phòng xuống đĩa (SQLite, chỉ mục theo (room, id)).
+
+Ghi: mọi thay đổi (message mới, recall, pin/unpin, xoá phòng) được xếp vào
+hàng đợi, một writer thread gom lại và commit theo lô -> lệnh chat không
+chờ đĩa. Đọc: chỉ theo trang (n message trước một id), nên khởi động và
+/join không bao giờ phải nạp cả log vào RAM; mỗi lần đọc chờ các thao tác
+xếp trước nó được commit xong.
+"""
+
+import queue, sqlite3, threading, time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS msgs (room TEXT, id INTEGER, sender TEXT, line TEXT,
+                                 PRIMARY KEY (room, id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pins (room TEXT, no INTEGER, id INTEGER, line TEXT,
+                                 PRIMARY KEY (room, no)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER);
+"""
+BATCH = 1000                                        # số thao tác tối đa mỗi commit
+WAIT_WRITER = 2.0                                   # giây worker chỉ-đọc chờ worker ghi
+
+class Store:
+    def __init__(self, path, write=True):
+        """write=False: chỉ đọc (các worker phụ ở chế độ --workers), bỏ qua mọi lệnh ghi.
+        Các worker áp dụng cùng dãy op nên đếm cùng số lệnh ghi; worker ghi lưu số
+        lệnh đã commit vào bảng meta để worker chỉ-đọc biết khi nào đọc được."""
+        self.path, self.q, self.write = path, queue.Queue(), write
+        self.cv, self.seq, self.done = threading.Condition(), 0, 0
+        db = sqlite3.connect(path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        if write:
+            with db: db.execute("INSERT OR REPLACE INTO meta VALUES ('done', 0)")
+        db.close()
+        self.rd = sqlite3.connect(path, check_same_thread=False)
+        self.rlock = threading.Lock()
+        if write: threading.Thread(target=self._writer, daemon=True).start()
+
+    # ---- ghi (không chặn) ----
+    def append(self, room, mid, sender, line):
+        self._put("INSERT OR REPLACE INTO msgs VALUES (?,?,?,?)", (room, mid, sender, line))
+
+    def update(self, room, mid, line):
+        self._put("UPDATE msgs SET line=? WHERE room=? AND id=?", (line, room, mid))
+
+    def pin(self, room, no, mid, line):
+        self._put("INSERT OR REPLACE INTO pins VALUES (?,?,?,?)", (room, no, mid, line))
+
+    def unpin(self, room, no):
+        self._put("DELETE FROM pins WHERE room=? AND no=?", (room, no))
+
+    def drop(self, room):
+        self._put("DELETE FROM msgs WHERE room=?", (room,))
+        self._put("DELETE FROM pins WHERE room=?", (room,))
+
+    def _put(self, sql, args):
+        with self.cv:
+            self.seq += 1
+            if self.write: self.q.put((sql, args))
+
+    def sync(self):
+        """Chờ mọi thao tác đã xếp tới thời điểm này được commit."""
+        with self.cv:
+            target = self.seq
+            if self.write:
+                self.cv.wait_for(lambda: self.done >= target)
+                return
+        end = time.monotonic() + WAIT_WRITER       # worker ghi chết: đọc những gì đã có
+        while time.monotonic() < end:
+            with self.rlock:                        # fetchall: đóng lệnh, không giữ snapshot cũ
+                rows = self.rd.execute("SELECT v FROM meta WHERE k='done'").fetchall()
+            if rows and rows[0][0] >= target: return
+            time.sleep(0.001)
+
+    def _writer(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            ops = [self.q.get()]
+            while len(ops) < BATCH:
+                try: ops.append(self.q.get_nowait())
+                except queue.Empty: break
+            with db:
+                for sql, args in ops: db.execute(sql, args)
+                db.execute("UPDATE meta SET v=? WHERE k='done'", (self.done + len(ops),))
+            with self.cv:
+                self.done += len(ops)
+                self.cv.notify_all()
+
+    # ---- đọc ----
+    def _rows(self, sql, args):
+        self.sync()
+        with self.rlock:
+            return self.rd.execute(sql, args).fetchall()
+
+    def last_id(self, room):
+        return self._rows("SELECT MAX(id) FROM msgs WHERE room=?", (room,))[0][0] or 0
+
+    def before(self, room, mid, n):
+        """n message ngay trước id mid (cũ -> mới)."""
+        rows = self._rows("SELECT id, sender, line FROM msgs WHERE room=? AND id<? "
+                          "ORDER BY id DESC LIMIT ?", (room, mid, n))
+        return rows[::-1]
+
+    def get(self, room, mid):
+        rows = self._rows("SELECT id, sender, line FROM msgs WHERE room=? AND id=?", (room, mid))
+        return rows[0] if rows else None
+
+    def pins(self, room):
+        return self._rows("SELECT no, id, line FROM pins WHERE room=? ORDER BY no", (room,))
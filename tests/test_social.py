@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Social.rename lên tên của một user offline còn dữ liệu đã lưu (--state DIR)."""
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from journal import Journal
+from state import Social
+
+def persisted(path):
+    # bob (offline) có bạn carol và chặn dave, đã ghi xuống journal
+    jn = Journal(path); soc = Social(jn); soc.restore(jn.load())
+    soc.request("bob", "carol"); soc.accept("carol", "bob")
+    soc.toggle_block("bob", "dave")
+    soc.request("alice", "erin")
+    jn.close()
+
+def reopen(path):
+    jn = Journal(path); soc = Social(jn); soc.restore(jn.load())
+    return jn, soc
+
+def test_rename_onto_offline_user_refused(tmp_path):
+    path = str(tmp_path); persisted(path)
+    jn, soc = reopen(path)
+    assert not soc.rename("alice", "bob")
+    assert soc.friends_of("bob") == ["carol"] and soc.blocked("bob", "dave")
+    assert soc.fans("alice") == [] and "alice" in soc.pending["erin"]
+    jn.close()
+    jn, soc = reopen(path)                      # lần từ chối không được ghi vào journal
+    assert soc.friends_of("bob") == ["carol"] and soc.blocked("bob", "dave")
+    assert "alice" in soc.pending["erin"]
+    jn.close()
+
+def test_rename_onto_name_someone_blocks_refused():
+    soc = Social()
+    soc.toggle_block("carol", "bob")            # bob không có dữ liệu riêng nhưng bị carol chặn
+    assert not soc.rename("alice", "bob")
+    assert soc.blocked("carol", "bob") and not soc.blocked("carol", "alice")
+
+def test_rename_onto_free_name(tmp_path):
+    path = str(tmp_path); persisted(path)
+    jn, soc = reopen(path)
+    soc.ensure("zed")                           # login tạo set rỗng: chưa phải dữ liệu
+    assert soc.rename("bob", "zed")
+    jn.close()
+    jn, soc = reopen(path)
+    assert soc.friends_of("zed") == ["carol"] and soc.friends_of("carol") == ["zed"]
+    assert soc.blocked("zed", "dave") and not soc.friends_of("bob")
+    jn.close()
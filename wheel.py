@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bánh xe hẹn giờ (hashed timing wheel) cho hạn của kết nối: login, ping, chết.
+
+Mỗi ô ứng với TICK giây; object có hạn `due` nằm ở ô của tick đầu tiên sau
+due, trong SLOTS ô quay vòng. add() và pop() tốn O(1) mỗi object, không phụ
+thuộc số kết nối – không phải heap O(log n), không một Timer mỗi kết nối. Hạn
+không bao giờ bị huỷ hay dời: mỗi lần nhận dữ liệu, server chỉ ghi thời điểm
+vào Conn; khi pop() trả Conn ra (trễ tối đa một tick), server tự xét lại hạn
+thật và add() lại nếu chưa tới. Hạn xa hơn một vòng nằm chờ trong ô, pop() bỏ
+qua tới đúng vòng của nó.
+"""
+
+import threading, time
+
+TICK = 1.0                                      # giây mỗi ô
+SLOTS = 256                                     # số ô (một vòng = SLOTS * TICK giây)
+
+class Wheel:
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick, self.slots = tick, [[] for _ in range(slots)]
+        self.lock = threading.Lock()            # thread mode: thread client add(), thread hẹn giờ pop()
+        self.at = int(time.monotonic() / tick)  # tick kế tiếp chưa quét
+        self.n = 0
+
+    def __len__(self): return self.n
+
+    def add(self, obj, due):
+        with self.lock:
+            k = max(int(due / self.tick) + 1, self.at)   # không bao giờ sớm; hạn đã qua: tick kế
+            self.slots[k % len(self.slots)].append((k, obj)); self.n += 1
+
+    def pop(self, now):
+        """Các object có hạn tới trước now (theo thứ tự tick)."""
+        end, out, size = int(now / self.tick), [], len(self.slots)
+        with self.lock:
+            if end - self.at >= size:           # lâu không quét (vd. máy treo): một vòng là đủ
+                self.at = end - size + 1
+            while self.at <= end:
+                s = self.slots[self.at % size]
+                if s:
+                    out += [o for k, o in s if k <= self.at]
+                    s[:] = [e for e in s if e[0] > self.at]      # các vòng sau
+                self.at += 1
+            self.n -= len(out)
+        return out